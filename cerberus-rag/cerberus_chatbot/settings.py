@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chatbot.log_pipeline.request_context_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -114,9 +116,32 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # WAL permite lecturas concurrentes mientras se escribe desde otro hilo
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
     }
 }
 
+# PostgreSQL con pool de conexiones (psycopg[pool]) si se configura POSTGRES_DB
+if os.environ.get('POSTGRES_DB'):
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ['POSTGRES_DB'],
+        'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+        'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+        'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+        'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+        'OPTIONS': {
+            'pool': {
+                'min_size': int(os.environ.get('POSTGRES_POOL_MIN', 2)),
+                'max_size': int(os.environ.get('POSTGRES_POOL_MAX', 20)),
+            },
+        },
+    }
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -158,42 +183,155 @@ STATIC_URL = 'static/'
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Chatbot
+# Presupuesto de tokens del prompt (contexto + historial + pregunta)
+CHATBOT_PROMPT_TOKEN_BUDGET = 2048
+CHATBOT_PROMPT_HISTORY_BUDGET = 512
+# Tokenizador del modelo generador (llama3.2, copia sin acceso restringido); si no se puede cargar
+# se usa una aproximación por exceso y /api/metrics/load/ lo indica en `prompt_tokenizer`
+CHATBOT_PROMPT_TOKENIZER = os.environ.get('CHATBOT_PROMPT_TOKENIZER', 'unsloth/Llama-3.2-3B-Instruct')
+CHATBOT_PROMPT_MAX_OVERLAP = 400  # caracteres
+CHATBOT_PROMPT_MIN_OVERLAP = 20  # caracteres; solapamientos menores no se consideran
+CHATBOT_PROMPT_MIN_TAIL_TOKENS = 20  # tokens libres mínimos para añadir un chunk recortado
+# Persistencia write-behind de mensajes (segundos entre escrituras y tamaño de lote).
+# El intervalo es también lo que se pierde si el proceso muere sin cerrarse (SIGKILL, OOM)
+CHATBOT_WRITE_BEHIND_INTERVAL = 0.5
+CHATBOT_WRITE_BEHIND_BATCH_SIZE = 200
+# Retención: conversaciones inactivas más de N días se archivan en ficheros mensuales comprimidos
+CHATBOT_RETENTION_DAYS = 90
+CHATBOT_RETENTION_INTERVAL_HOURS = 24  # intervalo de `manage.py archive_conversations --periodic`
+CHATBOT_ARCHIVE_DIR = BASE_DIR / 'archive'
+# Diario de feedback: lotes en memoria, fsync ('always', 'batch', 'never') y rotación
+CHATBOT_FEEDBACK_DIR = BASE_DIR / 'feedback'
+CHATBOT_FEEDBACK_BATCH_SIZE = 100
+CHATBOT_FEEDBACK_FLUSH_INTERVAL = 2.0
+CHATBOT_FEEDBACK_FSYNC = 'batch'
+CHATBOT_FEEDBACK_MAX_BYTES = 64 * 1024 * 1024
+CHATBOT_FEEDBACK_MAX_AGE_HOURS = 24
+# Inferencia del embedder y el cross-encoder: 'torch' (fp32) u 'onnx' (int8, requiere optimum[onnxruntime])
+CHATBOT_INFERENCE_BACKEND = os.environ.get('CHATBOT_INFERENCE_BACKEND', 'torch')
+CHATBOT_ONNX_CACHE_DIR = BASE_DIR / 'onnx_models'
+CHATBOT_ONNX_THREADS = 0  # 0 = decide ONNX Runtime
+# Rerank en cascada: se omite el cross-encoder si los recuperadores coinciden y hay margen
+CHATBOT_CASCADE_ENABLED = True
+CHATBOT_CASCADE_AGREEMENT_K = 3
+CHATBOT_CASCADE_MIN_AGREEMENT = 2
+CHATBOT_CASCADE_MIN_MARGIN = 0.15
+CHATBOT_CASCADE_CANDIDATES = 6
+# Pool de hilos de los recuperadores y timeout (segundos) de cada uno, contado desde que empieza a ejecutarse
+CHATBOT_RETRIEVAL_WORKERS = 4
+CHATBOT_RETRIEVAL_SPARE_WORKERS = 4  # hilos extra para los recuperadores que siguen tras vencer su timeout
+# Procesos shard de recuperación; 1 mantiene todos los índices en el proceso principal
+CHATBOT_RETRIEVAL_SHARDS = int(os.environ.get('CHATBOT_RETRIEVAL_SHARDS', 1))
+CHATBOT_RETRIEVAL_TIMEOUTS = {
+    'vector': 2.0,
+    'bm25l': 1.0,
+    'tfidf': 1.0,
+    'shard': 3.0,
+    'default': 5.0,
+}
+# Historial como señales de recuperación: peso del turno más reciente, decaimiento por turno y caché de embeddings
+CHATBOT_HISTORY_TURNS = 2
+CHATBOT_HISTORY_WEIGHT = 0.5  # la consulta actual pesa 1
+CHATBOT_HISTORY_DECAY = 0.9
+CHATBOT_HISTORY_EMBEDDING_CACHE_SIZE = 2048
+# Caché de resultados de recuperación (ids y puntuaciones); 0 la desactiva. El nivel compartido usa un alias
+# de CACHES (p. ej. django.core.cache.backends.redis.RedisCache) y es opcional
+CHATBOT_RETRIEVAL_CACHE_SIZE = 1024
+CHATBOT_RETRIEVAL_CACHE_ALIAS = os.environ.get('CHATBOT_RETRIEVAL_CACHE_ALIAS') or None
+CHATBOT_RETRIEVAL_CACHE_TTL = 3600  # segundos en el nivel compartido
+
+# Instancias de Ollama: "url|peso,url|peso" en CHATBOT_LLM_ENDPOINTS
+CHATBOT_LLM_ENDPOINTS = [
+    {'url': url, 'weight': float(weight or 1)}
+    for url, _, weight in (
+        entry.strip().partition('|')
+        for entry in os.environ.get('CHATBOT_LLM_ENDPOINTS', 'http://localhost:11434').split(',')
+        if entry.strip()
+    )
+]
+CHATBOT_LLM_HEALTH_INTERVAL = 10.0
+
+CHATBOT_LOAD_ENABLED = True
+CHATBOT_LOAD_MAX_INFLIGHT = 8  # consultas simultáneas por proceso antes de degradar
+CHATBOT_LOAD_LAG_BUDGET = 0.1  # segundos de retraso medio del event loop
+CHATBOT_LOAD_GENERATION_BUDGET = 15.0  # segundos de generación media
+CHATBOT_LOAD_SHORT_MAX_TOKENS = 256
+CHATBOT_LOAD_COOLDOWN = 10.0  # segundos con poca presión antes de recuperar un escalón
+CHATBOT_ANSWER_CACHE_SIZE = 256
+
+# Troceado de los PDF (caracteres); un snapshot construido con otros valores no se carga
+CHATBOT_CHUNK_SIZE = 1000
+CHATBOT_CHUNK_OVERLAP = 200
+
+CHATBOT_DEDUP_ENABLED = True
+CHATBOT_DEDUP_THRESHOLD = 0.85  # Jaccard mínimo entre shingles para considerar casi duplicados
+
+# Snapshots del índice generados con `manage.py build_index` (se cargan con mmap al arrancar si
+# coinciden los PDF, el modelo y backend de embeddings, el troceado y la deduplicación)
+CHATBOT_INDEX_DIR = BASE_DIR / 'index'
+CHATBOT_INDEX_SNAPSHOT_ENABLED = True
+
+# Respuestas WebSocket retomables: segundos que se conservan los tokens tras terminar y máximo de respuestas guardadas
+CHATBOT_STREAM_BUFFER_TTL = 120.0
+CHATBOT_STREAM_BUFFER_MAX = 500
+CHATBOT_SSE_KEEPALIVE = 15.0  # segundos sin datos antes de enviar un comentario SSE a los proxies
+
+CHATBOT_LOOP_LAG_THRESHOLD = 0.2  # segundos de bloqueo del event loop que se registran (0 = desactivado)
+
+# Lotes de preguntas (`manage.py batch_qa` y /api/admin/batch-qa/)
+CHATBOT_BATCH_DIR = BASE_DIR / 'batches'  # la API solo lee y escribe ficheros dentro de este directorio
+CHATBOT_BATCH_SIZE = 16  # preguntas por paso de recuperación (embeddings y rerank juntos)
+CHATBOT_BATCH_CONCURRENCY = 2  # generaciones simultáneas de un lote
+CHATBOT_BATCH_RETRIEVAL_WORKERS = 1  # hilos de recuperación de los lotes, separados de los del chat
+
+# Logging: logs/chatbot.<proceso>.log en JSON (un registro por línea), rotado por tamaño o antigüedad
+CHATBOT_LOG_MAX_BYTES = 50 * 1024 * 1024
+CHATBOT_LOG_MAX_AGE_HOURS = 24
+CHATBOT_LOG_BACKUP_COUNT = 7
+CHATBOT_LOG_QUEUE_SIZE = 10000  # registros pendientes; con la cola llena se descartan
+# Fracción de registros INFO/DEBUG que se conserva por prefijo de logger (WARNING y superiores siempre)
+CHATBOT_LOG_SAMPLING = {
+    'chatbot.queries': 0.1,
+}
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
     'formatters': {
+        # Formato de la consola; el fichero siempre se escribe en JSON
         'verbose': {
             'format': '{levelname} {asctime} {module} {message}',
             'style': '{',
         },
-        'simple': {
-            'format': '{levelname} {message}',
-            'style': '{',
-        },
     },
     'handlers': {
-        'console': {
-            'class': 'logging.StreamHandler',
-            'formatter': 'verbose',
-        },
-        'file': {
-            'class': 'logging.FileHandler',
-            'filename': 'chatbot.log',
+        # Cola en memoria + hilo escritor: registrar nunca espera al disco ni a la consola
+        'async': {
+            '()': 'chatbot.log_pipeline.AsyncLogHandler',
             'formatter': 'verbose',
+            # Un fichero por proceso (runserver, worker-0, shard-1...): cada uno rota solo el suyo
+            'filename': str(BASE_DIR / 'logs' / 'chatbot.{process}.log'),
+            'max_bytes': CHATBOT_LOG_MAX_BYTES,
+            'backup_count': CHATBOT_LOG_BACKUP_COUNT,
+            'max_age_hours': CHATBOT_LOG_MAX_AGE_HOURS,
+            'queue_size': CHATBOT_LOG_QUEUE_SIZE,
+            'sampling': CHATBOT_LOG_SAMPLING,
         },
     },
     'root': {
-        'handlers': ['console', 'file'],
+        'handlers': ['async'],
         'level': 'INFO',
     },
     'loggers': {
         'django': {
-            'handlers': ['console', 'file'],
+            'handlers': ['async'],
             'level': 'INFO',
             'propagate': False,
         },
         'chatbot': {
-            'handlers': ['console', 'file'],
+            'handlers': ['async'],
             'level': 'INFO',
             'propagate': False,
         },
@@ -4,15 +4,38 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Solo los procesos que atienden peticiones arrancan el servicio de chat al cargar la app; el
+# resto de comandos (migraciones, índices, benchmarks, informes, lotes, serve_workers) lo
+# inicializan ellos mismos si lo necesitan
+SERVER_COMMANDS = ('runserver',)
+SERVER_PROGRAMS = ('daphne',)
+
+
+def is_server_process() -> bool:
+    import os
+    import sys
+    if not sys.argv:
+        return False
+    # `daphne ...` o `python -m daphne ...` (sys.argv[0] es .../daphne/__main__.py)
+    if set(SERVER_PROGRAMS) & set(os.path.normpath(sys.argv[0]).split(os.sep)[-2:]):
+        return True
+    if len(sys.argv) > 1 and sys.argv[1] in SERVER_COMMANDS:
+        # Con el autorecargador solo el proceso hijo (RUN_MAIN) atiende peticiones
+        return os.environ.get('RUN_MAIN') == 'true' or '--noreload' in sys.argv
+    return False
+
+
 class ChatbotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chatbot'
 
     def ready(self):
         """Este método se ejecuta cuando la aplicación Django arranca"""
-        # Evitamos iniciar el servicio durante las migraciones
-        import sys
-        if 'makemigrations' not in sys.argv and 'migrate' not in sys.argv:
+        import os
+        # Los procesos shard (ver services.sharding) solo construyen su partición
+        if os.environ.get('CHATBOT_SHARD_WORKER'):
+            return
+        if is_server_process():
             logger.info("Iniciando servicio de chatbot...")
             # Iniciar el servicio en un hilo separado para no bloquear el arranque
             from .views.chat_views import init_chat_service
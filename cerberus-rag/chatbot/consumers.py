@@ -1,17 +1,35 @@
 import json
 import uuid
+import asyncio
+import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
-from asgiref.sync import sync_to_async
+from asgiref.sync import ThreadSensitiveContext
+from . import repository
 from .models import Conversation, Message
 from .services.chat_service import ChatService
+from .services.metadata_index import InvalidFilterError
+from .services.message_writer import MessageWriter
+from .services.profiling import ProfilingService
+from .services.answer_streams import AnswerStreamRegistry
+from .log_pipeline import bind_log_context, new_request_id
+
+logger = logging.getLogger(__name__)
 
 chat_service = ChatService.get_instance()
+message_writer = MessageWriter.get_instance()
+profiling = ProfilingService.get_instance()
+answer_streams = AnswerStreamRegistry.get_instance()
 
 class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.user = self.scope['user']
-        self.session_id = self.scope.get('session', {}).get('session_key', 'anonymous')
+        # Mismo dueño que en las vistas HTTP: el usuario autenticado o la clave de sesión
+        self.session_id = getattr(self.scope.get('session'), 'session_key', None) or 'anonymous'
+        self.owner = f"user:{self.user.pk}" if self.user.is_authenticated else f"session:{self.session_id}"
+        self.owner_filter = {'user': self.user} if self.user.is_authenticated else {'session_id': self.session_id}
         self.conversation_id = self.scope['url_route']['kwargs'].get('conversation_id')
+        self.conversation = None
+        self.chat_history = []
 
         if self.conversation_id:
             # Join the specific conversation group
@@ -44,6 +62,16 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
     # Receive message from WebSocket
     async def receive(self, text_data):
+        # Cada mensaje usa su propio hilo y conexión de base de datos, como una petición HTTP
+        async with ThreadSensitiveContext(), profiling.request('ChatConsumer'):
+            # Cada mensaje es una petición para el log; la generación lanzada desde aquí hereda los ids
+            bind_log_context(request_id=new_request_id(), conversation_id=self.conversation_id)
+            try:
+                await self.handle_message(text_data)
+            finally:
+                await repository.close_connections()
+
+    async def handle_message(self, text_data):
         text_data_json = json.loads(text_data)
         message_type = text_data_json.get('type')
 
@@ -52,14 +80,22 @@ class ChatConsumer(AsyncWebsocketConsumer):
             conversation_id = text_data_json.get('conversation_id')
 
             # Handle the message
-            await self.process_message(query, conversation_id)
+            await self.process_message(query, conversation_id, text_data_json.get('filters'))
+        elif message_type == 'resume':
+            await self.resume_stream(text_data_json.get('message_id'), text_data_json.get('offset', 0))
         elif message_type == 'feedback':
             await self.process_feedback(
                 text_data_json.get('message_id'),
                 text_data_json.get('rating')
             )
 
-    async def process_message(self, query, conversation_id):
+    async def process_message(self, query, conversation_id, filters=None):
+        try:
+            chat_service.validate_filters(filters)
+        except InvalidFilterError as e:
+            await self.send(text_data=json.dumps({'type': 'error', 'message': str(e)}))
+            return
+
         # Acknowledge receipt of the message
         await self.send(text_data=json.dumps({
             'type': 'system_message',
@@ -67,82 +103,126 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'temp_id': str(uuid.uuid4())  # Temporary ID for the loading message
         }))
 
-        # Get or create conversation
+        conversation = await self.get_or_create_conversation(conversation_id)
+
+        # Save user message (write-behind: se persiste en segundo plano)
+        user_message = Message(conversation=conversation, role='user', content=query)
+        message_writer.add_message(user_message)
+        self.chat_history.append({'role': 'user', 'content': query})
+
+        # Process query with streaming
+        await self.stream_response(query, list(self.chat_history), conversation, filters)
+
+    async def get_or_create_conversation(self, conversation_id):
+        """Reutiliza la conversación e historial cargados en esta conexión; solo consulta la base de datos al cambiar de conversación"""
+        if self.conversation and (not conversation_id or str(conversation_id) == str(self.conversation.id)):
+            return self.conversation
+
         conversation = None
+        history = []
         if conversation_id:
-            try:
-                conversation = await sync_to_async(Conversation.objects.get)(id=conversation_id)
-            except Conversation.DoesNotExist:
-                pass
+            if message_writer.has_pending_conversation(conversation_id):
+                await message_writer.flush()
+            conversation, history = await repository.load_conversation_with_history(
+                conversation_id, **self.owner_filter
+            )
 
         if not conversation:
-            conversation = await sync_to_async(Conversation.objects.create)(
+            conversation = Conversation(
                 user=self.user if self.user.is_authenticated else None,
                 session_id=self.session_id
             )
-            self.conversation_id = str(conversation.id)
+            message_writer.add_conversation(conversation)
 
-        # Save user message
-        user_message = await sync_to_async(Message.objects.create)(
-            conversation=conversation,
-            role='user',
-            content=query
-        )
+        self.conversation = conversation
+        self.conversation_id = str(conversation.id)
+        bind_log_context(conversation_id=self.conversation_id)
+        self.chat_history = history
+        return conversation
 
-        # Get chat history
-        messages = await sync_to_async(list)(Message.objects.filter(conversation=conversation).order_by('created_at'))
-        chat_history = [{'role': msg.role, 'content': msg.content} for msg in messages]
+    async def stream_response(self, query, chat_history, conversation, filters=None):
+        # El id del mensaje del asistente se asigna antes de generar el primer token
+        assistant_message = Message(conversation=conversation, role='assistant', content="")
+        stream = answer_streams.create(str(assistant_message.id), str(conversation.id), self.owner)
+        # La generación corre en su propia tarea: si el cliente se desconecta continúa, y
+        # una conexión nueva puede retomarla con `resume`
+        stream.task = asyncio.create_task(self.generate(stream, assistant_message, query, chat_history, filters))
+        # El cliente registra el id desde ya: si la conexión cae antes del primer token, también lo retoma
+        await self.send(text_data=json.dumps({
+            'type': 'streaming_start',
+            'message_id': stream.message_id,
+            'conversation_id': stream.conversation_id
+        }))
 
-        # Process query with streaming
-        await self.stream_response(query, chat_history, conversation)
-
-    async def stream_response(self, query, chat_history, conversation):
-        response_text = ""
-        # Create placeholder for the assistant message
-        assistant_message = await sync_to_async(Message.objects.create)(
-            conversation=conversation,
-            role='assistant',
-            content=""  # Empty content initially
-        )
+        response_text = await self.follow_stream(stream)
+        self.chat_history.append({'role': 'assistant', 'content': response_text})
 
+    @staticmethod
+    async def generate(stream, assistant_message, query, chat_history, filters=None):
+        trace = {}
         try:
             # Get streaming response
-            async for token in chat_service.stream_query(query, chat_history):
+            async for token in chat_service.stream_query(query, chat_history, trace=trace, filters=filters):
                 if token:  # Make sure we only send non-empty tokens
-                    response_text += token
-                    # Send the token to the WebSocket
-                    await self.send(text_data=json.dumps({
-                        'type': 'streaming_token',
-                        'token': token,
-                        'message_id': str(assistant_message.id)
-                    }))
-
-            # Update the message with the complete response
-            assistant_message.content = response_text
-            await sync_to_async(assistant_message.save)()
-
-            # Send complete message notification
-            await self.send(text_data=json.dumps({
+                    stream.append(token)
+            response_text = stream.text
+            final = {
                 'type': 'message_complete',
-                'message_id': str(assistant_message.id),
-                'conversation_id': str(conversation.id),
-                'full_message': response_text  # Include the full message
-            }))
+                'message_id': stream.message_id,
+                'conversation_id': stream.conversation_id,
+                'full_message': response_text,  # Include the full message
+                'sources': trace.get('sources', []),
+                'tier': trace.get('tier')
+            }
         except Exception as e:
             logger.error(f"Error in stream_response: {str(e)}")
-            # Send error message
-            await self.send(text_data=json.dumps({
+            response_text = f"{stream.text} (Error: {str(e)})"
+            final = {
                 'type': 'error',
-                'message': f"Error: {str(e)}"
+                'message': f"Error: {str(e)}",
+                'message_id': stream.message_id
+            }
+
+        # El mensaje se persiste una sola vez con el contenido completo, incluso tras un error
+        # o si el cliente ya no está conectado
+        assistant_message.content = response_text
+        assistant_message.metadata = trace
+        message_writer.add_message(assistant_message)
+        stream.finish(final)
+
+    async def follow_stream(self, stream, offset=0):
+        """Envía los tokens desde `offset` y, al terminar, el mensaje completo (o el error)"""
+        async for position, token in stream.follow(offset):
+            await self.send(text_data=json.dumps({
+                'type': 'streaming_token',
+                'token': token,
+                'message_id': stream.message_id,
+                'offset': position
             }))
+        await self.send(text_data=json.dumps(stream.final))
+        return stream.text
 
-        # Make sure to update the message even on error
-        if not assistant_message.content and response_text:
-            assistant_message.content = f"{response_text} (Error: {str(e)})"
-            await sync_to_async(assistant_message.save)()
-    async def process_feedback(self, message_id, rating):
-        from .models import Feedback
+    async def resume_stream(self, message_id, offset):
+        """Retoma tras una reconexión una respuesta que sigue generándose o terminó hace poco"""
+        stream = answer_streams.get(str(message_id)) if message_id else None
+        if stream is None or stream.owner != self.owner:
+            # Expiró, se generó en otro proceso o es de otro usuario: el cliente debe recargar
+            # la conversación (a otro dueño se le responde igual que si no existiera)
+            await self.send(text_data=json.dumps({
+                'type': 'resume_failed',
+                'message_id': message_id
+            }))
+            return
+        try:
+            offset = max(int(offset or 0), 0)
+        except (TypeError, ValueError):
+            offset = 0
+        if not self.conversation_id:
+            self.conversation_id = stream.conversation_id
+        bind_log_context(conversation_id=stream.conversation_id)
+        await self.follow_stream(stream, offset)
 
+    async def process_feedback(self, message_id, rating):
         if not message_id or not rating or not (1 <= int(rating) <= 5):
             await self.send(text_data=json.dumps({
                 'type': 'error',
@@ -151,18 +231,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         try:
-            message = await sync_to_async(Message.objects.get)(id=message_id, role='assistant')
-            feedback_obj = await sync_to_async(Feedback.objects.create)(
-                message=message,
-                rating=int(rating)
-            )
+            # El mensaje puede seguir en la cola de escritura
+            await message_writer.flush()
+            message = await repository.get_assistant_message(message_id)
+            feedback_obj = await repository.create_feedback(message, int(rating))
 
             # Get the last user message
-            last_user_message = await sync_to_async(lambda: message.conversation.messages.filter(role='user').last())()
-            query = last_user_message.content if last_user_message else ""
+            query = await repository.get_last_user_query(message.conversation_id)
 
             # Save feedback
-            await chat_service.save_feedback_async(query, message.content, int(rating))
+            await chat_service.save_feedback_async(
+                query, message.content, int(rating),
+                message_id=message.id,
+                conversation_id=message.conversation_id
+            )
 
             await self.send(text_data=json.dumps({
                 'type': 'feedback_received',
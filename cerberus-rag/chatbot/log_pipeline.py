@@ -0,0 +1,312 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import uuid
+import queue
+import random
+import logging
+import contextvars
+from datetime import datetime, timezone
+from collections import defaultdict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Optional
+
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+# Identificadores de la petición en curso; se copian a cada registro en el hilo que lo emite
+request_id_var = contextvars.ContextVar('request_id', default=None)
+conversation_id_var = contextvars.ContextVar('conversation_id', default=None)
+
+# Atributos propios de LogRecord: el resto son campos añadidos con `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+_handlers = []
+# Nombre del proceso en el nombre de su fichero de log (ver `log_process_name`)
+_process_name = None
+
+
+def log_process_name() -> str:
+    """
+    Nombre estable del proceso para su fichero de log
+
+    El asignado con `set_log_process` (workers de serve_workers, shards) o, si
+    no, el comando de manage.py (`runserver`, `test`, `batch_qa`...) o el
+    programa (`daphne`). No depende del pid: un proceso reiniciado sigue en el
+    mismo fichero y la rotación limita lo que ocupa.
+    """
+    if _process_name:
+        return _process_name
+    argv = sys.argv or ['']
+    program = os.path.splitext(os.path.basename(argv[0]))[0]
+    if program == '__main__':
+        # python -m daphne
+        program = os.path.basename(os.path.dirname(argv[0]))
+    if program in ('manage', 'django-admin') and len(argv) > 1:
+        if argv[1] == 'runserver' and os.environ.get('RUN_MAIN') != 'true' and '--noreload' not in argv:
+            # Proceso del autorecargador: no comparte fichero con el que atiende peticiones
+            return 'runserver-reloader'
+        return argv[1]
+    return program or 'python'
+
+
+def set_log_process(name: str):
+    """Cambia el nombre del proceso en los ficheros de log (p. ej. `worker-0` tras el fork)"""
+    global _process_name
+    _process_name = name
+    for handler in _handlers:
+        handler.reopen()
+
+
+def prune_worker_logs(workers: int):
+    """Borra los ficheros de log de workers con índice >= `workers` (de arranques con más workers)"""
+    for handler in _handlers:
+        pattern = re.compile(
+            re.escape(handler.filename).replace(re.escape('{process}'), r'worker-(\d+)') + r'(\.\d+)?$'
+        )
+        for path in glob.glob(handler.filename.format(process='worker-*') + '*'):
+            match = pattern.match(path)
+            if match and int(match.group(1)) >= workers:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    logging.getLogger(__name__).warning(f"No se pudo borrar el log {path}: {str(e)}")
+
+
+def bind_log_context(request_id: Optional[str] = None, conversation_id: Optional[str] = None):
+    """Asocia los ids a los registros que se emitan desde el contexto actual (petición, mensaje WebSocket)"""
+    if request_id is not None:
+        request_id_var.set(str(request_id))
+    if conversation_id is not None:
+        conversation_id_var.set(str(conversation_id))
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+@sync_and_async_middleware
+def request_context_middleware(get_response):
+    """Asigna un id a cada petición HTTP (o respeta X-Request-ID) y lo devuelve en la respuesta"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            # Cada petición ASGI se atiende en su propia tarea: el contexto no se comparte con otras,
+            # y se conserva mientras se envía una respuesta en streaming
+            request_id = request.headers.get('X-Request-ID') or new_request_id()
+            request_id_var.set(request_id)
+            conversation_id_var.set(None)
+            response = await get_response(request)
+            response['X-Request-ID'] = request_id
+            return response
+    else:
+        def middleware(request):
+            # Los hilos WSGI se reutilizan entre peticiones: se restaura el contexto al terminar
+            request_id = request.headers.get('X-Request-ID') or new_request_id()
+            request_token = request_id_var.set(request_id)
+            conversation_token = conversation_id_var.set(None)
+            try:
+                response = get_response(request)
+            finally:
+                request_id_var.reset(request_token)
+                conversation_id_var.reset(conversation_token)
+            response['X-Request-ID'] = request_id
+            return response
+    return middleware
+
+
+class JsonFormatter(logging.Formatter):
+    """Un objeto JSON por línea con nivel, logger, ids de petición y conversación y los campos de `extra`"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'module': record.module,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'conversation_id': getattr(record, 'conversation_id', None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key not in entry:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SizeAndAgeRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler que además rota cuando el fichero activo supera `max_age` segundos"""
+
+    def __init__(self, filename, max_bytes: int = 0, backup_count: int = 0, max_age: float = 0, encoding='utf-8'):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding, delay=True)
+        self.max_age = max_age
+        self._opened_at = self._initial_age()
+
+    def _initial_age(self) -> float:
+        # Tras un reinicio se sigue contando desde la última escritura del fichero existente
+        try:
+            return os.path.getmtime(self.baseFilename) if os.path.getsize(self.baseFilename) else time.time()
+        except OSError:
+            return time.time()
+
+    def shouldRollover(self, record) -> bool:
+        if self.max_age and time.time() - self._opened_at >= self.max_age and os.path.exists(self.baseFilename):
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self._opened_at = time.time()
+
+
+class _BlockingSentinelListener(QueueListener):
+    def enqueue_sentinel(self):
+        # Con la cola llena se espera a que el hilo escritor haga sitio en vez de fallar al parar
+        self.queue.put(self._sentinel)
+
+
+class AsyncLogHandler(QueueHandler):
+    """
+    Handler para `LOGGING` que no escribe en el hilo que registra.
+
+    En el hilo de la petición (o del event loop) solo se aplica el muestreo, se
+    copian los ids de petición y conversación y se encola el registro; un
+    QueueListener en segundo plano lo escribe en consola (con el `formatter` del
+    handler en `LOGGING`) y en un fichero JSON rotado por tamaño y antigüedad.
+    Con la cola llena el registro se descarta y se cuenta, en vez de bloquear.
+
+    Cada proceso escribe y rota su propio fichero: `{process}` en `filename` se
+    sustituye por `log_process_name()` (`runserver`, `worker-0`, `shard-1`...).
+    Si varios procesos rotaran el mismo fichero, uno renombraría el fichero que
+    otro sigue escribiendo y se perderían registros. El nombre es estable entre
+    reinicios, así que el número de ficheros no crece con cada arranque.
+
+    `sampling` indica, por prefijo de logger, la fracción de registros por
+    debajo de WARNING emitidos durante una petición que se conserva (p. ej.
+    {'chatbot.queries': 0.1}); los avisos, los errores y los
+    registros de arranque se escriben siempre.
+    """
+
+    def __init__(self, filename: str = 'logs/chatbot.{process}.log', max_bytes: int = 0, backup_count: int = 5,
+                 max_age_hours: float = 0, queue_size: int = 10000, sampling: Dict[str, float] = None,
+                 console: bool = True):
+        self.filename = os.path.abspath(str(filename))
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        # Los destinos se crean antes que la cola: logging.shutdown cierra los handlers en orden
+        # inverso, así que la cola se vacía antes de cerrar el fichero
+        self.file_handler = SizeAndAgeRotatingFileHandler(
+            self._log_path(), max_bytes=max_bytes, backup_count=backup_count, max_age=max_age_hours * 3600
+        )
+        self.file_handler.setFormatter(JsonFormatter())
+        self.targets = [self.file_handler]
+        self.console = None
+        if console:
+            self.console = logging.StreamHandler()
+            self.targets.append(self.console)
+
+        super().__init__(queue.Queue(queue_size))
+        # Reglas más específicas primero
+        self.sampling = sorted((sampling or {}).items(), key=lambda rule: len(rule[0]), reverse=True)
+        self.stats = defaultdict(int)
+        self.listener = None
+        self._start_listener()
+        if hasattr(os, 'register_at_fork'):
+            # El hilo escritor no sobrevive a fork() (workers de serve_workers): cada hijo arranca el suyo
+            os.register_at_fork(after_in_child=self._restart_after_fork)
+        _handlers.append(self)
+
+    def _log_path(self) -> str:
+        return self.filename.format(process=log_process_name())
+
+    def reopen(self):
+        """Pasa a escribir en el fichero del nombre de proceso actual a partir del siguiente registro"""
+        with self.file_handler.lock:
+            if self.file_handler.stream is not None:
+                self.file_handler.stream.close()
+                self.file_handler.stream = None
+            self.file_handler.baseFilename = self._log_path()
+            self.file_handler._opened_at = self.file_handler._initial_age()
+
+    def setFormatter(self, fmt):
+        # `formatter` del handler en LOGGING: se aplica a la consola; el fichero siempre es JSON
+        super().setFormatter(fmt)
+        if self.console is not None:
+            self.console.setFormatter(fmt)
+
+    def _start_listener(self):
+        self.listener = _BlockingSentinelListener(self.queue, *self.targets, respect_handler_level=True)
+        self.listener.start()
+
+    def _restart_after_fork(self):
+        if self.listener is None:
+            return
+        # El buffer heredado puede estar a medio escribir por el hilo del padre: no se cierra (lo
+        # haría volcarse aquí); el hijo abre un fichero al escribir, y el suyo tras `set_log_process`
+        self.file_handler.stream = None
+        self.reopen()
+        self.queue = queue.Queue(self.queue.maxsize)
+        self.stats = defaultdict(int)
+        self._start_listener()
+
+    def _sample_rate(self, name: str) -> float:
+        for prefix, rate in self.sampling:
+            if name == prefix or name.startswith(prefix + '.'):
+                return rate
+        return 1.0
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING and self.sampling and request_id_var.get() is not None:
+            rate = self._sample_rate(record.name)
+            if rate < 1.0 and random.random() >= rate:
+                self.stats['sampled_out'] += 1
+                return False
+        return super().filter(record)
+
+    def prepare(self, record):
+        # Se resuelve aquí lo que depende del hilo emisor (ids de contexto, argumentos, traza de la excepción)
+        record.request_id = request_id_var.get()
+        record.conversation_id = conversation_id_var.get()
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = logging.makeLogRecord(vars(record))
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.stats['queued'] += 1
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def close(self):
+        if self.listener is not None:
+            # Escribe lo que quede en la cola antes de terminar
+            self.listener.stop()
+            self.listener = None
+        if self in _handlers:
+            _handlers.remove(self)
+        super().close()
+
+    def metrics(self) -> Dict[str, int]:
+        return {**self.stats, 'pending': self.queue.qsize(), 'queue_size': self.queue.maxsize}
+
+
+def pipeline_metrics() -> Dict[str, int]:
+    """Contadores agregados de los AsyncLogHandler configurados en este proceso"""
+    totals = defaultdict(int)
+    for handler in _handlers:
+        for key, value in handler.metrics().items():
+            totals[key] += value
+    return dict(totals)
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from chatbot.services.retention import RetentionService
+
+
+class Command(BaseCommand):
+    help = "Archiva las conversaciones inactivas en ficheros mensuales comprimidos y compacta la base de datos"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help="Días de inactividad (por defecto CHATBOT_RETENTION_DAYS)")
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--dry-run', action='store_true', help="Solo cuenta las conversaciones a archivar")
+        parser.add_argument('--no-compact', action='store_true', help="No ejecutar VACUUM tras archivar")
+        parser.add_argument('--periodic', action='store_true',
+                            help="Repetir cada CHATBOT_RETENTION_INTERVAL_HOURS horas (un solo proceso, p. ej. un servicio aparte)")
+
+    def handle(self, *args, **options):
+        service = RetentionService()
+        if options['periodic']:
+            self.stdout.write("Retención periódica iniciada")
+            service.run_periodic()
+            return
+        archived = service.archive_idle(
+            days=options['days'],
+            batch_size=options['batch_size'],
+            dry_run=options['dry_run']
+        )
+
+        if options['dry_run']:
+            self.stdout.write(f"Conversaciones a archivar: {archived}")
+            return
+
+        self.stdout.write(self.style.SUCCESS(f"Conversaciones archivadas: {archived}"))
+        if archived and not options['no_compact']:
+            service.compact()
+            self.stdout.write("Base de datos compactada")
@@ -0,0 +1,44 @@
+import asyncio
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.batch_qa import BatchQAService
+
+
+class Command(BaseCommand):
+    help = (
+        "Responde un JSONL de preguntas ({\"id\", \"question\", \"filters\"}) con recuperación por lotes y "
+        "generación acotada; escribe una línea por respuesta y se reanuda si se vuelve a lanzar"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="JSONL de preguntas")
+        parser.add_argument('output', help="JSONL de resultados (se completan las preguntas que falten)")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Preguntas por paso de recuperación (CHATBOT_BATCH_SIZE por defecto)")
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help="Generaciones simultáneas (CHATBOT_BATCH_CONCURRENCY por defecto)")
+        parser.add_argument('--top-k', type=int, default=5)
+
+    def handle(self, *args, **options):
+        def progress(result):
+            timings = result['timings']
+            if result['error']:
+                self.stderr.write(f"[{result['id']}] {result['error']}")
+            else:
+                self.stdout.write(f"[{result['id']}] recuperación {timings['retrieval_ms']:.0f} ms, "
+                                  f"generación {timings['generation_ms']:.0f} ms")
+
+        try:
+            summary = asyncio.run(BatchQAService.get_instance().run(
+                options['input'], options['output'], batch_size=options['batch_size'],
+                concurrency=options['concurrency'], top_k=options['top_k'], progress=progress
+            ))
+        except (OSError, ValueError, RuntimeError) as e:
+            raise CommandError(str(e))
+        except KeyboardInterrupt:
+            raise CommandError(f"Interrumpido: vuelve a ejecutar el comando para reanudar {options['output']}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{summary['answered']} respuestas, {summary['errors']} errores y {summary['skipped']} ya "
+            f"respondidas de {summary['total']} en {summary['duration_s']}s"
+        ))
@@ -0,0 +1,74 @@
+import gc
+import sys
+import json
+import subprocess
+import tracemalloc
+from django.core.management.base import BaseCommand, CommandError
+from langchain.schema import Document
+
+from chatbot.services.chat_service import ChatService
+from chatbot.services.chunk_store import ChunkStore
+from chatbot.services.document_loader import DocumentLoader
+from chatbot.management.commands.bench_inference import _rss_mb
+
+MODES = ('documents', 'store')
+
+
+class Command(BaseCommand):
+    help = "Memoria del corpus como lista de Document frente al ChunkStore compacto (RSS y tracemalloc)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', type=int, default=20, help="Factor de réplica del corpus de data/")
+        parser.add_argument('--mode', choices=MODES, help=(
+            "Mide solo una representación en este proceso (uso interno: cada una se mide en un "
+            "proceso nuevo para que el RSS no arrastre memoria de la otra)"
+        ))
+
+    def _corpus(self, scale):
+        pdf_files = ChatService._validate_pdf_files(ChatService._get_pdf_files_from_data_folder())
+        if not pdf_files:
+            raise CommandError("No hay archivos PDF en data/")
+        # Sin deduplicar: las copias deben ocupar memoria como un corpus mayor
+        base = DocumentLoader(pdf_files, deduplicate=False).load_documents()
+        # Generador: el texto de cada copia se crea dentro de la medición
+        return ((f"{doc.page_content} [copia {copy}]", doc.metadata) for copy in range(scale) for doc in base)
+
+    def _measure(self, mode, scale):
+        entries = self._corpus(scale)
+        gc.collect()
+        rss_before = _rss_mb()
+        tracemalloc.start()
+        if mode == 'documents':
+            # Representación anterior: Document por chunk, metadatos propios y el índice texto -> id
+            corpus = [Document(page_content=text, metadata=dict(metadata)) for text, metadata in entries]
+            by_content = {doc.page_content: idx for idx, doc in enumerate(corpus)}
+        else:
+            corpus = ChunkStore.from_entries(entries)
+        gc.collect()
+        traced, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {'chunks': len(corpus), 'traced_mb': traced / 2**20, 'rss_mb': _rss_mb() - rss_before}
+
+    def handle(self, *args, **options):
+        if options['mode']:
+            self.stdout.write(json.dumps(self._measure(options['mode'], options['scale'])))
+            return
+
+        results = {}
+        for mode in MODES:
+            completed = subprocess.run(
+                [sys.executable, sys.argv[0], 'bench_chunk_store', '--mode', mode, '--scale', str(options['scale'])],
+                capture_output=True, text=True
+            )
+            if completed.returncode != 0:
+                raise CommandError(f"Falló la medición de {mode}: {completed.stderr.strip()}")
+            results[mode] = json.loads(completed.stdout.strip().splitlines()[-1])
+
+        self.stdout.write(f"{'representación':<16} {'chunks':>8} {'asignado MB':>12} {'RSS MB':>8}")
+        for mode, result in results.items():
+            self.stdout.write(
+                f"{mode:<16} {result['chunks']:>8} {result['traced_mb']:>12.1f} {result['rss_mb']:>8.1f}"
+            )
+        before, after = results['documents']['traced_mb'], results['store']['traced_mb']
+        self.stdout.write(f"Reducción de memoria asignada: {100 * (1 - after / (before or 1)):.1f}%")
+        self.stdout.write("Chroma ya no guarda el texto de los chunks: su copia desaparece además de la medida aquí")
@@ -0,0 +1,72 @@
+import time
+import asyncio
+from django.core.management.base import BaseCommand
+from asgiref.sync import ThreadSensitiveContext
+
+from chatbot import repository
+from chatbot.models import Conversation, Message
+
+
+class Command(BaseCommand):
+    help = "Mide el rendimiento de lectura del repositorio con distintos niveles de concurrencia"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversations', type=int, default=50)
+        parser.add_argument('--messages', type=int, default=20, help="Mensajes por conversación")
+        parser.add_argument('--duration', type=float, default=3.0, help="Segundos por nivel de concurrencia")
+        parser.add_argument('--levels', type=str, default="1,2,4,8,16")
+
+    def handle(self, *args, **options):
+        session_id = 'bench-db'
+        conversation_ids = self._seed(session_id, options['conversations'], options['messages'])
+        levels = [int(level) for level in options['levels'].split(',')]
+
+        try:
+            self.stdout.write(f"{'workers':>10} {'compartido ops/s':>18} {'por worker ops/s':>20}")
+            for level in levels:
+                shared = asyncio.run(self._run(conversation_ids, level, options['duration'], isolated=False))
+                isolated = asyncio.run(self._run(conversation_ids, level, options['duration'], isolated=True))
+                self.stdout.write(f"{level:>10} {shared:>18.1f} {isolated:>20.1f}")
+        finally:
+            Conversation.objects.filter(session_id=session_id).delete()
+
+    def _seed(self, session_id, conversations, messages):
+        created = Conversation.objects.bulk_create(
+            [Conversation(session_id=session_id) for _ in range(conversations)]
+        )
+        Message.objects.bulk_create([
+            Message(conversation=conv, role='user' if i % 2 == 0 else 'assistant', content=f"mensaje {i} " * 20)
+            for conv in created for i in range(messages)
+        ])
+        return [conv.id for conv in created]
+
+    async def _worker(self, conversation_ids, deadline, isolated):
+        if isolated:
+            # Un hilo y una conexión propios durante todo el worker: se mide la consulta,
+            # no el establecimiento de la conexión
+            async with ThreadSensitiveContext():
+                try:
+                    return await self._loop(conversation_ids, deadline)
+                finally:
+                    await repository.close_connections()
+        return await self._loop(conversation_ids, deadline)
+
+    async def _loop(self, conversation_ids, deadline):
+        operations = 0
+        while time.perf_counter() < deadline:
+            await self._operation(conversation_ids[operations % len(conversation_ids)])
+            operations += 1
+        return operations
+
+    async def _operation(self, conversation_id):
+        await repository.get_chat_history(conversation_id)
+        await repository.count_messages(conversation_id)
+
+    async def _run(self, conversation_ids, concurrency, duration, isolated):
+        start = time.perf_counter()
+        deadline = start + duration
+        results = await asyncio.gather(*[
+            self._worker(conversation_ids[i::concurrency] or conversation_ids, deadline, isolated)
+            for i in range(concurrency)
+        ])
+        return sum(results) / (time.perf_counter() - start)
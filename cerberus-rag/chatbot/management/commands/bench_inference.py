@@ -0,0 +1,95 @@
+import time
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.inference import get_embeddings, get_cross_encoder, BACKEND_TORCH, BACKEND_ONNX
+
+SAMPLE_QUERIES = [
+    "¿Cuáles son los requisitos para la convocatoria de becas?",
+    "¿Cuál es la misión de la Universidad Nacional de Colombia?",
+    "¿Cómo se solicita la cancelación de una asignatura?",
+    "¿Qué dice el reglamento estudiantil sobre el promedio mínimo?",
+]
+
+SAMPLE_PASSAGES = [
+    "La Universidad Nacional de Colombia tiene como misión formar profesionales competentes y socialmente responsables.",
+    "Los estudiantes podrán cancelar asignaturas hasta la octava semana del periodo académico, previa solicitud.",
+    "El promedio aritmético ponderado acumulado no podrá ser inferior a tres punto cero (3.0).",
+    "La convocatoria de becas exige matrícula vigente, promedio destacado y certificado de condición socioeconómica.",
+] * 4
+
+
+def _rss_mb() -> float:
+    """RSS actual del proceso en MB (Linux); 0 si no está disponible"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class Command(BaseCommand):
+    help = ("Compara los backends de inferencia (torch y onnx): rendimiento, latencia, RSS y deriva de puntuaciones. "
+            "La paridad se comprueba en los tests (InferenceParityTests)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20)
+
+    def _measure(self, fn, iterations):
+        latencies = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            fn()
+            latencies.append((time.perf_counter() - start) * 1000)
+        latencies = np.asarray(latencies)
+        return np.percentile(latencies, 50), np.percentile(latencies, 95), 1000 / latencies.mean()
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        pairs = [[query, passage] for query in SAMPLE_QUERIES for passage in SAMPLE_PASSAGES[:4]]
+        results = {}
+
+        for backend in (BACKEND_TORCH, BACKEND_ONNX):
+            rss_before = _rss_mb()
+            embeddings = get_embeddings(backend)
+            cross_encoder = get_cross_encoder(backend)
+            rss_loaded = _rss_mb() - rss_before
+
+            embed = self._measure(lambda: embeddings.embed_documents(SAMPLE_PASSAGES), iterations)
+            rerank = self._measure(lambda: cross_encoder.predict(pairs), iterations)
+            results[backend] = {
+                'vectors': np.asarray(embeddings.embed_documents(SAMPLE_PASSAGES)),
+                'scores': np.asarray(cross_encoder.predict(pairs)),
+                'embedding_class': type(embeddings).__name__,
+            }
+
+            self.stdout.write(f"[{backend}] {results[backend]['embedding_class']} / {type(cross_encoder).__name__}")
+            self.stdout.write(f"  RSS tras cargar modelos: +{rss_loaded:.0f} MB")
+            self.stdout.write(
+                f"  embeddings ({len(SAMPLE_PASSAGES)} textos): p50 {embed[0]:.1f} ms, p95 {embed[1]:.1f} ms, "
+                f"{embed[2] * len(SAMPLE_PASSAGES):.0f} textos/s"
+            )
+            self.stdout.write(
+                f"  rerank ({len(pairs)} pares): p50 {rerank[0]:.1f} ms, p95 {rerank[1]:.1f} ms, "
+                f"{rerank[2] * len(pairs):.0f} pares/s"
+            )
+            del embeddings, cross_encoder
+
+        if results[BACKEND_ONNX]['embedding_class'] == results[BACKEND_TORCH]['embedding_class']:
+            raise CommandError("El backend ONNX no está disponible (se usó PyTorch como respaldo)")
+
+        torch_vectors, onnx_vectors = results[BACKEND_TORCH]['vectors'], results[BACKEND_ONNX]['vectors']
+        cosine = (torch_vectors * onnx_vectors).sum(axis=1) / (
+            np.linalg.norm(torch_vectors, axis=1) * np.linalg.norm(onnx_vectors, axis=1)
+        )
+        drift = np.abs(results[BACKEND_TORCH]['scores'] - results[BACKEND_ONNX]['scores'])
+        ranking_match = np.mean([
+            np.argmax(results[BACKEND_TORCH]['scores'][i:i + 4]) == np.argmax(results[BACKEND_ONNX]['scores'][i:i + 4])
+            for i in range(0, len(pairs), 4)
+        ])
+
+        self.stdout.write(f"Paridad: coseno mínimo {cosine.min():.4f}, deriva máxima {drift.max():.4f}, "
+                          f"top-1 coincidente {ranking_match:.0%}")
@@ -0,0 +1,69 @@
+import time
+import asyncio
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from langchain.schema import Document
+
+from chatbot.services.chat_service import ChatService
+from chatbot.services.document_loader import DocumentLoader
+from chatbot.services.retrieval import RetrievalService
+from chatbot.management.commands.bench_inference import SAMPLE_QUERIES, _rss_mb
+
+
+class Command(BaseCommand):
+    help = "Latencia de la recuperación local frente a la distribuida en shards a medida que crece el corpus"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--shards', default='1,2,4',
+                            help="Números de shards a comparar, separados por comas (1 = en proceso)")
+        parser.add_argument('--scales', default='1,2,4',
+                            help="Factores de réplica del corpus de data/, separados por comas")
+        parser.add_argument('--iterations', type=int, default=10)
+
+    def _replicate(self, documents, factor):
+        # Cada copia se marca para que no sea un duplicado exacto del original
+        return [
+            Document(page_content=f"{doc.page_content} [copia {copy}]", metadata=dict(doc.metadata))
+            for copy in range(factor) for doc in documents
+        ]
+
+    async def _measure(self, service, iterations):
+        latencies = []
+        for _ in range(iterations):
+            for query in SAMPLE_QUERIES:
+                start = time.perf_counter()
+                await service.get_relevant_documents(query, [])
+                latencies.append((time.perf_counter() - start) * 1000)
+        latencies = np.asarray(latencies)
+        return np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+    def handle(self, *args, **options):
+        pdf_files = ChatService._validate_pdf_files(ChatService._get_pdf_files_from_data_folder())
+        if not pdf_files:
+            raise CommandError("No hay archivos PDF en data/")
+        base_documents = DocumentLoader(pdf_files).load_documents()
+        shard_counts = [int(value) for value in options['shards'].split(',')]
+        scales = [int(value) for value in options['scales'].split(',')]
+
+        self.stdout.write(f"{'chunks':>8} {'shards':>6} {'build s':>8} {'p50 ms':>8} {'p95 ms':>8} {'RSS MB':>8}")
+        for scale in scales:
+            for num_shards in shard_counts:
+                documents = self._replicate(base_documents, scale)
+                rss_before = _rss_mb()
+                service = RetrievalService(documents)
+                service.num_shards = num_shards
+                start = time.perf_counter()
+                if not service.initialize():
+                    raise CommandError(f"No se pudo inicializar la recuperación con {num_shards} shards")
+                build = time.perf_counter() - start
+
+                p50, p95 = asyncio.run(self._measure(service, options['iterations']))
+                self.stdout.write(
+                    f"{len(documents):>8} {num_shards:>6} {build:>8.1f} {p50:>8.1f} {p95:>8.1f} "
+                    f"{_rss_mb() - rss_before:>8.0f}"
+                )
+                if service.shards is not None:
+                    service.shards.close()
+                service.executor.shutdown()
+                service.batch_executor.shutdown()
+        self.stdout.write("RSS: incremento en el proceso coordinador; cada shard usa su propio proceso")
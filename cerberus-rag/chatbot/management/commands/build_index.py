@@ -0,0 +1,72 @@
+import os
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.chat_service import ChatService
+from chatbot.services.document_loader import DocumentLoader
+from chatbot.services.retrieval import RetrievalService
+from chatbot.services.index_snapshot import IndexSnapshot, index_config, ingestion_dates, source_fingerprint, write_snapshot
+
+
+class Command(BaseCommand):
+    help = "Ingesta e indexa los PDF de data/ fuera de línea y escribe un snapshot versionado cargable con mmap"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=None, help="Directorio de snapshots (CHATBOT_INDEX_DIR por defecto)")
+        parser.add_argument('--keep', type=int, default=3, help="Versiones que se conservan, incluida la nueva")
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help="Por defecto CHATBOT_CHUNK_SIZE; con otro valor el servicio no cargará el snapshot")
+        parser.add_argument('--chunk-overlap', type=int, default=None, help="Por defecto CHATBOT_CHUNK_OVERLAP")
+
+    def handle(self, *args, **options):
+        root = str(options['output'] or getattr(settings, 'CHATBOT_INDEX_DIR', settings.BASE_DIR / 'index'))
+        pdf_files = ChatService._validate_pdf_files(ChatService._get_pdf_files_from_data_folder())
+        if not pdf_files:
+            raise CommandError("No hay archivos PDF en data/")
+
+        start = time.perf_counter()
+        loader = DocumentLoader(pdf_files, chunk_size=options['chunk_size'], chunk_overlap=options['chunk_overlap'],
+                                ingested_at=ingestion_dates(root, pdf_files))
+        documents = loader.load_documents()
+        if not documents:
+            raise CommandError("No se pudieron cargar documentos")
+        ingest = time.perf_counter() - start
+        self.stdout.write(f"Ingesta: {len(pdf_files)} PDF, {len(documents)} fragmentos en {ingest:.1f}s")
+
+        start = time.perf_counter()
+        service = RetrievalService(documents)
+        del documents
+        # Índices en este proceso: el snapshot guarda el corpus completo aunque se sirva con shards
+        service._init_indexes()
+        indexing = time.perf_counter() - start
+        self.stdout.write(f"Indexado (embeddings, postings, TF-IDF) en {indexing:.1f}s")
+
+        config = index_config(
+            chunk_size=loader.chunk_size, chunk_overlap=loader.chunk_overlap,
+            deduplicate=loader.deduplicate, dedup_threshold=loader.dedup_threshold
+        )
+        manifest = {
+            'sources': source_fingerprint(pdf_files),
+            **config,
+            'dedup_report': loader.dedup_report,
+            'ingested': loader.ingested_at,
+        }
+        path = write_snapshot(service, root, service.chunk_embeddings(), manifest, keep=options['keep'])
+        if config != index_config():
+            self.stdout.write(self.style.WARNING(
+                "El snapshot no usa la configuración actual (CHATBOT_CHUNK_*): el servicio no lo cargará"
+            ))
+
+        # Comprobación: el snapshot recién escrito se carga y mide
+        start = time.perf_counter()
+        snapshot = IndexSnapshot(path)
+        load_ms = (time.perf_counter() - start) * 1000
+        if len(snapshot.chunks) != len(service.chunks):
+            raise CommandError("El snapshot escrito no contiene todos los fragmentos")
+
+        size_mb = sum(entry.stat().st_size for entry in os.scandir(path)) / 2**20
+        self.stdout.write(self.style.SUCCESS(
+            f"Snapshot {snapshot.manifest['version']} en {path}: {size_mb:.1f} MB, "
+            f"se carga en {load_ms:.0f} ms"
+        ))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count
+
+from chatbot.models import Message, Feedback
+
+
+class Command(BaseCommand):
+    help = "Tasa de omisión del rerank en cascada y calificación media de las respuestas por modo"
+
+    def handle(self, *args, **options):
+        answers = (
+            Message.objects.filter(role='assistant')
+            .values('metadata__rerank')
+            .annotate(total=Count('id'))
+        )
+        ratings = {
+            row['message__metadata__rerank']: row
+            for row in Feedback.objects.filter(message__role='assistant')
+            .values('message__metadata__rerank')
+            .annotate(avg_rating=Avg('rating'), ratings=Count('id'))
+        }
+
+        total = sum(row['total'] for row in answers if row['metadata__rerank'])
+        self.stdout.write(f"{'modo':<10} {'respuestas':>10} {'%':>7} {'feedback':>9} {'media':>6}")
+        for row in sorted(answers, key=lambda row: row['total'], reverse=True):
+            mode = row['metadata__rerank']
+            if not mode:
+                continue
+            rated = ratings.get(mode, {})
+            average = f"{rated['avg_rating']:.2f}" if rated.get('avg_rating') is not None else "-"
+            self.stdout.write(
+                f"{mode:<10} {row['total']:>10} {100 * row['total'] / total:>6.1f}% "
+                f"{rated.get('ratings', 0):>9} {average:>6}"
+            )
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.chat_service import ChatService
+from chatbot.services.document_loader import DocumentLoader
+
+
+class Command(BaseCommand):
+    help = "Carga los PDF de data/ con y sin deduplicación y muestra cuánto se reduce el índice"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threshold', type=float, default=None,
+                            help="Jaccard mínimo para casi duplicados (por defecto CHATBOT_DEDUP_THRESHOLD)")
+
+    def handle(self, *args, **options):
+        pdf_files = ChatService._validate_pdf_files(ChatService._get_pdf_files_from_data_folder())
+        if not pdf_files:
+            raise CommandError("No hay archivos PDF en data/")
+
+        loader = DocumentLoader(pdf_files, deduplicate=True, dedup_threshold=options['threshold'])
+        loader.load_documents()
+        report = loader.dedup_report
+        if report is None:
+            raise CommandError("Los PDF de data/ no contienen texto extraíble")
+
+        self.stdout.write(f"Fragmentos:          {report['chunks_before']} -> {report['chunks_after']} "
+                          f"(-{100 * report['reduction']:.1f}%)")
+        self.stdout.write(f"Duplicados exactos:  {report['exact_duplicates']}")
+        self.stdout.write(f"Casi duplicados:     {report['near_duplicates']}")
+        self.stdout.write(f"Caracteres:          {report['chars_before']} -> {report['chars_after']}")
+        self.stdout.write(f"Cabeceras/pies:      {report['boilerplate_lines']} líneas eliminadas")
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.services.feedback_journal import FeedbackJournal
+
+
+class Command(BaseCommand):
+    help = "Exporta el diario de feedback a formato columnar (Parquet o NPZ comprimido)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', type=str, help="Ruta del fichero de salida")
+        parser.add_argument('--format', choices=['parquet', 'npz'], default='npz')
+        parser.add_argument('--rotate', action='store_true',
+                            help="Comprimir antes de exportar los ficheros activos de procesos que ya terminaron")
+
+    def handle(self, *args, **options):
+        journal = FeedbackJournal.get_instance()
+        if options['rotate']:
+            self.stdout.write(f"Ficheros activos comprimidos: {journal.rotate_stale()}")
+
+        try:
+            exported = journal.export(options['output'], fmt=options['format'])
+        except ImportError as e:
+            raise CommandError(f"Dependencia no disponible para el formato {options['format']}: {str(e)}")
+
+        self.stdout.write(self.style.SUCCESS(f"Eventos exportados: {exported} -> {options['output']}"))
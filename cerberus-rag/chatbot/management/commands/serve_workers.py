@@ -0,0 +1,101 @@
+import gc
+import os
+import signal
+import socket
+import asyncio
+import logging
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.log_pipeline import prune_worker_logs, set_log_process
+from chatbot.services.chat_service import ChatService
+
+logger = logging.getLogger(__name__)
+
+
+def _run_worker(fd: int, worker_id: int):
+    """Proceso hijo: termina la inicialización (modelos, LLM, hilos) y sirve con Daphne sobre el socket heredado"""
+    # Cada worker escribe y rota su propio fichero de log, con un nombre estable entre reinicios
+    set_log_process(f"worker-{worker_id}")
+    # Daphne instala el reactor de Twisted al importarse: solo después del fork
+    from daphne.server import Server
+    from cerberus_chatbot.asgi import application
+
+    if not asyncio.run(ChatService.get_instance().initialize()):
+        logger.error(f"Worker {worker_id}: no se pudo inicializar el servicio de chat")
+        os._exit(1)
+    logger.info(f"Worker {worker_id} (pid {os.getpid()}) atendiendo peticiones")
+    Server(application=application, endpoints=[f"fd:fileno={fd}"]).run()
+    os._exit(0)
+
+
+class Command(BaseCommand):
+    help = (
+        "Precarga el snapshot del índice en un proceso y hace fork de N workers Daphne "
+        "que comparten esas páginas de memoria y el mismo socket de escucha"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 2)
+        parser.add_argument('--bind', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8000)
+
+    def handle(self, *args, **options):
+        if getattr(settings, 'CHATBOT_RETRIEVAL_SHARDS', 1) > 1:
+            # Cada worker tendría que arrancar sus propios procesos shard y reconstruir sus
+            # particiones; los de un padre no se pueden compartir tras el fork
+            raise CommandError("serve_workers no admite CHATBOT_RETRIEVAL_SHARDS > 1: usa un solo proceso "
+                               "(runserver/daphne) con shards o varios workers sin ellos")
+
+        chat_service = ChatService.get_instance()
+        # Precarga sin modelos, hilos ni procesos: el snapshot y los índices en memoria se
+        # comparten entre todos los workers; cada worker carga los modelos después del fork
+        # (las sesiones de ONNX Runtime crean su pool de hilos al construirse)
+        if not chat_service.preload(load_models=False):
+            raise CommandError("No se pudieron cargar el corpus y los índices")
+        if chat_service.retrieval_service.snapshot is None:
+            # Indexar aquí ejecutaría inferencia en el padre, y los pools de hilos de
+            # PyTorch/ONNX no sobreviven de forma segura a un fork
+            raise CommandError("serve_workers necesita un snapshot del índice: ejecuta `manage.py build_index`")
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((options['bind'], options['port']))
+        listener.listen(1024)
+        listener.set_inheritable(True)
+
+        # Logs de workers de un arranque anterior con más workers
+        prune_worker_logs(options['workers'])
+
+        # Los objetos ya creados salen del GC: recorrerlos tocaría sus páginas y forzaría copias
+        gc.collect()
+        gc.freeze()
+
+        children = {}
+        for worker_id in range(options['workers']):
+            pid = os.fork()
+            if pid == 0:
+                _run_worker(listener.fileno(), worker_id)
+            children[pid] = worker_id
+        listener.close()
+        self.stdout.write(f"{len(children)} workers en http://{options['bind']}:{options['port']} "
+                          f"(pids {', '.join(str(pid) for pid in children)})")
+
+        def forward(signum, frame):
+            for pid in list(children):
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGINT, forward)
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            worker_id = children.pop(pid, None)
+            if worker_id is not None and os.waitstatus_to_exitcode(status) != 0:
+                logger.warning(f"Worker {worker_id} (pid {pid}) terminó con código "
+                               f"{os.waitstatus_to_exitcode(status)}")
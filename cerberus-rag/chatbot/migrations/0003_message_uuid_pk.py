@@ -0,0 +1,79 @@
+# Generated by Django 5.1.7 on 2026-10-19 10:00
+
+import django.utils.timezone
+import uuid
+from django.db import migrations, models
+
+
+def convert_integer_ids(apps, schema_editor):
+    """
+    SQLite copia los ids enteros tal cual al reconstruir la tabla; se convierten
+    al formato hexadecimal de UUIDField (equivalente a uuid.UUID(int=id)) tanto
+    en los mensajes como en las referencias de feedback.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "UPDATE chatbot_message SET id = printf('%032x', CAST(id AS INTEGER)) WHERE length(id) < 32"
+    )
+    schema_editor.execute(
+        "UPDATE chatbot_feedback SET message_id = printf('%032x', CAST(message_id AS INTEGER)) "
+        "WHERE length(message_id) < 32"
+    )
+
+
+# PostgreSQL no tiene cast de bigint a uuid (el AlterField genera `USING id::uuid`):
+# se convierten los ids con la misma equivalencia uuid.UUID(int=id) que en SQLite
+POSTGRESQL_CONVERSION = [
+    """
+    DO $$
+    DECLARE fk_name text;
+    BEGIN
+        FOR fk_name IN
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = 'chatbot_feedback'::regclass
+              AND confrelid = 'chatbot_message'::regclass
+              AND contype = 'f'
+        LOOP
+            EXECUTE 'ALTER TABLE chatbot_feedback DROP CONSTRAINT ' || quote_ident(fk_name);
+        END LOOP;
+    END $$
+    """,
+    "ALTER TABLE chatbot_message ALTER COLUMN id DROP IDENTITY IF EXISTS",
+    "ALTER TABLE chatbot_message ALTER COLUMN id DROP DEFAULT",
+    "ALTER TABLE chatbot_message ALTER COLUMN id TYPE uuid USING lpad(to_hex(id), 32, '0')::uuid",
+    "ALTER TABLE chatbot_feedback ALTER COLUMN message_id TYPE uuid USING lpad(to_hex(message_id), 32, '0')::uuid",
+    "ALTER TABLE chatbot_feedback ADD CONSTRAINT chatbot_feedback_message_id_fk_chatbot_message_id "
+    "FOREIGN KEY (message_id) REFERENCES chatbot_message (id) DEFERRABLE INITIALLY DEFERRED",
+]
+
+
+class AlterMessageIdToUUID(migrations.AlterField):
+    """AlterField del id de Message, con la conversión propia en PostgreSQL (solo hacia delante)"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        for statement in POSTGRESQL_CONVERSION:
+            schema_editor.execute(statement, params=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0002_alter_conversation_session_id'),
+    ]
+
+    operations = [
+        AlterMessageIdToUUID(
+            model_name='message',
+            name='id',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False),
+        ),
+        migrations.RunPython(convert_integer_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-19 14:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0004_conversation_indexes_archivedconversation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='feedback',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0005_feedback_created_at_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='metadata',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
 
 class Conversation(models.Model):
@@ -14,6 +15,13 @@ class Conversation(models.Model):
 
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            # Listados por dueño, ya ordenados por actividad
+            models.Index(fields=['session_id', '-updated_at'], name='conv_session_updated_idx'),
+            models.Index(fields=['user', '-updated_at'], name='conv_user_updated_idx'),
+            # Búsqueda de conversaciones inactivas para la retención
+            models.Index(fields=['updated_at'], name='conv_updated_idx'),
+        ]
 
 class Message(models.Model):
     ROLE_CHOICES = (
@@ -22,21 +30,52 @@ class Message(models.Model):
         ('system', 'System'),
     )
 
+    # El id se asigna al construir el mensaje para poder emitirlo antes de persistirlo
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
     role = models.CharField(max_length=10, choices=ROLE_CHOICES)
     content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    # Decisiones de recuperación con las que se generó la respuesta (rerank, etc.)
+    metadata = models.JSONField(default=dict, blank=True)
 
     def __str__(self):
         return f"{self.role}: {self.content[:30]}..."
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['conversation', 'created_at'], name='msg_conv_created_idx'),
+        ]
 
 class Feedback(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='feedback')
     rating = models.IntegerField(choices=[(i, i) for i in range(1, 6)])
-    created_at = models.DateTimeField(auto_now_add=True)
+    # default en lugar de auto_now_add para que la restauración del archivo conserve la fecha
+    created_at = models.DateTimeField(default=timezone.now)
 
     def __str__(self):
         return f"Feedback for {self.message} - {self.rating}/5"
+
+class ArchivedConversation(models.Model):
+    """Conversación movida a un fichero de archivo; se restaura al accederla"""
+    id = models.UUIDField(primary_key=True, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    session_id = models.CharField(max_length=100, blank=True, null=True)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    messages_count = models.IntegerField(default=0)
+    archive_month = models.CharField(max_length=7)
+    offset = models.BigIntegerField()
+    length = models.IntegerField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Archived conversation {self.id} ({self.archive_month})"
+
+    class Meta:
+        ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['session_id', '-updated_at'], name='arch_session_updated_idx'),
+            models.Index(fields=['user', '-updated_at'], name='arch_user_updated_idx'),
+        ]
@@ -0,0 +1,144 @@
+"""
+Acceso a datos compartido por las vistas y el consumer.
+
+Todas las consultas usan la API asíncrona nativa del ORM (aget, acreate,
+acount, iteración asíncrona). Esa API delega en hilos "thread sensitive", así
+que quien la invoque debe hacerlo dentro de un `ThreadSensitiveContext`
+(Django lo abre por petición HTTP; el consumer lo abre por mensaje) para que
+cada petición use su propio hilo y conexión en lugar de un único hilo global.
+"""
+from typing import Dict, List, Optional, Tuple
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+from django.db.models import Count, OuterRef, Subquery
+
+from .models import Conversation, Message, Feedback, ArchivedConversation
+from .services.retention import RetentionService
+
+
+def _owner_filter(user=None, session_id=None) -> Dict:
+    """
+    Filtro por dueño: el usuario autenticado o, si no hay, la sesión
+
+    Es obligatorio: sin dueño cualquiera que conozca un id podría leer,
+    continuar o restaurar una conversación ajena. Solo RetentionService
+    restaura sin filtro.
+    """
+    if user is not None:
+        return {'user': user}
+    if not session_id:
+        raise ValueError("Se necesita el usuario o la sesión dueña de la conversación")
+    return {'session_id': session_id}
+
+
+async def restore_archived(conversation_id, user=None, session_id=None) -> bool:
+    """Restaura una conversación archivada; devuelve False si no estaba archivada o es de otro dueño"""
+    owner = _owner_filter(user, session_id)
+    if not await ArchivedConversation.objects.filter(id=conversation_id, **owner).aexists():
+        return False
+    return await sync_to_async(RetentionService().restore)(conversation_id, **owner) is not None
+
+
+async def get_conversation(conversation_id, user=None, session_id=None) -> Conversation:
+    """Lanza `Conversation.DoesNotExist` si no existe o no pertenece al dueño indicado"""
+    filters = {'id': conversation_id, **_owner_filter(user, session_id)}
+    try:
+        return await Conversation.objects.aget(**filters)
+    except ValidationError:
+        raise Conversation.DoesNotExist(f"Identificador inválido: {conversation_id}")
+    except Conversation.DoesNotExist:
+        # Las conversaciones archivadas se restauran al accederlas
+        if not await restore_archived(conversation_id, user, session_id):
+            raise
+        return await Conversation.objects.aget(**filters)
+
+
+async def get_chat_history(conversation_id) -> List[Dict]:
+    history = []
+    async for role, content in Message.objects.filter(
+        conversation_id=conversation_id
+    ).order_by('created_at').values_list('role', 'content'):
+        history.append({'role': role, 'content': content})
+    return history
+
+
+async def load_conversation_with_history(conversation_id, user=None,
+                                         session_id=None) -> Tuple[Optional[Conversation], List[Dict]]:
+    """Conversación del dueño con su historial, o (None, []) si no existe o es de otro dueño"""
+    try:
+        conversation = await get_conversation(conversation_id, user=user, session_id=session_id)
+    except Conversation.DoesNotExist:
+        return None, []
+    return conversation, await get_chat_history(conversation.id)
+
+
+async def list_conversations(user=None, session_id=None) -> List[Dict]:
+    """Conversaciones del dueño (activas y archivadas) con su número de mensajes"""
+    conversations = []
+    queryset = Conversation.objects.filter(
+        **_owner_filter(user, session_id)
+    ).annotate(messages_count=Count('messages'))
+    async for conv in queryset:
+        conversations.append(conv)
+    async for conv in ArchivedConversation.objects.filter(**_owner_filter(user, session_id)):
+        conversations.append(conv)
+
+    conversations.sort(key=lambda conv: conv.updated_at, reverse=True)
+    return [
+        {
+            'id': str(conv.id),
+            'created_at': conv.created_at.isoformat(),
+            'updated_at': conv.updated_at.isoformat(),
+            'messages_count': conv.messages_count
+        }
+        for conv in conversations
+    ]
+
+
+async def count_messages(conversation_id) -> int:
+    return await Message.objects.filter(conversation_id=conversation_id).acount()
+
+
+async def get_conversation_messages(conversation_id, user=None, session_id=None) -> Tuple[Conversation, List[Dict]]:
+    """Mensajes de una conversación con la calificación de su primer feedback"""
+    conversation = await get_conversation(conversation_id, user=user, session_id=session_id)
+    first_rating = Feedback.objects.filter(message=OuterRef('pk')).order_by('pk').values('rating')[:1]
+    queryset = Message.objects.filter(
+        conversation=conversation
+    ).order_by('created_at').annotate(feedback_rating=Subquery(first_rating))
+
+    data = []
+    async for msg in queryset:
+        data.append({
+            'id': str(msg.id),
+            'role': msg.role,
+            'content': msg.content,
+            'created_at': msg.created_at.isoformat(),
+            'feedback': msg.feedback_rating
+        })
+    return conversation, data
+
+
+async def get_assistant_message(message_id) -> Message:
+    """Lanza `Message.DoesNotExist` si no existe un mensaje del asistente con ese id"""
+    try:
+        return await Message.objects.select_related('conversation').aget(id=message_id, role='assistant')
+    except ValidationError:
+        raise Message.DoesNotExist(f"Identificador inválido: {message_id}")
+
+
+async def create_feedback(message: Message, rating: int) -> Feedback:
+    return await Feedback.objects.acreate(message=message, rating=int(rating))
+
+
+async def get_last_user_query(conversation_id) -> str:
+    last_user_message = await Message.objects.filter(
+        conversation_id=conversation_id, role='user'
+    ).order_by('created_at').alast()
+    return last_user_message.content if last_user_message else ""
+
+
+async def close_connections():
+    """Cierra la conexión del hilo del contexto actual al terminar su trabajo"""
+    await sync_to_async(close_old_connections)()
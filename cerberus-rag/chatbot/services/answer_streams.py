@@ -0,0 +1,103 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class AnswerStream:
+    """Tokens de una respuesta en generación, conservados para reenviarlos a un cliente que se reconecta"""
+
+    def __init__(self, message_id: str, conversation_id: str, owner: Optional[str] = None):
+        self.message_id = message_id
+        self.conversation_id = conversation_id
+        # Usuario o sesión que pidió la respuesta: solo ese dueño puede retomarla
+        self.owner = owner
+        self.tokens: List[str] = []
+        # Último evento para el cliente (`message_complete` o `error`); None mientras se genera
+        self.final: Optional[Dict] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def append(self, token: str):
+        self.tokens.append(token)
+        self._notify()
+
+    def finish(self, final: Dict):
+        self.final = final
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def _notify(self):
+        # Un evento nuevo por cambio: los que esperaban despiertan y vuelven a mirar los tokens
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self, offset: int = 0) -> AsyncIterator[Tuple[int, str]]:
+        """(posición, token) desde `offset`: primero los ya generados y después los nuevos, hasta terminar"""
+        while True:
+            while offset < len(self.tokens):
+                yield offset, self.tokens[offset]
+                offset += 1
+            if self.final is not None:
+                return
+            await self._changed.wait()
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.tokens)
+
+
+class AnswerStreamRegistry:
+    """
+    Respuestas en curso y recientes de este proceso, por id de mensaje.
+
+    La generación no depende de la conexión que la pidió: si el cliente se
+    desconecta, sigue escribiendo en su `AnswerStream`, y una conexión nueva la
+    retoma con `resume`. Las terminadas se conservan `ttl` segundos; como mucho
+    se guardan `max_streams` (se descartan primero las terminadas más antiguas).
+    """
+
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, ttl: float = None, max_streams: int = None):
+        self.ttl = ttl if ttl is not None else getattr(settings, 'CHATBOT_STREAM_BUFFER_TTL', 120.0)
+        self.max_streams = max_streams or getattr(settings, 'CHATBOT_STREAM_BUFFER_MAX', 500)
+        self.streams: 'OrderedDict[str, AnswerStream]' = OrderedDict()
+
+    def create(self, message_id: str, conversation_id: str, owner: Optional[str] = None) -> AnswerStream:
+        self._purge()
+        stream = AnswerStream(message_id, conversation_id, owner)
+        self.streams[message_id] = stream
+        if len(self.streams) > self.max_streams:
+            finished = [key for key, candidate in self.streams.items() if candidate.final is not None]
+            for key in finished[:len(self.streams) - self.max_streams]:
+                del self.streams[key]
+        return stream
+
+    def get(self, message_id: str) -> Optional[AnswerStream]:
+        self._purge()
+        return self.streams.get(message_id)
+
+    def _purge(self):
+        now = time.monotonic()
+        expired = [
+            key for key, stream in self.streams.items()
+            if stream.finished_at is not None and now - stream.finished_at > self.ttl
+        ]
+        for key in expired:
+            del self.streams[key]
+
+    def stats(self) -> Dict[str, int]:
+        active = sum(1 for stream in self.streams.values() if stream.final is None)
+        return {'active': active, 'buffered': len(self.streams) - active}
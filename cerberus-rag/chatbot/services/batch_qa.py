@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set
+from django.conf import settings
+
+from .chat_service import ChatService
+from .metadata_index import InvalidFilterError
+
+logger = logging.getLogger(__name__)
+
+
+def read_questions(path: str) -> List[Dict]:
+    """
+    Lee un JSONL de preguntas: `{"question": ..., "id": ..., "filters": {...}}`
+
+    `id` es opcional (por defecto, el número de línea) y `filters` sigue el
+    formato de MetadataIndex. Las líneas vacías se ignoran.
+    """
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Línea {line_number} no es JSON válido: {str(e)}")
+            question = item.get('question') if isinstance(item, dict) else None
+            if not question:
+                raise ValueError(f"Línea {line_number} sin campo 'question'")
+            questions.append({
+                'id': str(item.get('id', line_number)),
+                'question': question,
+                'filters': item.get('filters')
+            })
+    return questions
+
+
+def resume_output(path: str) -> Set[str]:
+    """
+    Deja en el fichero de salida solo las respuestas sin error y devuelve sus ids
+
+    Al reanudar, las preguntas con error se vuelven a intentar: sus líneas
+    anteriores se eliminan para que cada id aparezca una sola vez. También se
+    descartan una última línea truncada (proceso interrumpido a mitad de
+    escritura) y los ids repetidos. El fichero se reescribe de forma atómica.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    kept = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get('error') or str(result['id']) in done:
+                continue
+            done.add(str(result['id']))
+            kept.append(line if line.endswith('\n') else line + '\n')
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.writelines(kept)
+    os.replace(tmp_path, path)
+    return done
+
+
+class BatchQAService:
+    """
+    Responde un fichero de preguntas independientes y escribe una línea JSON por respuesta.
+
+    La recuperación se hace por bloques de `batch_size` preguntas (un paso de
+    embeddings y uno de cross-encoder por bloque) y la generación corre con a lo
+    sumo `concurrency` llamadas al LLM a la vez, solapada con la recuperación del
+    bloque siguiente. Cada resultado se añade al fichero de salida en cuanto
+    termina, así que un lote interrumpido se reanuda saltando los ids ya
+    respondidos y repitiendo los que fallaron.
+    """
+
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        # Lotes lanzados desde la API en este proceso, por ruta de salida
+        self.jobs: Dict[str, Dict] = {}
+
+    async def run(self, input_path: str, output_path: str, batch_size: int = None, concurrency: int = None,
+                  top_k: int = 5, progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+        """
+        Ejecuta un lote completo (o lo que falte de él)
+
+        Args:
+            input_path (str): JSONL de preguntas (ver `read_questions`)
+            output_path (str): JSONL de resultados; se abre en modo append
+            batch_size (int): Preguntas por paso de recuperación
+            concurrency (int): Generaciones simultáneas
+            top_k (int): Chunks por pregunta
+            progress (Callable): Se llama con cada resultado escrito
+
+        Returns:
+            Dict: Resumen con totales, errores y duración
+        """
+        batch_size = batch_size or getattr(settings, 'CHATBOT_BATCH_SIZE', 16)
+        concurrency = concurrency or getattr(settings, 'CHATBOT_BATCH_CONCURRENCY', 2)
+        chat_service = ChatService.get_instance()
+        if not await chat_service.initialize():
+            raise RuntimeError("No se pudo inicializar el servicio de chat")
+
+        questions = read_questions(input_path)
+        done = resume_output(output_path)
+        pending = [item for item in questions if item['id'] not in done]
+        summary = {
+            'input': input_path, 'output': output_path, 'total': len(questions),
+            'skipped': len(questions) - len(pending), 'answered': 0, 'errors': 0,
+            'started_at': datetime.now().isoformat(timespec='seconds'), 'finished_at': None
+        }
+        if done:
+            logger.info(f"Reanudando lote {output_path}: {len(done)} preguntas ya respondidas")
+
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(concurrency)
+        tasks = set()
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, 'a', encoding='utf-8') as output:
+            def write(result: Dict):
+                output.write(json.dumps(result, ensure_ascii=False) + '\n')
+                output.flush()
+                summary['errors' if result['error'] else 'answered'] += 1
+                if progress:
+                    progress(result)
+
+            valid = []
+            for item in pending:
+                try:
+                    chat_service.validate_filters(item['filters'])
+                    valid.append(item)
+                except InvalidFilterError as e:
+                    write(self._result(item, error=f"Filtro no válido: {str(e)}"))
+            pending = valid
+
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                batch_started = time.monotonic()
+                traces = [{} for _ in batch]
+                try:
+                    results = await chat_service.retrieval_service.get_relevant_documents_batch(
+                        [item['question'] for item in batch], top_k=top_k,
+                        filters=[item['filters'] for item in batch], traces=traces
+                    )
+                except Exception as e:
+                    logger.error(f"Error recuperando el bloque {start // batch_size}: {str(e)}")
+                    for item in batch:
+                        write(self._result(item, error=f"Error en la recuperación: {str(e)}"))
+                    continue
+                # Tiempo de recuperación amortizado entre las preguntas del bloque
+                retrieval_ms = (time.monotonic() - batch_started) * 1000 / len(batch)
+
+                for item, documents, trace in zip(batch, results, traces):
+                    tasks.add(asyncio.create_task(self._generate(
+                        chat_service, semaphore, item, documents, trace, batch_started, retrieval_ms, write
+                    )))
+                # No se recupera más de un bloque por delante de la generación
+                while len(tasks) > batch_size + concurrency:
+                    finished, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            if tasks:
+                await asyncio.wait(tasks)
+
+        summary['duration_s'] = round(time.monotonic() - started, 1)
+        summary['finished_at'] = datetime.now().isoformat(timespec='seconds')
+        logger.info(f"Lote {output_path} terminado: {summary['answered']} respuestas, "
+                    f"{summary['errors']} errores, {summary['skipped']} ya respondidas")
+        return summary
+
+    @staticmethod
+    def _result(item: Dict, answer: str = None, sources: List[Dict] = None, timings: Dict = None,
+                error: str = None) -> Dict:
+        return {
+            'id': item['id'],
+            'question': item['question'],
+            'answer': answer,
+            'sources': sources or [],
+            'timings': timings or {},
+            'error': error
+        }
+
+    async def _generate(self, chat_service: ChatService, semaphore: asyncio.Semaphore, item: Dict,
+                        documents: List, trace: Dict, batch_started: float, retrieval_ms: float,
+                        write: Callable[[Dict], None]):
+        async with semaphore:
+            generation_started = time.monotonic()
+            try:
+                answer = await chat_service.answer_from_documents(item['question'], documents)
+                error = None
+            except Exception as e:
+                logger.error(f"Error generando la respuesta {item['id']}: {str(e)}")
+                answer, error = None, f"Error en la generación: {str(e)}"
+            finished = time.monotonic()
+        write(self._result(item, answer, trace.get('sources', []), {
+            'retrieval_ms': round(retrieval_ms, 1),
+            'queue_ms': round((generation_started - batch_started) * 1000 - retrieval_ms, 1),
+            'generation_ms': round((finished - generation_started) * 1000, 1),
+            'total_ms': round((finished - batch_started) * 1000, 1),
+            'rerank': trace.get('rerank')
+        }, error))
+
+    def resolve(self, name: str) -> str:
+        """Ruta dentro de CHATBOT_BATCH_DIR; rechaza rutas que salgan de él"""
+        root = os.path.realpath(str(getattr(settings, 'CHATBOT_BATCH_DIR', settings.BASE_DIR / 'batches')))
+        path = os.path.realpath(os.path.join(root, name))
+        if os.path.commonpath([root, path]) != root:
+            raise ValueError(f"Ruta fuera del directorio de lotes: {name}")
+        return path
+
+    def start(self, input_name: str, output_name: str, **options) -> Dict:
+        """Lanza un lote en segundo plano en el event loop actual (API de administración)"""
+        input_path, output_path = self.resolve(input_name), self.resolve(output_name)
+        if not os.path.isfile(input_path):
+            raise FileNotFoundError(input_name)
+        job = self.jobs.get(output_path)
+        if job and job['state'] == 'running':
+            raise RuntimeError(f"Ya hay un lote escribiendo en {output_name}")
+
+        job = {'input': input_name, 'output': output_name, 'state': 'running', 'written': 0,
+               'errors': 0, 'summary': None, 'error': None}
+
+        def progress(result: Dict):
+            job['written'] += 1
+            job['errors'] += bool(result['error'])
+
+        async def run():
+            try:
+                job['summary'] = await self.run(input_path, output_path, progress=progress, **options)
+                job['state'] = 'finished'
+            except Exception as e:
+                logger.error(f"Lote {output_name} fallido: {str(e)}")
+                job.update({'state': 'failed', 'error': str(e)})
+
+        job['task'] = asyncio.create_task(run())
+        self.jobs[output_path] = job
+        return self.status(job)
+
+    @staticmethod
+    def status(job: Dict) -> Dict:
+        return {key: value for key, value in job.items() if key != 'task'}
@@ -0,0 +1,84 @@
+import json
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+import numpy as np
+from langchain.schema import Document
+
+
+class ChunkStore:
+    """
+    Almacén compacto de los chunks del corpus, referenciados por id entero.
+
+    El texto de todos los chunks vive en un único bloque UTF-8 (`arena`: bytes o
+    el mmap de un snapshot del índice) con un array de offsets en bytes: el
+    chunk i es `arena[offsets[i]:offsets[i + 1]]`.
+    Los metadatos se internan: los chunks de una misma página comparten el mismo
+    dict, y cada chunk guarda solo el índice del suyo (`metadata_ids`).
+
+    Los recuperadores trabajan con ids; el texto solo se decodifica para el
+    cross-encoder y para construir el prompt (`text`, `document`).
+    """
+    __slots__ = ('arena', 'offsets', 'metadata_ids', 'metadata_table')
+
+    def __init__(self, documents: Iterable[Document]):
+        arena = bytearray()
+        offsets = [0]
+        metadata_ids = []
+        self.metadata_table: List[Dict] = []
+        interned: Dict[str, int] = {}
+        for doc in documents:
+            arena += doc.page_content.encode('utf-8')
+            offsets.append(len(arena))
+            metadata = {key: value for key, value in doc.metadata.items() if key != 'chunk_id'}
+            key = json.dumps(metadata, sort_keys=True, default=str)
+            if key not in interned:
+                interned[key] = len(self.metadata_table)
+                self.metadata_table.append(metadata)
+            metadata_ids.append(interned[key])
+
+        self.arena = bytes(arena)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.metadata_ids = np.asarray(metadata_ids, dtype=np.int32)
+
+    @classmethod
+    def from_arrays(cls, arena, offsets: np.ndarray, metadata_ids: np.ndarray,
+                    metadata_table: List[Dict]) -> 'ChunkStore':
+        """Almacén sobre datos ya compactados; `arena` puede ser un mmap de solo lectura"""
+        store = cls.__new__(cls)
+        store.arena = arena
+        store.offsets = offsets
+        store.metadata_ids = metadata_ids
+        store.metadata_table = metadata_table
+        return store
+
+    @classmethod
+    def from_entries(cls, entries: Iterable[Tuple[str, Dict]]) -> 'ChunkStore':
+        """Construye el almacén a partir de pares (texto, metadatos)"""
+        return cls(Document(page_content=text, metadata=metadata) for text, metadata in entries)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def text(self, idx: int) -> str:
+        return self.arena[self.offsets[idx]:self.offsets[idx + 1]].decode('utf-8')
+
+    def texts(self, ids: Sequence[int]) -> List[str]:
+        return [self.text(idx) for idx in ids]
+
+    def iter_texts(self) -> Iterator[str]:
+        for idx in range(len(self)):
+            yield self.text(idx)
+
+    def metadata(self, idx: int) -> Dict:
+        """Copia de los metadatos del chunk, con su `chunk_id`"""
+        return {**self.metadata_table[self.metadata_ids[idx]], 'chunk_id': int(idx)}
+
+    def document(self, idx: int) -> Document:
+        return Document(page_content=self.text(idx), metadata=self.metadata(idx))
+
+    def documents(self, ids: Sequence[int]) -> List[Document]:
+        return [self.document(idx) for idx in ids]
+
+    @property
+    def nbytes(self) -> int:
+        """Memoria del texto y de los arrays de índices (sin la tabla de metadatos)"""
+        return len(self.arena) + self.offsets.nbytes + self.metadata_ids.nbytes
@@ -0,0 +1,193 @@
+import re
+import json
+import zlib
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, List, Set, Tuple
+import numpy as np
+from langchain.schema import Document
+
+from .text_analysis import fold_accents
+
+logger = logging.getLogger(__name__)
+
+_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+_DIGITS_PATTERN = re.compile(r"\d+")
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def _normalize_line(line: str) -> str:
+    line = ' '.join(fold_accents(line.lower()).split())
+    # En líneas cortas (p. ej. "Página 3 de 10") los números cambian en cada página:
+    # se igualan para detectar el patrón
+    if len(line.split()) <= 5:
+        line = _DIGITS_PATTERN.sub('#', line)
+    return line
+
+
+def strip_repeated_lines(pages: List[Document], edge_lines: int = 2, min_ratio: float = 0.5,
+                         min_pages: int = 3) -> Tuple[List[Document], int]:
+    """
+    Elimina cabeceras y pies de página repetidos de las páginas de un PDF
+
+    Una línea se considera cabecera o pie si aparece (ignorando números en las
+    líneas cortas) en la misma posición entre las primeras o últimas
+    `edge_lines` líneas de al menos `min_ratio` de las páginas, y como mínimo
+    en `min_pages`.
+
+    Returns:
+        Tuple[List[Document], int]: Páginas limpias y número de líneas eliminadas
+    """
+    if len(pages) < min_pages:
+        return pages, 0
+
+    def edges(lines: List[str]) -> Dict[int, Tuple[int, str]]:
+        """Índice de línea -> clave (posición desde el borde, texto normalizado)"""
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        keys = {}
+        for position, i in enumerate(filled[:edge_lines]):
+            keys[i] = (position, _normalize_line(lines[i]))
+        for position, i in enumerate(reversed(filled[-edge_lines:])):
+            keys.setdefault(i, (-1 - position, _normalize_line(lines[i])))
+        return keys
+
+    page_lines = [page.page_content.splitlines() for page in pages]
+    page_edges = [edges(lines) for lines in page_lines]
+    counts = Counter()
+    for keys in page_edges:
+        counts.update(set(keys.values()))
+    threshold = max(min_pages, min_ratio * len(pages))
+    boilerplate = {key for key, count in counts.items() if key[1] and count >= threshold}
+    if not boilerplate:
+        return pages, 0
+
+    removed = 0
+    cleaned = []
+    for page, lines, keys in zip(pages, page_lines, page_edges):
+        drop = {i for i, key in keys.items() if key in boilerplate}
+        removed += len(drop)
+        content = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+        cleaned.append(Document(page_content=content, metadata=page.metadata))
+    return cleaned, removed
+
+
+def chunk_sources(document: Document) -> List[Dict]:
+    """Referencias (fichero y página) de un chunk, incluidas las de sus duplicados"""
+    sources = document.metadata.get('sources')
+    if sources:
+        return json.loads(sources)
+    return [{'source': document.metadata.get('source'), 'page': document.metadata.get('page')}]
+
+
+class ChunkDeduplicator:
+    """
+    Detecta chunks duplicados exactos y casi duplicados con MinHash + LSH.
+
+    Cada chunk se representa por sus shingles de `shingle_size` palabras
+    normalizadas; la firma MinHash se divide en bandas y solo se comparan los
+    chunks que comparten alguna banda. Se conserva el primer chunk de cada grupo
+    (canónico) y en su metadato `sources` se guardan las referencias de todos
+    los duplicados, como JSON porque Chroma solo admite metadatos escalares.
+    """
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 64, bands: int = 16,
+                 shingle_size: int = 3, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm debe ser múltiplo de bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+
+    def shingles(self, text: str) -> Set[int]:
+        words = _WORD_PATTERN.findall(fold_accents(text.lower()))
+        if len(words) < self.shingle_size:
+            return {zlib.crc32(' '.join(words).encode('utf-8'))} if words else set()
+        return {
+            zlib.crc32(' '.join(words[i:i + self.shingle_size]).encode('utf-8'))
+            for i in range(len(words) - self.shingle_size + 1)
+        }
+
+    def signature(self, shingles: Set[int]) -> np.ndarray:
+        hashes = np.fromiter(shingles, dtype=np.int64, count=len(shingles)) % _MERSENNE_PRIME
+        # (a * x + b) mod p para cada permutación; a, x < 2^31 así que no desborda int64
+        permuted = (np.outer(self._a, hashes) + self._b[:, None]) % _MERSENNE_PRIME
+        return permuted.min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray) -> List[Tuple[int, bytes]]:
+        return [
+            (band, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    @staticmethod
+    def _jaccard(left: Set[int], right: Set[int]) -> float:
+        return len(left & right) / len(left | right) if left or right else 1.0
+
+    def deduplicate(self, documents: List[Document]) -> Tuple[List[Document], Dict]:
+        """
+        Agrupa los chunks duplicados y devuelve solo los canónicos
+
+        Returns:
+            Tuple[List[Document], Dict]: Chunks canónicos y resumen de la reducción
+        """
+        canonical: List[Document] = []
+        canonical_shingles: List[Set[int]] = []
+        references: List[List[Dict]] = []
+        exact_index: Dict[str, int] = {}
+        buckets: Dict[Tuple[int, bytes], List[int]] = defaultdict(list)
+        exact_duplicates = near_duplicates = 0
+
+        for doc in documents:
+            reference = {'source': doc.metadata.get('source'), 'page': doc.metadata.get('page')}
+            normalized = ' '.join(_WORD_PATTERN.findall(fold_accents(doc.page_content.lower())))
+
+            match = exact_index.get(normalized)
+            if match is not None:
+                exact_duplicates += 1
+                references[match].append(reference)
+                continue
+
+            shingles = self.shingles(doc.page_content)
+            keys = self._band_keys(self.signature(shingles)) if shingles else []
+            candidates = {idx for key in keys for idx in buckets.get(key, ())}
+            match = next(
+                (idx for idx in sorted(candidates)
+                 if self._jaccard(shingles, canonical_shingles[idx]) >= self.threshold),
+                None
+            )
+            if match is not None:
+                near_duplicates += 1
+                references[match].append(reference)
+                continue
+
+            idx = len(canonical)
+            canonical.append(doc)
+            canonical_shingles.append(shingles)
+            references.append([reference])
+            exact_index[normalized] = idx
+            for key in keys:
+                buckets[key].append(idx)
+
+        for doc, refs in zip(canonical, references):
+            if len(refs) > 1:
+                unique_refs = list({(ref['source'], ref['page']): ref for ref in refs}.values())
+                doc.metadata['sources'] = json.dumps(unique_refs, ensure_ascii=False)
+                doc.metadata['duplicates'] = len(refs) - 1
+
+        chars_before = sum(len(doc.page_content) for doc in documents)
+        chars_after = sum(len(doc.page_content) for doc in canonical)
+        report = {
+            'chunks_before': len(documents),
+            'chunks_after': len(canonical),
+            'exact_duplicates': exact_duplicates,
+            'near_duplicates': near_duplicates,
+            'chars_before': chars_before,
+            'chars_after': chars_after,
+            'reduction': 1 - len(canonical) / len(documents) if documents else 0.0
+        }
+        return canonical, report
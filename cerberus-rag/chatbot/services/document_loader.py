@@ -1,22 +1,50 @@
 import os
 import logging
-from typing import List
+from datetime import date
+from typing import Dict, List
+from django.conf import settings
 from langchain.schema import Document
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+from .deduplication import ChunkDeduplicator, strip_repeated_lines
+from .metadata_index import infer_document_type
+
 logger = logging.getLogger(__name__)
 
 class DocumentLoader:
-    def __init__(self, pdf_files: List[str], chunk_size: int = 1000, chunk_overlap: int = 200):
+    def __init__(self, pdf_files: List[str], chunk_size: int = None, chunk_overlap: int = None,
+                 deduplicate: bool = None, dedup_threshold: float = None, ingested_at: Dict[str, str] = None):
         self.pdf_files = pdf_files
-        self.chunk_size = chunk_size
-        self.chunk_overlap = chunk_overlap
+        # Fecha de ingesta por nombre de fichero: la ya registrada (ver index_snapshot.ingestion_dates) o la de hoy
+        self.ingested_at = dict(ingested_at or {})
+        self.chunk_size = chunk_size or getattr(settings, 'CHATBOT_CHUNK_SIZE', 1000)
+        self.chunk_overlap = chunk_overlap if chunk_overlap is not None else getattr(settings, 'CHATBOT_CHUNK_OVERLAP', 200)
+        if deduplicate is None:
+            deduplicate = getattr(settings, 'CHATBOT_DEDUP_ENABLED', True)
+        self.deduplicate = deduplicate
+        if dedup_threshold is None:
+            dedup_threshold = getattr(settings, 'CHATBOT_DEDUP_THRESHOLD', 0.85)
+        self.dedup_threshold = dedup_threshold
+        self.boilerplate_lines = 0
+        self.dedup_report = None
 
     def load_documents(self) -> List[Document]:
         all_docs = []
         for pdf_file in self.pdf_files:
             all_docs.extend(self._load_pdf(pdf_file))
+
+        if self.deduplicate and all_docs:
+            deduplicator = ChunkDeduplicator(threshold=self.dedup_threshold)
+            all_docs, self.dedup_report = deduplicator.deduplicate(all_docs)
+            self.dedup_report['boilerplate_lines'] = self.boilerplate_lines
+            report = self.dedup_report
+            logger.info(
+                f"Deduplicación: {report['chunks_before']} -> {report['chunks_after']} fragmentos "
+                f"(-{100 * report['reduction']:.1f}%), {report['exact_duplicates']} exactos, "
+                f"{report['near_duplicates']} casi duplicados, {report['boilerplate_lines']} líneas "
+                f"de cabecera/pie eliminadas"
+            )
         return all_docs
 
     def _load_pdf(self, pdf_file: str) -> List[Document]:
@@ -24,9 +52,18 @@ class DocumentLoader:
             logger.info(f"Cargando archivo PDF: {pdf_file}")
             loader = PyPDFLoader(pdf_file)
             data = loader.load()
+            # Metadatos para el filtrado previo: tipo de documento y fecha en que se ingirió el fichero
+            doc_type = infer_document_type(pdf_file)
+            ingested_at = self.ingested_at.setdefault(os.path.basename(pdf_file), date.today().isoformat())
+            for page in data:
+                page.metadata.update({'doc_type': doc_type, 'ingested_at': ingested_at})
+            if self.deduplicate:
+                data, removed = strip_repeated_lines(data)
+                self.boilerplate_lines += removed
             text_splitter = RecursiveCharacterTextSplitter(
                 chunk_size=self.chunk_size,
-                chunk_overlap=self.chunk_overlap
+                chunk_overlap=self.chunk_overlap,
+                add_start_index=True
             )
             docs = text_splitter.split_documents(data)
             logger.info(f"Cargado exitosamente {pdf_file}")
@@ -0,0 +1,247 @@
+import os
+import glob
+import gzip
+import json
+import time
+import atexit
+import shutil
+import logging
+import threading
+from typing import Dict, List, Iterator
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+FSYNC_ALWAYS = 'always'
+FSYNC_BATCH = 'batch'
+FSYNC_NEVER = 'never'
+
+TEXT_COLUMNS = ('query', 'answer', 'message_id', 'conversation_id')
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class FeedbackJournal:
+    """
+    Diario de calificaciones con escritura por lotes.
+
+    `record` solo añade el evento a un buffer en memoria; un hilo de fondo lo
+    escribe en `feedback-current-<pid>.jsonl` cada `flush_interval` segundos o
+    al llegar a `batch_size` eventos. Cada proceso (workers de serve_workers)
+    tiene su propio fichero activo, así que escribir y rotar no necesita
+    bloqueos entre procesos. El fichero activo se rota por tamaño o antigüedad
+    a un segmento comprimido, y todos los segmentos pueden exportarse a
+    formato columnar.
+
+    Políticas de fsync: con `always`, `record` escribe y sincroniza antes de
+    volver (el evento es durable al terminar la llamada); `batch` sincroniza
+    tras cada lote y `never` deja la sincronización al sistema operativo.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """Implementación Singleton para compartir el buffer entre vistas y consumer"""
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, directory: str = None, batch_size: int = None, flush_interval: float = None,
+                 fsync_policy: str = None, max_bytes: int = None, max_age_hours: float = None):
+        self.directory = str(directory or getattr(settings, 'CHATBOT_FEEDBACK_DIR', settings.BASE_DIR / 'feedback'))
+        self.batch_size = batch_size or getattr(settings, 'CHATBOT_FEEDBACK_BATCH_SIZE', 100)
+        self.flush_interval = flush_interval or getattr(settings, 'CHATBOT_FEEDBACK_FLUSH_INTERVAL', 2.0)
+        self.fsync_policy = fsync_policy or getattr(settings, 'CHATBOT_FEEDBACK_FSYNC', FSYNC_BATCH)
+        self.max_bytes = max_bytes or getattr(settings, 'CHATBOT_FEEDBACK_MAX_BYTES', 64 * 1024 * 1024)
+        self.max_age = (max_age_hours or getattr(settings, 'CHATBOT_FEEDBACK_MAX_AGE_HOURS', 24)) * 3600
+
+        self._buffer: List[Dict] = []
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._opened_at = None
+        self._thread = None
+        atexit.register(self.flush)
+        if hasattr(os, 'register_at_fork'):
+            # Los eventos pendientes son del padre, que los escribirá en su propio fichero
+            os.register_at_fork(after_in_child=self._reset_after_fork)
+
+    def _reset_after_fork(self):
+        self._buffer = []
+        self._opened_at = None
+        self._thread = None
+
+    @property
+    def current_path(self) -> str:
+        return os.path.join(self.directory, f'feedback-current-{os.getpid()}.jsonl')
+
+    def record(self, query: str, answer: str, rating: int, message_id=None, conversation_id=None):
+        """Añade un evento al buffer sin tocar el disco; con la política `always` lo escribe y sincroniza antes de volver"""
+        event = {
+            'timestamp': time.time(),
+            'rating': int(rating),
+            'query': query or "",
+            'answer': answer or "",
+            'message_id': str(message_id) if message_id else "",
+            'conversation_id': str(conversation_id) if conversation_id else ""
+        }
+        with self._lock:
+            self._buffer.append(event)
+            pending = len(self._buffer)
+
+        if self.fsync_policy == FSYNC_ALWAYS:
+            self.flush()
+            return
+        self._ensure_thread()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='feedback-journal', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error escribiendo el diario de feedback: {str(e)}")
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                events, self._buffer = self._buffer, []
+            if not events:
+                return
+
+            os.makedirs(self.directory, exist_ok=True)
+            self._rotate_if_needed()
+            try:
+                with open(self.current_path, 'a', encoding='utf-8') as f:
+                    f.write("".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events))
+                    f.flush()
+                    if self.fsync_policy != FSYNC_NEVER:
+                        os.fsync(f.fileno())
+            except Exception:
+                with self._lock:
+                    self._buffer = events + self._buffer
+                raise
+
+    def _rotate_if_needed(self):
+        if not os.path.exists(self.current_path):
+            self._opened_at = time.time()
+            return
+        if self._opened_at is None:
+            self._opened_at = os.path.getmtime(self.current_path)
+
+        too_big = os.path.getsize(self.current_path) >= self.max_bytes
+        too_old = time.time() - self._opened_at >= self.max_age
+        if too_big or too_old:
+            self._compress(self.current_path, os.getpid())
+            self._opened_at = time.time()
+
+    def rotate(self):
+        """Comprime el fichero activo de este proceso como un segmento cerrado y empieza uno nuevo"""
+        with self._write_lock:
+            self._compress(self.current_path, os.getpid())
+            self._opened_at = time.time()
+
+    def rotate_stale(self) -> int:
+        """Comprime los ficheros activos de procesos que ya no existen; devuelve cuántos"""
+        rotated = 0
+        for path in glob.glob(os.path.join(self.directory, 'feedback-current-*.jsonl')):
+            pid = int(path.rsplit('-', 1)[1].split('.')[0])
+            if pid != os.getpid() and not _process_alive(pid):
+                self._compress(path, pid)
+                rotated += 1
+        return rotated
+
+    def _compress(self, path: str, pid: int):
+        if not os.path.exists(path):
+            return
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        sequence = 0
+        segment = os.path.join(self.directory, f"feedback-{stamp}-{pid}-{sequence:03d}.jsonl.gz")
+        while os.path.exists(segment):
+            sequence += 1
+            segment = os.path.join(self.directory, f"feedback-{stamp}-{pid}-{sequence:03d}.jsonl.gz")
+        with open(path, 'rb') as src, gzip.open(segment, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+        logger.info(f"Diario de feedback rotado: {os.path.basename(segment)}")
+
+    def segments(self) -> List[str]:
+        paths = []
+        # Registro anterior al diario, escrito por ChatService.save_feedback_async
+        legacy_path = os.path.join(settings.BASE_DIR, 'feedback_log.json')
+        if os.path.exists(legacy_path):
+            paths.append(str(legacy_path))
+        paths.extend(sorted(glob.glob(os.path.join(self.directory, 'feedback-*.jsonl.gz'))))
+        # Ficheros activos de todos los procesos (y el nombre único de versiones anteriores)
+        paths.extend(sorted(glob.glob(os.path.join(self.directory, 'feedback-current*.jsonl'))))
+        return paths
+
+    def iter_events(self) -> Iterator[Dict]:
+        self.flush()
+        for path in self.segments():
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        event = json.loads(line)
+                        event.setdefault('rating', event.pop('feedback', 0))
+                        yield event
+
+    def export(self, output_path: str, fmt: str = 'npz') -> int:
+        """
+        Exporta todos los eventos a formato columnar
+
+        Args:
+            output_path (str): Ruta del fichero de salida
+            fmt (str): `parquet` (requiere pyarrow) o `npz` (NumPy comprimido)
+
+        Returns:
+            int: Número de eventos exportados
+        """
+        columns = {'timestamp': [], 'rating': [], **{name: [] for name in TEXT_COLUMNS}}
+        for event in self.iter_events():
+            for name, values in columns.items():
+                values.append(event.get(name, "" if name in TEXT_COLUMNS else 0))
+
+        if fmt == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.table({
+                'timestamp': pa.array(columns['timestamp'], type=pa.float64()),
+                'rating': pa.array(columns['rating'], type=pa.int8()),
+                **{name: pa.array(columns[name], type=pa.string()) for name in TEXT_COLUMNS}
+            })
+            pq.write_table(table, output_path, compression='zstd')
+        elif fmt == 'npz':
+            import numpy as np
+            arrays = {
+                'timestamp': np.asarray(columns['timestamp'], dtype=np.float64),
+                'rating': np.asarray(columns['rating'], dtype=np.int8),
+            }
+            # Texto al estilo Arrow: bytes UTF-8 contiguos más un array de offsets
+            for name in TEXT_COLUMNS:
+                encoded = [value.encode('utf-8') for value in columns[name]]
+                offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+                offsets[1:] = np.cumsum([len(value) for value in encoded])
+                arrays[f"{name}_data"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+                arrays[f"{name}_offsets"] = offsets
+            np.savez_compressed(output_path, **arrays)
+        else:
+            raise ValueError(f"Formato de exportación no soportado: {fmt}")
+
+        return len(columns['rating'])
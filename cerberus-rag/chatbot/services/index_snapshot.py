@@ -0,0 +1,219 @@
+import os
+import json
+import mmap
+import shutil
+import logging
+import hashlib
+from datetime import datetime
+from typing import Dict, List, Optional
+import numpy as np
+from scipy.sparse import csr_matrix
+from django.conf import settings
+
+from .chunk_store import ChunkStore
+from .text_analysis import TokenStore
+from .inference import EMBEDDING_MODEL
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT = 1
+CURRENT_FILE = 'CURRENT'
+MANIFEST_FILE = 'manifest.json'
+ARENA_FILE = 'chunks.arena'
+
+
+def source_fingerprint(pdf_files: List[str]) -> List[Dict]:
+    """Nombre, tamaño y fecha de modificación de cada PDF, para detectar snapshots desactualizados"""
+    fingerprint = []
+    for pdf_file in sorted(pdf_files, key=os.path.basename):
+        stat = os.stat(pdf_file)
+        fingerprint.append({'name': os.path.basename(pdf_file), 'size': stat.st_size, 'mtime': int(stat.st_mtime)})
+    return fingerprint
+
+
+def index_config(**overrides) -> Dict:
+    """
+    Parámetros de los que depende el contenido del índice: modelo y backend de
+    embeddings, troceado y deduplicación. Se guardan en el manifiesto y un
+    snapshot solo se carga si coinciden con la configuración actual.
+    """
+    config = {
+        'embedding_model': EMBEDDING_MODEL,
+        'inference_backend': getattr(settings, 'CHATBOT_INFERENCE_BACKEND', 'torch'),
+        'chunk_size': getattr(settings, 'CHATBOT_CHUNK_SIZE', 1000),
+        'chunk_overlap': getattr(settings, 'CHATBOT_CHUNK_OVERLAP', 200),
+        'deduplicate': getattr(settings, 'CHATBOT_DEDUP_ENABLED', True),
+        'dedup_threshold': getattr(settings, 'CHATBOT_DEDUP_THRESHOLD', 0.85),
+    }
+    config.update(overrides)
+    if not config['deduplicate']:
+        # Sin deduplicación el umbral no afecta al índice
+        config['dedup_threshold'] = None
+    return config
+
+
+def ingestion_dates(root: str, pdf_files: List[str]) -> Dict[str, str]:
+    """
+    Fecha de ingesta (ISO) registrada en el snapshot activo de los PDF que no han
+    cambiado desde entonces; los nuevos o modificados no aparecen y cuentan como
+    ingeridos ahora
+    """
+    path = current_snapshot(root)
+    if path is None:
+        return {}
+    try:
+        manifest = read_manifest(path)
+    except (OSError, ValueError):
+        return {}
+    previous = {entry['name']: entry for entry in manifest.get('sources', [])}
+    ingested = manifest.get('ingested', {})
+    return {
+        entry['name']: ingested[entry['name']] for entry in source_fingerprint(pdf_files)
+        if entry['name'] in ingested and previous.get(entry['name']) == entry
+    }
+
+
+def _save(directory: str, name: str, array: np.ndarray):
+    np.save(os.path.join(directory, f"{name}.npy"), np.ascontiguousarray(array))
+
+
+def _load(directory: str, name: str) -> np.ndarray:
+    # mmap_mode='r': las páginas del fichero se comparten entre todos los procesos que lo mapean
+    return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+
+
+def write_snapshot(service, root: str, embeddings: np.ndarray, manifest: Dict, keep: int = 3) -> str:
+    """
+    Escribe los índices de un `RetrievalService` construido en un directorio versionado
+
+    El directorio se crea con un nombre temporal y se renombra al terminar; después
+    se actualiza `CURRENT` de forma atómica, así que un proceso que arranca a la vez
+    nunca ve un snapshot a medias.
+
+    Args:
+        service (RetrievalService): Servicio con los índices en proceso ya construidos
+        root (str): Directorio raíz de los snapshots (CHATBOT_INDEX_DIR)
+        embeddings (np.ndarray): Embedding de cada chunk, en el orden de los ids
+        manifest (Dict): Datos de la ingesta (fuentes, modelo, parámetros de troceado)
+        keep (int): Versiones que se conservan, incluida la nueva
+
+    Returns:
+        str: Ruta del snapshot escrito
+    """
+    chunks, token_store = service.chunks, service.token_store
+    digest = hashlib.sha256(bytes(chunks.arena)).hexdigest()[:8]
+    version = f"{datetime.now().strftime('%Y%m%d%H%M%S')}-{digest}"
+    os.makedirs(root, exist_ok=True)
+    tmp_dir = os.path.join(root, f".tmp-{version}")
+    os.makedirs(tmp_dir)
+
+    with open(os.path.join(tmp_dir, ARENA_FILE), 'wb') as f:
+        f.write(chunks.arena)
+    _save(tmp_dir, 'chunk_offsets', chunks.offsets)
+    _save(tmp_dir, 'metadata_ids', chunks.metadata_ids)
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    _save(tmp_dir, 'embeddings', embeddings)
+    _save(tmp_dir, 'embedding_sq_norms', np.einsum('ij,ij->i', embeddings, embeddings))
+
+    for name in TokenStore.ARRAYS:
+        _save(tmp_dir, f"tokens_{name}", getattr(token_store, name))
+
+    tfidf = service.tfidf_matrix.tocsr()
+    _save(tmp_dir, 'tfidf_idf', service.tfidf_transformer.idf_)
+    _save(tmp_dir, 'tfidf_data', tfidf.data)
+    _save(tmp_dir, 'tfidf_indices', tfidf.indices)
+    _save(tmp_dir, 'tfidf_indptr', tfidf.indptr)
+
+    vocabulary = [None] * len(token_store.vocabulary)
+    for term, term_id in token_store.vocabulary.items():
+        vocabulary[term_id] = term
+    manifest = {
+        **manifest,
+        'format': SNAPSHOT_FORMAT,
+        'version': version,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'chunks': len(chunks),
+        'vocab_size': len(vocabulary),
+        'embedding_dim': int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        'vocabulary': vocabulary,
+        'metadata_table': chunks.metadata_table,
+    }
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, default=str)
+
+    path = os.path.join(root, version)
+    os.rename(tmp_dir, path)
+    current_tmp = os.path.join(root, f".{CURRENT_FILE}.tmp")
+    with open(current_tmp, 'w') as f:
+        f.write(version)
+    os.replace(current_tmp, os.path.join(root, CURRENT_FILE))
+
+    # Las versiones antiguas se borran; los procesos que aún las mapean conservan sus páginas
+    versions = sorted(name for name in os.listdir(root) if not name.startswith('.') and name != CURRENT_FILE)
+    for old in versions[:-keep] if keep > 0 else []:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    return path
+
+
+def current_snapshot(root: str) -> Optional[str]:
+    """Ruta del snapshot activo según `CURRENT`, o None si no hay ninguno"""
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            version = f.read().strip()
+    except OSError:
+        return None
+    path = os.path.join(root, version)
+    return path if os.path.isfile(os.path.join(path, MANIFEST_FILE)) else None
+
+
+def read_manifest(path: str) -> Dict:
+    with open(os.path.join(path, MANIFEST_FILE), encoding='utf-8') as f:
+        return json.load(f)
+
+
+class IndexSnapshot:
+    """
+    Snapshot del índice cargado con mmap: no se copia ni se reconstruye nada.
+
+    Texto, embeddings, postings y matriz TF-IDF quedan como vistas sobre los
+    ficheros, de modo que varios workers que cargan el mismo snapshot comparten
+    las páginas físicas a través de la caché del sistema operativo.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.manifest = read_manifest(path)
+        if self.manifest.get('format') != SNAPSHOT_FORMAT:
+            raise ValueError(f"Formato de snapshot no soportado: {self.manifest.get('format')}")
+
+        with open(os.path.join(path, ARENA_FILE), 'rb') as f:
+            # Un fichero vacío no se puede mapear
+            arena = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+        self.chunks = ChunkStore.from_arrays(
+            arena, _load(path, 'chunk_offsets'), _load(path, 'metadata_ids'), self.manifest['metadata_table']
+        )
+
+        vocabulary = {term: term_id for term_id, term in enumerate(self.manifest['vocabulary'])}
+        arrays = {name: _load(path, f"tokens_{name}") for name in TokenStore.ARRAYS}
+        self.token_store = TokenStore.from_arrays(vocabulary, arrays)
+
+        self.embeddings = _load(path, 'embeddings')
+        self.embedding_sq_norms = _load(path, 'embedding_sq_norms')
+        self.tfidf_idf = np.asarray(_load(path, 'tfidf_idf'))
+        self.tfidf_matrix = csr_matrix(
+            (_load(path, 'tfidf_data'), _load(path, 'tfidf_indices'), _load(path, 'tfidf_indptr')),
+            shape=(len(self.chunks), len(vocabulary))
+        )
+
+    def mismatches(self, pdf_files: List[str], config: Optional[Dict] = None) -> List[str]:
+        """
+        Qué no corresponde a los PDF y a la configuración actuales (ver `index_config`);
+        vacío si el snapshot se puede usar
+        """
+        config = config or index_config()
+        differences = [] if self.manifest.get('sources') == source_fingerprint(pdf_files) else ['sources']
+        return differences + [key for key, value in config.items() if self.manifest.get(key) != value]
+
+    def matches(self, pdf_files: List[str], config: Optional[Dict] = None) -> bool:
+        return not self.mismatches(pdf_files, config)
@@ -0,0 +1,152 @@
+import os
+import logging
+from typing import List
+import numpy as np
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+BACKEND_TORCH = 'torch'
+BACKEND_ONNX = 'onnx'
+
+
+def _onnx_cache_dir(model_name: str) -> str:
+    base = str(getattr(settings, 'CHATBOT_ONNX_CACHE_DIR', settings.BASE_DIR / 'onnx_models'))
+    return os.path.join(base, model_name.replace('/', '__'))
+
+
+def _export_quantized(model_name: str, model_class):
+    """
+    Exporta el modelo a ONNX y lo cuantiza a int8 (dinámico) una sola vez;
+    las siguientes cargas leen el modelo cuantizado del directorio de caché.
+    """
+    from optimum.onnxruntime import ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    target_dir = _onnx_cache_dir(model_name)
+    quantized_file = os.path.join(target_dir, 'model_quantized.onnx')
+    if not os.path.exists(quantized_file):
+        logger.info(f"Exportando {model_name} a ONNX int8 en {target_dir}")
+        model = model_class.from_pretrained(model_name, export=True)
+        model.save_pretrained(target_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(target_dir)
+        quantizer = ORTQuantizer.from_pretrained(target_dir)
+        quantizer.quantize(
+            save_dir=target_dir,
+            quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        )
+    return target_dir
+
+
+def _session_options():
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    threads = getattr(settings, 'CHATBOT_ONNX_THREADS', 0)
+    if threads:
+        options.intra_op_num_threads = threads
+    return options
+
+
+class OnnxEmbeddings(Embeddings):
+    """Embeddings de sentence-transformers (mean pooling + normalización) sobre ONNX Runtime int8"""
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, batch_size: int = 32):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        model_dir = _export_quantized(model_name, ORTModelForFeatureExtraction)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir, file_name='model_quantized.onnx', session_options=_session_options()
+        )
+        self.batch_size = batch_size
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = texts[start:start + self.batch_size]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, max_length=256, return_tensors='np')
+            hidden = self.model(**inputs).last_hidden_state
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            vectors.append(pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None))
+        return np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(list(texts)).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+
+class OnnxCrossEncoder:
+    """Cross-encoder con la misma interfaz `predict(pairs)` que sentence_transformers.CrossEncoder"""
+
+    def __init__(self, model_name: str = CROSS_ENCODER_MODEL, batch_size: int = 32):
+        from optimum.onnxruntime import ORTModelForSequenceClassification
+        from transformers import AutoTokenizer
+
+        model_dir = _export_quantized(model_name, ORTModelForSequenceClassification)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForSequenceClassification.from_pretrained(
+            model_dir, file_name='model_quantized.onnx', session_options=_session_options()
+        )
+        self.batch_size = batch_size
+
+    def predict(self, pairs: List[List[str]], **kwargs) -> np.ndarray:
+        scores = []
+        for start in range(0, len(pairs), self.batch_size):
+            batch = pairs[start:start + self.batch_size]
+            inputs = self.tokenizer(
+                [query for query, _ in batch], [doc for _, doc in batch],
+                padding=True, truncation=True, max_length=512, return_tensors='np'
+            )
+            scores.append(np.asarray(self.model(**inputs).logits)[:, 0])
+        return np.concatenate(scores) if scores else np.zeros(0, dtype=np.float32)
+
+
+def _torch_embeddings(model_name: str):
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name, model_kwargs={'device': 'cpu'})
+
+
+def _torch_cross_encoder(model_name: str):
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name)
+
+
+def get_embeddings(backend: str = None, model_name: str = EMBEDDING_MODEL):
+    """
+    Crea el modelo de embeddings del backend configurado
+
+    Args:
+        backend (str): `onnx` o `torch`; por defecto CHATBOT_INFERENCE_BACKEND
+
+    Returns:
+        Embeddings: Modelo compatible con LangChain. Si el backend ONNX no está
+        disponible se usa PyTorch.
+    """
+    backend = backend or getattr(settings, 'CHATBOT_INFERENCE_BACKEND', BACKEND_TORCH)
+    if backend == BACKEND_ONNX:
+        try:
+            return OnnxEmbeddings(model_name)
+        except Exception as e:
+            logger.warning(f"Backend ONNX no disponible para embeddings, usando PyTorch: {str(e)}")
+    return _torch_embeddings(model_name)
+
+
+def get_cross_encoder(backend: str = None, model_name: str = CROSS_ENCODER_MODEL):
+    """Crea el cross-encoder del backend configurado, con PyTorch como respaldo"""
+    backend = backend or getattr(settings, 'CHATBOT_INFERENCE_BACKEND', BACKEND_TORCH)
+    if backend == BACKEND_ONNX:
+        try:
+            return OnnxCrossEncoder(model_name)
+        except Exception as e:
+            logger.warning(f"Backend ONNX no disponible para el cross-encoder, usando PyTorch: {str(e)}")
+    return _torch_cross_encoder(model_name)
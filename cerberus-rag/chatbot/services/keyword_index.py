@@ -0,0 +1,151 @@
+import re
+import bisect
+from typing import List, Optional, Tuple
+import numpy as np
+
+from .text_analysis import TokenStore, fold_accents, light_stem
+
+_CLAUSE_PATTERN = re.compile(r'"([^"]+)"|(\S+)')
+_PREFIX_CLEAN = re.compile(r"\W+", re.UNICODE)
+
+
+class KeywordIndex:
+    """
+    Índice invertido para la búsqueda por palabras clave de respaldo.
+
+    Se construye sobre los postings del `TokenStore`, así que no vuelve a leer
+    el texto de los chunks: el coste de una consulta depende solo de los
+    postings de sus términos. Sintaxis admitida:
+
+    - `palabra`: término opcional, puntúa con BM25
+    - `prefij*`: se expande a todos los términos del vocabulario con ese prefijo
+    - `"frase exacta"`: obligatoria; sus términos deben aparecer seguidos
+      (las stopwords se ignoran igual que en la indexación)
+    """
+
+    def __init__(self, token_store: TokenStore, k1: float = 1.2, b: float = 0.75,
+                 max_prefix_expansions: int = 50):
+        self.token_store = token_store
+        self.k1 = k1
+        self.max_prefix_expansions = max_prefix_expansions
+
+        doc_freqs = token_store.doc_freqs.astype(np.float64)
+        num_docs = token_store.num_docs
+        self.idf = np.log(1.0 + (num_docs - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        doc_len = token_store.doc_lengths.astype(np.float64)
+        avg_len = float(doc_len.mean()) if num_docs else 1.0
+        self.length_norm = k1 * (1 - b + b * doc_len / (avg_len or 1.0))
+
+        # Vocabulario ordenado para expandir prefijos con búsqueda binaria
+        self._sorted_terms = sorted(token_store.vocabulary)
+        self._sorted_ids = [token_store.vocabulary[term] for term in self._sorted_terms]
+
+    def expand_prefix(self, prefix: str) -> List[int]:
+        start = bisect.bisect_left(self._sorted_terms, prefix)
+        end = bisect.bisect_left(self._sorted_terms, prefix + '\uffff')
+        ids = self._sorted_ids[start:end]
+        if len(ids) > self.max_prefix_expansions:
+            # Con demasiadas expansiones se conservan los términos más discriminantes
+            ids = sorted(ids, key=lambda term: self.token_store.doc_freqs[term])[:self.max_prefix_expansions]
+        return ids
+
+    def phrase_matches(self, term_ids: Tuple[int, ...]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Chunks que contienen la secuencia de términos y cuántas veces
+
+        Se parte de las posiciones del término menos frecuente de la frase y se
+        comprueba el resto comparando `token_ids` en los desplazamientos esperados.
+        """
+        store = self.token_store
+        anchor = int(np.argmin([store.doc_freqs[term] for term in term_ids]))
+        starts = store.positions(term_ids[anchor]) - anchor
+        length = len(term_ids)
+        valid = (starts >= 0) & (starts + length <= len(store.token_ids))
+        starts = starts[valid]
+        for offset, term in enumerate(term_ids):
+            if offset == anchor:
+                continue
+            starts = starts[store.token_ids[starts + offset] == term]
+        # La frase no puede cruzar el límite entre dos chunks
+        starts = starts[store.token_docs[starts] == store.token_docs[starts + length - 1]]
+        return np.unique(store.token_docs[starts], return_counts=True)
+
+    def _parse(self, query: str) -> Tuple[List[Tuple[int, ...]], List[int], bool]:
+        """Separa la consulta en frases, términos (incluidos los prefijos expandidos) y si hay frases imposibles"""
+        store = self.token_store
+        phrases, terms, loose = [], [], []
+        unmatched_phrase = False
+        for phrase, word in _CLAUSE_PATTERN.findall(query):
+            if phrase:
+                analyzed = store.analyzer(phrase)
+                if not analyzed:
+                    continue
+                if any(token not in store.vocabulary for token in analyzed):
+                    unmatched_phrase = True
+                    continue
+                phrases.append(tuple(store.vocabulary[token] for token in analyzed))
+            elif word.endswith('*') and len(word) > 1:
+                prefix = _PREFIX_CLEAN.sub('', fold_accents(word[:-1].lower()))
+                if prefix:
+                    expanded = self.expand_prefix(prefix)
+                    # El vocabulario guarda raíces: `reglamento*` debe alcanzar `reglament`
+                    if getattr(store.analyzer, 'stem', False) and light_stem(prefix) != prefix:
+                        expanded = list(dict.fromkeys(expanded + self.expand_prefix(light_stem(prefix))))
+                    terms.extend(expanded)
+            else:
+                loose.append(word)
+        if loose:
+            terms.extend(store.analyze_query(" ".join(loose)))
+        return phrases, terms, unmatched_phrase
+
+    def search(self, query: str, limit: int = 3, allowed_mask: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Busca los chunks más relevantes para la consulta
+
+        Args:
+            query (str): Consulta con la sintaxis descrita en la clase
+            limit (int): Número máximo de resultados
+            allowed_mask (np.ndarray): Máscara booleana de chunks permitidos (filtro de metadatos)
+
+        Returns:
+            List[Tuple[int, float]]: (índice del chunk, puntuación) de mayor a menor
+        """
+        phrases, terms, unmatched_phrase = self._parse(query)
+        if unmatched_phrase or not (phrases or terms):
+            return []
+
+        scores = {}
+        required = None
+        for phrase in phrases:
+            docs, counts = self.phrase_matches(phrase)
+            if allowed_mask is not None:
+                keep = allowed_mask[docs]
+                docs, counts = docs[keep], counts[keep]
+            if required is None:
+                required = docs
+            else:
+                required = np.intersect1d(required, docs, assume_unique=True)
+            weight = float(self.idf[list(phrase)].sum())
+            for doc, count in zip(docs.tolist(), counts.tolist()):
+                scores[doc] = scores.get(doc, 0.0) + weight * count / (count + self.length_norm[doc])
+
+        if terms:
+            # Solo se materializan los chunks presentes en los postings, no todo el corpus
+            touched, contributions = [], []
+            for term in set(terms):
+                docs, freqs = self.token_store.postings(term)
+                if allowed_mask is not None:
+                    keep = allowed_mask[docs]
+                    docs, freqs = docs[keep], freqs[keep]
+                touched.append(docs)
+                contributions.append(self.idf[term] * freqs * (self.k1 + 1) / (freqs + self.length_norm[docs]))
+            docs, inverse = np.unique(np.concatenate(touched), return_inverse=True)
+            totals = np.bincount(inverse, weights=np.concatenate(contributions))
+            for doc, total in zip(docs.tolist(), totals.tolist()):
+                scores[doc] = scores.get(doc, 0.0) + total
+
+        if required is not None:
+            allowed = set(required.tolist())
+            scores = {doc: score for doc, score in scores.items() if doc in allowed}
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
@@ -0,0 +1,210 @@
+import logging
+import threading
+from typing import Any, AsyncIterator, Dict, List, Optional
+import httpx
+from ollama import ResponseError
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from langchain_ollama import OllamaLLM
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OLLAMA_URL = "http://localhost:11434"
+
+
+def _chunk_text(chunk: Any) -> Optional[str]:
+    """Texto de un fragmento del stream (str, AIMessageChunk o dict)"""
+    if hasattr(chunk, 'content'):
+        return chunk.content
+    if isinstance(chunk, str):
+        return chunk
+    if isinstance(chunk, dict) and 'content' in chunk:
+        return chunk['content']
+    logger.info(f"Unexpected chunk type: {type(chunk)}, chunk: {chunk}")
+    return None
+
+
+def is_endpoint_failure(error: Exception) -> bool:
+    """
+    Si el error es del endpoint (transporte o respuesta 5xx) y no de la petición
+
+    Solo estos errores marcan el endpoint como no disponible y se reintentan en
+    otro; un 4xx o un prompt inválido fallaría igual en cualquier instancia.
+    """
+    if isinstance(error, ResponseError):
+        return error.status_code >= 500
+    return isinstance(error, (httpx.TransportError, OSError))
+
+
+class LLMEndpoint:
+    """Una instancia de Ollama: estado de salud, peticiones en curso y clientes por límite de tokens"""
+
+    def __init__(self, url: str, model_name: str, temperature: float, weight: float = 1.0):
+        self.url = url.rstrip('/')
+        self.model_name = model_name
+        self.temperature = temperature
+        self.weight = weight
+        self.healthy = True
+        self.inflight = 0
+        self.requests = 0
+        self.failures = 0
+        self.last_error = None
+        self._clients: Dict[Optional[int], OllamaLLM] = {}
+
+    def llm(self, max_tokens: int = None) -> OllamaLLM:
+        if max_tokens not in self._clients:
+            options = {'num_predict': max_tokens} if max_tokens else {}
+            self._clients[max_tokens] = OllamaLLM(
+                model=self.model_name,
+                temperature=self.temperature,
+                streaming=True,
+                base_url=self.url,
+                **options
+            )
+        return self._clients[max_tokens]
+
+    @property
+    def load(self) -> float:
+        return (self.inflight + 1) / self.weight
+
+    def check_health(self, timeout: float = 2.0) -> bool:
+        try:
+            import requests
+            response = requests.get(f"{self.url}/api/version", timeout=timeout)
+            self.healthy = response.status_code == 200
+        except Exception as e:
+            self.healthy = False
+            self.last_error = str(e)
+        return self.healthy
+
+    def status(self) -> Dict:
+        return {
+            'url': self.url,
+            'weight': self.weight,
+            'healthy': self.healthy,
+            'inflight': self.inflight,
+            'requests': self.requests,
+            'failures': self.failures,
+            'last_error': self.last_error
+        }
+
+
+class LLMRouter:
+    """
+    Reparte las generaciones entre varias instancias de Ollama.
+
+    Cada petición va al endpoint sano con menos carga relativa a su peso
+    ((en curso + 1) / peso). Si un endpoint falla (error de transporte o 5xx,
+    ver `is_endpoint_failure`) antes de emitir el primer token se marca como no
+    disponible y se reintenta en otro; una vez emitido un token el error se
+    propaga, porque el cliente ya recibió parte de la respuesta. Los errores de
+    la petición se propagan sin reintentar ni marcar el endpoint. Un hilo de
+    fondo comprueba la salud de todos los endpoints.
+    """
+
+    def __init__(self, model_name: str, temperature: float, endpoints: List[Dict],
+                 health_interval: float = None):
+        self.endpoints = []
+        for endpoint in endpoints:
+            weight = float(endpoint.get('weight', 1.0))
+            # El peso divide la carga del endpoint (ver LLMEndpoint.load)
+            if weight <= 0:
+                raise ImproperlyConfigured(f"Peso no válido para el endpoint LLM {endpoint['url']}: {weight} (debe ser > 0)")
+            self.endpoints.append(LLMEndpoint(endpoint['url'], model_name, temperature, weight))
+        self.health_interval = health_interval or getattr(settings, 'CHATBOT_LLM_HEALTH_INTERVAL', 10.0)
+        self._lock = threading.Lock()
+        self._turn = 0
+        self._health_thread = None
+
+    def start_health_checks(self):
+        if self._health_thread is not None:
+            return
+        stop_event = threading.Event()
+
+        def loop():
+            while not stop_event.wait(self.health_interval):
+                for endpoint in self.endpoints:
+                    was_healthy = endpoint.healthy
+                    if endpoint.check_health() != was_healthy:
+                        state = "disponible" if endpoint.healthy else "no disponible"
+                        logger.warning(f"Endpoint LLM {endpoint.url} {state}")
+
+        self._health_thread = threading.Thread(target=loop, name='llm-health', daemon=True)
+        self._health_thread.stop_event = stop_event
+        self._health_thread.start()
+
+    def _acquire(self, tried: set) -> Optional[LLMEndpoint]:
+        """Elige el endpoint menos cargado no probado aún; si no queda ninguno sano, prueba los demás"""
+        with self._lock:
+            candidates = [e for e in self.endpoints if e.url not in tried and e.healthy]
+            if not candidates:
+                candidates = [e for e in self.endpoints if e.url not in tried]
+            if not candidates:
+                return None
+            # Empates: por turnos, para no cargar siempre el primero de la lista
+            self._turn += 1
+            order = {e.url: (i - self._turn) % len(self.endpoints) for i, e in enumerate(self.endpoints)}
+            endpoint = min(candidates, key=lambda e: (e.load, order[e.url]))
+            endpoint.inflight += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def _release(self, endpoint: LLMEndpoint):
+        with self._lock:
+            endpoint.inflight -= 1
+
+    def _mark_failure(self, endpoint: LLMEndpoint, error: Exception):
+        endpoint.failures += 1
+        endpoint.healthy = False
+        endpoint.last_error = str(error)
+        logger.warning(f"Endpoint LLM {endpoint.url} falló, se marca como no disponible: {str(error)}")
+
+    async def ainvoke(self, prompt: Any, max_tokens: int = None) -> str:
+        """Genera la respuesta completa, reintentando en otro endpoint si el elegido falla"""
+        tried = set()
+        last_error = None
+        while True:
+            endpoint = self._acquire(tried)
+            if endpoint is None:
+                raise RuntimeError(f"Ningún endpoint LLM respondió: {last_error}")
+            tried.add(endpoint.url)
+            try:
+                return await endpoint.llm(max_tokens).ainvoke(prompt)
+            except Exception as e:
+                if not is_endpoint_failure(e):
+                    raise
+                last_error = e
+                self._mark_failure(endpoint, e)
+            finally:
+                self._release(endpoint)
+
+    async def astream(self, prompt: Any, max_tokens: int = None) -> AsyncIterator[str]:
+        """Genera la respuesta token a token; solo reintenta si aún no se emitió ningún token"""
+        tried = set()
+        last_error = None
+        while True:
+            endpoint = self._acquire(tried)
+            if endpoint is None:
+                raise RuntimeError(f"Ningún endpoint LLM respondió: {last_error}")
+            tried.add(endpoint.url)
+            emitted = False
+            try:
+                async for chunk in endpoint.llm(max_tokens).astream(prompt):
+                    token = _chunk_text(chunk)
+                    if token is None:
+                        continue
+                    emitted = True
+                    yield token
+                return
+            except Exception as e:
+                if not is_endpoint_failure(e):
+                    raise
+                self._mark_failure(endpoint, e)
+                if emitted:
+                    raise
+                last_error = e
+            finally:
+                self._release(endpoint)
+
+    def status(self) -> List[Dict]:
+        return [endpoint.status() for endpoint in self.endpoints]
@@ -2,31 +2,35 @@ import os
 import logging
 import time
 import subprocess
-from langchain_ollama import OllamaLLM
+from django.conf import settings
 from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
 
+from .llm_router import LLMRouter, DEFAULT_OLLAMA_URL
+
 logger = logging.getLogger(__name__)
 
 class LLMService:
-    def __init__(self, model_name="llama3.2", temperature=0.0):
+    def __init__(self, model_name="llama3.2", temperature=0.0, endpoints=None):
         self.model_name = model_name
         self.temperature = temperature
+        self.endpoints = endpoints or getattr(settings, 'CHATBOT_LLM_ENDPOINTS', [{'url': DEFAULT_OLLAMA_URL}])
         self.llm = None
+        self.router = None
 
-    def _check_ollama_running(self):
+    def _check_ollama_running(self, base_url=DEFAULT_OLLAMA_URL):
         """Verifica si Ollama está corriendo y disponible"""
         try:
             import requests
-            response = requests.get("http://localhost:11434/api/version", timeout=5)
+            response = requests.get(f"{base_url}/api/version", timeout=5)
             return response.status_code == 200
         except:
             return False
 
-    def _check_model_available(self):
+    def _check_model_available(self, base_url=DEFAULT_OLLAMA_URL):
         """Verifica si el modelo requerido está disponible en Ollama"""
         try:
             import requests
-            response = requests.get("http://localhost:11434/api/tags", timeout=5)
+            response = requests.get(f"{base_url}/api/tags", timeout=5)
             if response.status_code == 200:
                 models = response.json().get("models", [])
                 return any(model["name"] == self.model_name for model in models)
@@ -52,15 +56,17 @@ class LLMService:
             logger.error(f"Error al iniciar Ollama: {str(e)}")
             return False
 
-    def _pull_model(self):
+    def _pull_model(self, base_url=DEFAULT_OLLAMA_URL):
         """Intenta descargar el modelo si no está disponible"""
-        logger.info(f"Descargando modelo {self.model_name}...")
+        logger.info(f"Descargando modelo {self.model_name} en {base_url}...")
         try:
             process = subprocess.Popen(
                 ["ollama", "pull", self.model_name],
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
-                text=True
+                text=True,
+                # El cliente de Ollama usa OLLAMA_HOST para elegir la instancia
+                env={**os.environ, 'OLLAMA_HOST': base_url}
             )
             stdout, stderr = process.communicate()
             if process.returncode == 0:
@@ -73,31 +79,38 @@ class LLMService:
             logger.error(f"Error al descargar modelo: {str(e)}")
             return False
 
-    def initialize(self):
-        try:
-            logger.info(f"Inicializando modelo LLM: {self.model_name}")
+    def _prepare_endpoint(self, base_url):
+        """Comprueba (y si es local, arranca) la instancia y descarga el modelo si falta"""
+        if not self._check_ollama_running(base_url):
+            if base_url.rstrip('/') != DEFAULT_OLLAMA_URL:
+                logger.error(f"Endpoint LLM {base_url} no responde")
+                return False
+            logger.warning("Ollama no está corriendo. Intentando iniciarlo...")
+            if not self._start_ollama():
+                logger.error("No se pudo iniciar Ollama. Asegúrate de que esté instalado.")
+                return False
 
-            # Verificar si Ollama está corriendo
-            if not self._check_ollama_running():
-                logger.warning("Ollama no está corriendo. Intentando iniciarlo...")
-                if not self._start_ollama():
-                    logger.error("No se pudo iniciar Ollama. Asegúrate de que esté instalado.")
-                    return False
+        # Verificar si el modelo está disponible
+        if not self._check_model_available(base_url):
+            logger.warning(f"Modelo {self.model_name} no encontrado en {base_url}. Intentando descargarlo...")
+            if not self._pull_model(base_url):
+                logger.error(f"No se pudo descargar el modelo {self.model_name} en {base_url}")
+                return False
+        return True
 
-            # Verificar si el modelo está disponible
-            if not self._check_model_available():
-                logger.warning(f"Modelo {self.model_name} no encontrado. Intentando descargarlo...")
-                if not self._pull_model():
-                    logger.error(f"No se pudo descargar el modelo {self.model_name}")
-                    return False
+    def initialize(self):
+        try:
+            logger.info(f"Inicializando modelo LLM: {self.model_name} en {len(self.endpoints)} endpoint(s)")
 
-            # Configurar el modelo
-            self.llm = OllamaLLM(
-                model=self.model_name,
-                temperature=self.temperature,
-                streaming=True,  # Make sure streaming is enabled
-                base_url="http://localhost:11434"
-            )
+            # Configurar el router; los endpoints que no estén listos arrancan como no disponibles
+            self.router = LLMRouter(self.model_name, self.temperature, self.endpoints)
+            for endpoint in self.router.endpoints:
+                endpoint.healthy = self._prepare_endpoint(endpoint.url)
+            ready = [endpoint for endpoint in self.router.endpoints if endpoint.healthy]
+            if not ready:
+                logger.error("Ningún endpoint LLM está disponible")
+                return False
+            self.llm = ready[0].llm()
 
             # Realizar una prueba rápida para verificar que funcione
             try:
@@ -107,7 +120,8 @@ class LLMService:
                 logger.error(f"Error en prueba del modelo: {str(e)}")
                 return False
 
-            logger.info("Modelo LLM inicializado correctamente")
+            self.router.start_health_checks()
+            logger.info(f"Modelo LLM inicializado correctamente ({len(ready)} endpoint(s) disponibles)")
             return True
         except Exception as e:
             logger.error(f"Error inicializando modelo LLM: {str(e)}")
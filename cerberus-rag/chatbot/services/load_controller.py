@@ -0,0 +1,141 @@
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import Dict
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Escalones de degradación, de la respuesta completa a la búsqueda por palabras clave
+TIERS = [
+    {'name': 'full', 'candidates': 10, 'rerank': True, 'max_tokens': None, 'cache_only': False, 'keyword_only': False},
+    {'name': 'reduced', 'candidates': 5, 'rerank': True, 'max_tokens': None, 'cache_only': False, 'keyword_only': False},
+    {'name': 'no_rerank', 'candidates': 5, 'rerank': False, 'max_tokens': None, 'cache_only': False, 'keyword_only': False},
+    {'name': 'short', 'candidates': 5, 'rerank': False, 'max_tokens': 256, 'cache_only': False, 'keyword_only': False},
+    {'name': 'cached', 'candidates': 5, 'rerank': False, 'max_tokens': 256, 'cache_only': True, 'keyword_only': False},
+    {'name': 'keyword', 'candidates': 5, 'rerank': False, 'max_tokens': 256, 'cache_only': True, 'keyword_only': True},
+]
+
+
+class LoadController:
+    """
+    Controlador de sobrecarga con escalones de degradación.
+
+    Observa tres señales: consultas en curso, retraso del event loop (medido
+    por una tarea que duerme un intervalo fijo y mide cuánto se pasa) y la
+    latencia media de generación del LLM. Cada señal se divide por su
+    presupuesto; la presión es la mayor de ellas. Con presión >= 1 se baja un
+    escalón cada `step_interval` segundos; con presión < `recover_ratio`
+    durante `cooldown` segundos se sube uno.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """Implementación Singleton: un único controlador por proceso"""
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, enabled: bool = None, max_inflight: int = None, lag_budget: float = None,
+                 generation_budget: float = None, step_interval: float = 2.0, cooldown: float = None,
+                 recover_ratio: float = 0.5, probe_interval: float = 0.25):
+        self.enabled = getattr(settings, 'CHATBOT_LOAD_ENABLED', True) if enabled is None else enabled
+        self.max_inflight = max_inflight or getattr(settings, 'CHATBOT_LOAD_MAX_INFLIGHT', 8)
+        self.lag_budget = lag_budget or getattr(settings, 'CHATBOT_LOAD_LAG_BUDGET', 0.1)
+        self.generation_budget = generation_budget or getattr(settings, 'CHATBOT_LOAD_GENERATION_BUDGET', 15.0)
+        self.short_max_tokens = getattr(settings, 'CHATBOT_LOAD_SHORT_MAX_TOKENS', 256)
+        self.step_interval = step_interval
+        self.cooldown = cooldown or getattr(settings, 'CHATBOT_LOAD_COOLDOWN', 10.0)
+        self.recover_ratio = recover_ratio
+        self.probe_interval = probe_interval
+
+        self.tier = 0
+        self.inflight = 0
+        self.loop_lag = 0.0
+        self.generation_latency = 0.0
+        self._last_change = time.monotonic()
+        self._last_generation = 0.0
+        self._monitor = None
+        self.stats = defaultdict(int)
+
+    def _ensure_monitor(self):
+        if self._monitor is None or self._monitor.done():
+            self._monitor = asyncio.get_running_loop().create_task(self._probe_loop())
+
+    async def _probe_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.probe_interval)
+            lag = max(loop.time() - start - self.probe_interval, 0.0)
+            # Media exponencial: un pico aislado no cambia de escalón
+            self.loop_lag = 0.8 * self.loop_lag + 0.2 * lag
+            # En los escalones sin LLM no hay nuevas mediciones: la latencia se olvida poco a poco
+            if time.monotonic() - self._last_generation > self.cooldown:
+                self.generation_latency *= 0.9
+            self.evaluate()
+
+    def record_generation(self, seconds: float):
+        self._last_generation = time.monotonic()
+        self.generation_latency = 0.7 * self.generation_latency + 0.3 * seconds if self.generation_latency else seconds
+
+    @property
+    def pressure(self) -> float:
+        return max(
+            self.inflight / self.max_inflight,
+            self.loop_lag / self.lag_budget,
+            self.generation_latency / self.generation_budget
+        )
+
+    def evaluate(self) -> int:
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        pressure = self.pressure
+        if pressure >= 1.0 and self.tier < len(TIERS) - 1 and now - self._last_change >= self.step_interval:
+            self._set_tier(self.tier + 1, pressure, now)
+        elif pressure < self.recover_ratio and self.tier > 0 and now - self._last_change >= self.cooldown:
+            self._set_tier(self.tier - 1, pressure, now)
+        return self.tier
+
+    def _set_tier(self, tier: int, pressure: float, now: float):
+        direction = "Degradando" if tier > self.tier else "Recuperando"
+        logger.warning(f"{direction} servicio: {TIERS[self.tier]['name']} -> {TIERS[tier]['name']} "
+                       f"(presión {pressure:.2f})")
+        self.stats['transitions'] += 1
+        self.tier = tier
+        self._last_change = now
+
+    def profile(self) -> Dict:
+        """Parámetros del escalón actual (candidatos, rerank, max_tokens, modos de respaldo)"""
+        profile = dict(TIERS[self.tier])
+        if profile['max_tokens']:
+            profile['max_tokens'] = self.short_max_tokens
+        return profile
+
+    @asynccontextmanager
+    async def track(self):
+        """Cuenta la consulta como en curso y devuelve el perfil con el que debe atenderse"""
+        self._ensure_monitor()
+        self.inflight += 1
+        try:
+            self.evaluate()
+            profile = self.profile()
+            self.stats[f"requests_{profile['name']}"] += 1
+            yield profile
+        finally:
+            self.inflight -= 1
+
+    def metrics(self) -> Dict:
+        return {
+            'tier': TIERS[self.tier]['name'],
+            'tier_level': self.tier,
+            'pressure': round(self.pressure, 3),
+            'inflight': self.inflight,
+            'loop_lag_ms': round(self.loop_lag * 1000, 1),
+            'generation_latency_s': round(self.generation_latency, 2),
+            **self.stats
+        }
@@ -0,0 +1,203 @@
+import atexit
+import asyncio
+import logging
+import threading
+from typing import Dict, List
+from django.conf import settings
+from django.db import DatabaseError, InterfaceError, OperationalError, close_old_connections, transaction
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+
+from ..models import Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+class MessageWriter:
+    """
+    Persistencia write-behind de conversaciones y mensajes.
+
+    Los objetos se construyen en memoria con su UUID asignado de antemano y se
+    encolan; una tarea en segundo plano los escribe por lotes con `bulk_create`
+    cada `flush_interval` segundos (o antes, al llegar a `batch_size`). Las
+    conversaciones nuevas se insertan y las existentes solo se actualizan, así
+    que una conversación borrada o archivada mientras esperaba no se recrea: sus
+    mensajes se descartan con un aviso.
+
+    Si la base de datos no está disponible el lote se reencola completo y se
+    reintenta. Si la rechaza por su contenido, se escribe por partes y solo se
+    descartan (y registran) las filas inválidas, para que no bloqueen a las demás.
+
+    Ventana de pérdida: al cerrar el proceso se vacía la cola, pero un SIGKILL
+    o un OOM pierden lo aceptado y aún no escrito, en funcionamiento normal los
+    últimos `flush_interval` segundos (0.5 s por defecto); mientras la base de
+    datos esté caída la ventana crece hasta que vuelva.
+    """
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """Implementación Singleton compartida por las vistas y el consumer"""
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self, flush_interval: float = None, batch_size: int = None, retry_delay: float = 1.0):
+        self.flush_interval = flush_interval or getattr(settings, 'CHATBOT_WRITE_BEHIND_INTERVAL', 0.5)
+        self.batch_size = batch_size or getattr(settings, 'CHATBOT_WRITE_BEHIND_BATCH_SIZE', 200)
+        self.retry_delay = retry_delay
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._conversations: Dict[str, Conversation] = {}
+        self._messages: List[Message] = []
+        self._task = None
+        self._wakeup = None
+        atexit.register(self.flush_sync)
+
+    @property
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._conversations) + len(self._messages)
+
+    def add_conversation(self, conversation: Conversation):
+        """Encola la creación o el `touch` (updated_at) de una conversación"""
+        with self._lock:
+            self._conversations[str(conversation.id)] = conversation
+        self._schedule()
+
+    def add_message(self, message: Message):
+        """Encola un mensaje; su conversación se marca como actualizada"""
+        with self._lock:
+            self._messages.append(message)
+            self._conversations.setdefault(str(message.conversation_id), message.conversation)
+        self._schedule()
+
+    def has_pending_conversation(self, conversation_id) -> bool:
+        with self._lock:
+            return str(conversation_id) in self._conversations
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Fuera de un event loop (comandos, hilos): escritura inmediata
+            self.flush_sync()
+            return
+
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = loop.create_task(self._run())
+        if self.pending_count >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error escribiendo lote de mensajes, se reintentará: {str(e)}")
+                await asyncio.sleep(self.retry_delay)
+
+    async def flush(self):
+        """Escribe todo lo pendiente; sirve de barrera antes de leer de la base de datos"""
+        if self.pending_count:
+            # Fuera del hilo compartido: la escritura no bloquea las lecturas de otras peticiones
+            await sync_to_async(self._flush_pending, thread_sensitive=False)()
+
+    def flush_sync(self):
+        try:
+            self._flush_pending()
+        except Exception as e:
+            logger.error(f"Error vaciando la cola de mensajes: {str(e)}")
+
+    def _take_batch(self):
+        with self._lock:
+            conversations = list(self._conversations.values())
+            messages = self._messages
+            self._conversations = {}
+            self._messages = []
+        return conversations, messages
+
+    def _requeue(self, conversations: List[Conversation], messages: List[Message]):
+        with self._lock:
+            for conversation in conversations:
+                self._conversations.setdefault(str(conversation.id), conversation)
+            self._messages = messages + self._messages
+
+    def _flush_pending(self):
+        with self._write_lock:
+            conversations, messages = self._take_batch()
+            if not conversations and not messages:
+                return
+            try:
+                self._write(conversations, messages)
+            except (OperationalError, InterfaceError):
+                # Base de datos no disponible: se reintenta el lote completo
+                self._requeue(conversations, messages)
+                raise
+            except DatabaseError as e:
+                logger.warning(f"Lote de mensajes rechazado, se escribe por partes: {str(e)}")
+                self._write_isolating(conversations, messages)
+            finally:
+                close_old_connections()
+            logger.debug(f"Escritos {len(conversations)} conversaciones y {len(messages)} mensajes")
+
+    def _write(self, conversations: List[Conversation], messages: List[Message]):
+        new = [conversation for conversation in conversations if conversation._state.adding]
+        touched = [conversation.id for conversation in conversations if not conversation._state.adding]
+        try:
+            with transaction.atomic():
+                Conversation.objects.bulk_create(new)
+                if touched:
+                    Conversation.objects.filter(id__in=touched).update(updated_at=timezone.now())
+                if messages:
+                    # Las conversaciones borradas o archivadas desde que se encoló el mensaje no se recrean
+                    live = set(Conversation.objects.filter(
+                        id__in={message.conversation_id for message in messages}
+                    ).values_list('id', flat=True))
+                    orphans = [message for message in messages if message.conversation_id not in live]
+                    if orphans:
+                        messages = [message for message in messages if message.conversation_id in live]
+                        logger.warning(
+                            f"Descartados {len(orphans)} mensajes de conversaciones que ya no existen: "
+                            f"{sorted({str(message.conversation_id) for message in orphans})}"
+                        )
+                    Message.objects.bulk_create(messages, batch_size=self.batch_size)
+        except Exception:
+            # bulk_create las marca como guardadas aunque la transacción se deshaga
+            for conversation in new:
+                conversation._state.adding = True
+            raise
+
+    def _write_isolating(self, conversations: List[Conversation], messages: List[Message]):
+        """Escribe fila a fila (conversaciones) o por bisección (mensajes), descartando las que fallen"""
+        rejected = set()
+        for conversation in conversations:
+            try:
+                self._write([conversation], [])
+            except (OperationalError, InterfaceError):
+                raise
+            except DatabaseError as e:
+                rejected.add(conversation.id)
+                logger.error(f"Conversación {conversation.id} descartada: {str(e)}")
+        self._write_messages([message for message in messages if message.conversation_id not in rejected])
+
+    def _write_messages(self, messages: List[Message]):
+        if not messages:
+            return
+        try:
+            self._write([], messages)
+        except (OperationalError, InterfaceError):
+            raise
+        except DatabaseError as e:
+            if len(messages) == 1:
+                logger.error(f"Mensaje {messages[0].id} de la conversación {messages[0].conversation_id} descartado: {str(e)}")
+                return
+            middle = len(messages) // 2
+            self._write_messages(messages[:middle])
+            self._write_messages(messages[middle:])
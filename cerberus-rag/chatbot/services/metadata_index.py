@@ -0,0 +1,225 @@
+import os
+import re
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from langchain.schema import Document
+
+from .text_analysis import fold_accents
+from .deduplication import chunk_sources
+from .chunk_store import ChunkStore
+
+DOCUMENT_TYPES = (
+    'reglamento', 'convocatoria', 'acuerdo', 'resolucion', 'circular',
+    'estatuto', 'guia', 'manual', 'instructivo', 'calendario'
+)
+DEFAULT_DOCUMENT_TYPE = 'documento'
+
+_SEPARATORS = re.compile(r"[\W_]+", re.UNICODE)
+
+FILTER_KEYS = ('source', 'page', 'doc_type', 'ingested_after', 'ingested_before')
+
+
+class InvalidFilterError(ValueError):
+    """Filtro de metadatos explícito mal formado o que no corresponde a ningún documento del índice"""
+
+
+def _fold(text: str) -> str:
+    return ' '.join(_SEPARATORS.sub(' ', fold_accents(text.lower())).split())
+
+
+def infer_document_type(source: str) -> str:
+    """Tipo de documento a partir de la ruta del PDF (nombre del fichero o de su carpeta)"""
+    folded = _fold(source or "")
+    for doc_type in DOCUMENT_TYPES:
+        if re.search(rf"\b{doc_type}", folded):
+            return doc_type
+    return DEFAULT_DOCUMENT_TYPE
+
+
+def _as_list(value) -> list:
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def _page_range(page) -> Tuple[int, int]:
+    pages = _as_list(page)
+    if not 1 <= len(pages) <= 2 or not all(isinstance(value, int) and not isinstance(value, bool) for value in pages):
+        raise InvalidFilterError(f"Página no válida: {page!r} (número o rango [inicio, fin])")
+    start, end = pages[0], pages[-1]
+    if start < 1 or end < start:
+        raise InvalidFilterError(f"Página no válida: {page!r}")
+    return start, end
+
+
+def _parse_date(key: str, value) -> date:
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise InvalidFilterError(f"Fecha no válida en {key}: {value!r} (formato YYYY-MM-DD)")
+
+
+def validate_filters(filters) -> None:
+    """
+    Comprueba la forma de un filtro explícito (claves, páginas, tipos y fechas)
+    sin consultar el índice; MetadataIndex.validate además exige que los
+    documentos citados existan
+
+    Raises:
+        InvalidFilterError: Si el filtro no es válido
+    """
+    if filters is None:
+        return
+    if not isinstance(filters, dict):
+        raise InvalidFilterError("El filtro debe ser un objeto")
+    unknown = sorted(set(filters) - set(FILTER_KEYS))
+    if unknown:
+        raise InvalidFilterError(f"Campos de filtro desconocidos: {', '.join(unknown)}")
+    if filters.get('page') is not None:
+        _page_range(filters['page'])
+    for doc_type in _as_list(filters.get('doc_type') or []):
+        if doc_type not in DOCUMENT_TYPES and doc_type != DEFAULT_DOCUMENT_TYPE:
+            raise InvalidFilterError(f"Tipo de documento desconocido: {doc_type!r}")
+    for key in ('ingested_after', 'ingested_before'):
+        if filters.get(key) is not None:
+            _parse_date(key, filters[key])
+
+
+def format_sources(documents: List[Document]) -> List[Dict]:
+    """Fichero y página (desde 1) de los chunks usados, sin repeticiones y en orden de relevancia"""
+    seen = set()
+    sources = []
+    for doc in documents:
+        for ref in chunk_sources(doc):
+            name = os.path.basename(ref.get('source') or "")
+            page = ref['page'] + 1 if isinstance(ref.get('page'), int) else None
+            if (name, page) not in seen:
+                seen.add((name, page))
+                sources.append({'source': name, 'page': page})
+    return sources
+
+
+class MetadataIndex:
+    """
+    Índice columnar de los metadatos de cada chunk: fichero, página, tipo de
+    documento y fecha de ingesta.
+
+    `select` traduce un filtro a la lista de ids de chunk permitidos, que los
+    recuperadores usan antes de puntuar (Chroma con un `where` sobre `chunk_id`,
+    BM25L y la búsqueda por palabras clave descartando postings, TF-IDF
+    multiplicando solo las filas permitidas).
+
+    Filtros admitidos:
+        source: nombre del PDF (con o sin extensión) o lista de nombres
+        page: página (desde 1) o rango [inicio, fin]
+        doc_type: tipo de documento o lista de tipos (ver DOCUMENT_TYPES)
+        ingested_after / ingested_before: fechas ISO (YYYY-MM-DD) de ingesta
+
+    Un filtro explícito que no es válido o cita un documento que no está en el
+    índice lanza InvalidFilterError en vez de devolver un contexto vacío.
+    """
+
+    def __init__(self, chunks: ChunkStore):
+        self.num_docs = len(chunks)
+        self.source_names: List[str] = []
+        source_codes: Dict[str, int] = {}
+        self.doc_types: List[str] = []
+        type_codes: Dict[str, int] = {}
+
+        # Una fila por entrada de la tabla de metadatos internados; luego se expande a cada chunk
+        sources, pages, types, ingested = [], [], [], []
+        for metadata in chunks.metadata_table:
+            name = os.path.basename(metadata.get('source') or "")
+            if name not in source_codes:
+                source_codes[name] = len(self.source_names)
+                self.source_names.append(name)
+            sources.append(source_codes[name])
+
+            page = metadata.get('page')
+            pages.append(page + 1 if isinstance(page, int) else 0)
+
+            doc_type = metadata.get('doc_type') or infer_document_type(metadata.get('source'))
+            if doc_type not in type_codes:
+                type_codes[doc_type] = len(self.doc_types)
+                self.doc_types.append(doc_type)
+            types.append(type_codes[doc_type])
+
+            ingested_at = metadata.get('ingested_at')
+            ingested.append(date.fromisoformat(ingested_at).toordinal() if ingested_at else 0)
+
+        rows = chunks.metadata_ids
+        self.sources = np.asarray(sources, dtype=np.int32)[rows]
+        self.pages = np.asarray(pages, dtype=np.int32)[rows]
+        self.types = np.asarray(types, dtype=np.int16)[rows]
+        self.ingested = np.asarray(ingested, dtype=np.int32)[rows]
+        self._source_keys = {_fold(os.path.splitext(name)[0]): code for name, code in source_codes.items() if name}
+
+    def _source_codes(self, values) -> List[int]:
+        codes = []
+        for value in _as_list(values):
+            key = _fold(os.path.splitext(os.path.basename(str(value)))[0])
+            if key not in self._source_keys:
+                raise InvalidFilterError(f"Documento desconocido: {value!r}")
+            codes.append(self._source_keys[key])
+        return codes
+
+    def validate(self, filters) -> None:
+        """validate_filters más la comprobación de que los documentos citados están en el índice"""
+        validate_filters(filters)
+        if filters and filters.get('source'):
+            self._source_codes(filters['source'])
+
+    def select(self, filters: Optional[Dict]) -> Optional[np.ndarray]:
+        """
+        Ids de los chunks que cumplen el filtro
+
+        Returns:
+            Optional[np.ndarray]: Ids ordenados, o None si no hay filtro (todo el corpus)
+
+        Raises:
+            InvalidFilterError: Si el filtro no es válido (ver `validate`)
+        """
+        if not filters:
+            return None
+        validate_filters(filters)
+        mask = np.ones(self.num_docs, dtype=bool)
+
+        if filters.get('source'):
+            mask &= np.isin(self.sources, self._source_codes(filters['source']))
+
+        if filters.get('page') is not None:
+            start, end = _page_range(filters['page'])
+            mask &= (self.pages >= start) & (self.pages <= end)
+
+        if filters.get('doc_type'):
+            # Un tipo válido sin documentos en este corpus deja el contexto vacío
+            codes = [self.doc_types.index(value) for value in _as_list(filters['doc_type']) if value in self.doc_types]
+            mask &= np.isin(self.types, codes)
+
+        if filters.get('ingested_after'):
+            mask &= self.ingested >= _parse_date('ingested_after', filters['ingested_after']).toordinal()
+        if filters.get('ingested_before'):
+            mask &= self.ingested <= _parse_date('ingested_before', filters['ingested_before']).toordinal()
+
+        return np.flatnonzero(mask).astype(np.int32)
+
+    def detect_filters(self, query: str) -> Dict:
+        """
+        Filtro implícito en la consulta: documentos citados por su nombre o, si
+        no hay ninguno, el tipo de documento mencionado (p. ej. "el reglamento")
+        """
+        folded = f" {_fold(query)} "
+        sources = [
+            self.source_names[code] for key, code in self._source_keys.items()
+            if len(key) >= 4 and f" {key} " in folded
+        ]
+        if sources:
+            return {'source': sources}
+
+        if len(self.doc_types) > 1:
+            mentioned = [
+                doc_type for doc_type in self.doc_types
+                if doc_type != DEFAULT_DOCUMENT_TYPE and re.search(rf"\b{doc_type}(e?s)?\b", folded)
+            ]
+            if mentioned:
+                return {'doc_type': mentioned}
+        return {}
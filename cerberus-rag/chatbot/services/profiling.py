@@ -0,0 +1,272 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import tracemalloc
+from collections import Counter, OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Dict, List
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _format_frame(frame) -> str:
+    code = frame.f_code
+    # Formato de pila plegada (flamegraph.pl, speedscope): ';' separa los marcos
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})".replace(';', ':')
+
+
+def _collapse_stack(frame, max_depth: int = 128) -> List[str]:
+    stack = []
+    while frame is not None and len(stack) < max_depth:
+        stack.append(_format_frame(frame))
+        frame = frame.f_back
+    return list(reversed(stack))
+
+
+class SamplingProfiler:
+    """
+    Profiler por muestreo del proceso mientras se atienden las próximas N peticiones de chat.
+
+    Mientras haya alguna petición perfilada en curso, un hilo toma cada
+    `interval` segundos la pila de todos los hilos (sys._current_frames) y
+    acumula las pilas plegadas, descargables para flamegraph.pl o speedscope.
+
+    El perfil es de todo el proceso, no solo de las peticiones perfiladas: el
+    event loop y los pools de hilos son compartidos y una pila no dice a qué
+    petición pertenece, así que también aparece el trabajo de las peticiones
+    que coinciden en el tiempo. `overlapping_requests` cuenta esas peticiones
+    para saber cuánto ruido contiene el perfil; con un solo perfilado en un
+    proceso sin más tráfico el perfil es el de esas peticiones.
+    Sin perfilado armado, `request()` solo comprueba dos contadores.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = Counter()
+        self.profiled_requests = 0
+        self.overlapping_requests = 0
+        self._remaining = 0
+        self._active = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def arm(self, requests: int, interval: float = None):
+        with self._lock:
+            self.samples = Counter()
+            self.profiled_requests = 0
+            self.overlapping_requests = 0
+            self._remaining = requests
+            if interval:
+                self.interval = interval
+
+    @asynccontextmanager
+    async def request(self, name: str = 'chat'):
+        if not self._remaining and not self._active:
+            yield
+            return
+        with self._lock:
+            profiled = self._remaining > 0
+            if profiled:
+                self._remaining -= 1
+                self._active += 1
+                self.profiled_requests += 1
+                self._ensure_thread()
+            elif self._active:
+                # Su trabajo también aparece en las muestras (ver el docstring de la clase)
+                self.overlapping_requests += 1
+        try:
+            yield
+        finally:
+            if profiled:
+                with self._lock:
+                    self._active -= 1
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._sample_loop, name='chatbot-profiler', daemon=True)
+            self._thread.start()
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._active and not self._remaining:
+                    self._thread = None
+                    return
+                active = self._active
+            if active:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    # Los hilos de diagnóstico solo añadirían ruido a la gráfica
+                    if thread_id == own_id or names.get(thread_id) == 'loop-lag-watchdog':
+                        continue
+                    stack = ';'.join([names.get(thread_id, str(thread_id))] + _collapse_stack(frame))
+                    self.samples[stack] += 1
+            time.sleep(self.interval)
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+    def status(self) -> Dict:
+        return {
+            'remaining_requests': self._remaining,
+            'active_requests': self._active,
+            'profiled_requests': self.profiled_requests,
+            'overlapping_requests': self.overlapping_requests,
+            'scope': 'process',
+            'samples': sum(self.samples.values()),
+            'interval_ms': self.interval * 1000
+        }
+
+
+class MemoryTracker:
+    """Instantáneas de tracemalloc y diferencias entre ellas, para seguir el crecimiento de memoria"""
+
+    def __init__(self, max_snapshots: int = 10):
+        self.max_snapshots = max_snapshots
+        self.snapshots: "OrderedDict[int, tracemalloc.Snapshot]" = OrderedDict()
+        self._next_id = 1
+
+    def start(self, frames: int = 25):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def stop(self):
+        tracemalloc.stop()
+        self.snapshots.clear()
+
+    def snapshot(self) -> Dict:
+        self.start()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        snapshot_id = self._next_id
+        self._next_id += 1
+        self.snapshots[snapshot_id] = snapshot
+        while len(self.snapshots) > self.max_snapshots:
+            self.snapshots.popitem(last=False)
+        current, peak = tracemalloc.get_traced_memory()
+        return {'id': snapshot_id, 'traced_mb': round(current / 2**20, 2), 'peak_mb': round(peak / 2**20, 2)}
+
+    def _stats(self, stats, limit: int) -> List[Dict]:
+        return [
+            {
+                'location': str(stat.traceback[0]) if stat.traceback else "",
+                'size_kb': round(stat.size / 1024, 1),
+                'size_diff_kb': round(getattr(stat, 'size_diff', stat.size) / 1024, 1),
+                'count': stat.count,
+                'count_diff': getattr(stat, 'count_diff', stat.count),
+            }
+            for stat in stats[:limit]
+        ]
+
+    def top(self, snapshot_id: int, limit: int = 20, group_by: str = 'lineno') -> List[Dict]:
+        return self._stats(self.snapshots[snapshot_id].statistics(group_by), limit)
+
+    def diff(self, from_id: int, to_id: int, limit: int = 20, group_by: str = 'lineno') -> List[Dict]:
+        """Ubicaciones que más crecieron entre dos instantáneas"""
+        stats = self.snapshots[to_id].compare_to(self.snapshots[from_id], group_by)
+        return self._stats(stats, limit)
+
+
+class LoopLagMonitor:
+    """
+    Detecta bloqueos del event loop y registra qué código los causó.
+
+    Una tarea del loop actualiza un latido cada `interval` segundos; un hilo
+    vigilante comprueba el latido y, si lleva más de `threshold` segundos sin
+    actualizarse, captura la pila del hilo del loop (p. ej. un `predict` o un
+    `invoke` síncrono) y la registra una vez por episodio de bloqueo.
+    """
+
+    def __init__(self, threshold: float = None, interval: float = 0.05, max_events: int = 100):
+        self.threshold = threshold if threshold is not None else getattr(settings, 'CHATBOT_LOOP_LAG_THRESHOLD', 0.2)
+        self.interval = interval
+        self.events = deque(maxlen=max_events)
+        self._loop = None
+        self._loop_thread = None
+        self._beat = time.monotonic()
+        self._watchdog = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def ensure_started(self):
+        if not self.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        loop.create_task(self._heartbeat(loop))
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name='loop-lag-watchdog', daemon=True)
+            self._watchdog.start()
+
+    async def _heartbeat(self, loop):
+        try:
+            while self._loop is loop:
+                self._beat = time.monotonic()
+                await asyncio.sleep(self.interval)
+        finally:
+            # Loop cerrado o tarea cancelada: sin latido no hay nada que vigilar
+            if self._loop is loop:
+                self._loop = None
+
+    def _watch(self):
+        reported = False
+        while True:
+            time.sleep(self.interval)
+            blocked = time.monotonic() - self._beat - self.interval
+            if self._loop is None or blocked < self.threshold:
+                reported = False
+                continue
+            if reported:
+                # Mismo episodio: solo se actualiza la duración
+                self.events[-1]['blocked_ms'] = round(blocked * 1000, 1)
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            stack = _collapse_stack(frame)[-12:] if frame is not None else []
+            self.events.append({'at': time.time(), 'blocked_ms': round(blocked * 1000, 1), 'stack': stack})
+            reported = True
+            logger.warning(f"Event loop bloqueado {blocked * 1000:.0f} ms en: {stack[-1] if stack else '?'}\n  "
+                           + "\n  ".join(stack))
+
+    def status(self) -> Dict:
+        return {
+            'enabled': self.enabled,
+            'threshold_ms': self.threshold * 1000,
+            'events': list(self.events)
+        }
+
+
+class ProfilingService:
+    """Punto de acceso único a las herramientas de diagnóstico del proceso"""
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        """Implementación Singleton: el estado del perfilado es por proceso"""
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.sampler = SamplingProfiler()
+        self.memory = MemoryTracker()
+        self.loop_monitor = LoopLagMonitor()
+
+    @asynccontextmanager
+    async def request(self, name: str = 'chat'):
+        """Envuelve una petición de chat: arranca el vigilante del loop y la cuenta para el muestreo"""
+        self.loop_monitor.ensure_started()
+        async with self.sampler.request(name):
+            yield
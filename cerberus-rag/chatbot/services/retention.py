@@ -0,0 +1,210 @@
+import os
+import gzip
+import json
+import time
+import logging
+from datetime import timedelta
+from typing import Dict, List, Optional
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ..models import Conversation, Message, Feedback, ArchivedConversation
+
+logger = logging.getLogger(__name__)
+
+class RetentionService:
+    """
+    Archiva conversaciones inactivas en ficheros comprimidos por mes y las
+    elimina de las tablas principales.
+
+    Cada conversación se escribe como un miembro gzip independiente al final del
+    fichero del mes; `ArchivedConversation` guarda su desplazamiento y longitud,
+    de modo que restaurar una conversación solo lee y descomprime ese miembro.
+    """
+
+    def __init__(self, archive_dir: str = None, retention_days: int = None):
+        self.archive_dir = str(archive_dir or getattr(settings, 'CHATBOT_ARCHIVE_DIR', settings.BASE_DIR / 'archive'))
+        self.retention_days = retention_days or getattr(settings, 'CHATBOT_RETENTION_DAYS', 90)
+
+    def _archive_path(self, month: str) -> str:
+        return os.path.join(self.archive_dir, f"conversations-{month}.jsonl.gz")
+
+    def _serialize(self, conversation: Conversation) -> Dict:
+        messages = []
+        for message in conversation.messages.all():
+            messages.append({
+                'id': str(message.id),
+                'role': message.role,
+                'content': message.content,
+                'created_at': message.created_at.isoformat(),
+                'metadata': message.metadata,
+                'feedback': [
+                    {'rating': fb.rating, 'created_at': fb.created_at.isoformat()}
+                    for fb in message.feedback.all()
+                ]
+            })
+        return {
+            'id': str(conversation.id),
+            'user_id': conversation.user_id,
+            'session_id': conversation.session_id,
+            'created_at': conversation.created_at.isoformat(),
+            'updated_at': conversation.updated_at.isoformat(),
+            'messages': messages
+        }
+
+    def _append_members(self, month: str, records: List[Dict]) -> List[tuple]:
+        """Añade cada registro como miembro gzip y devuelve (offset, longitud) de cada uno"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        locations = []
+        with open(self._archive_path(month), 'ab') as f:
+            for record in records:
+                member = gzip.compress(json.dumps(record, ensure_ascii=False).encode('utf-8'))
+                offset = f.tell()
+                f.write(member)
+                locations.append((offset, len(member)))
+            f.flush()
+            os.fsync(f.fileno())
+        return locations
+
+    def archive_idle(self, days: int = None, batch_size: int = 100, dry_run: bool = False) -> int:
+        """
+        Archiva las conversaciones sin actividad en los últimos `days` días
+
+        Args:
+            days (int): Días de inactividad; por defecto CHATBOT_RETENTION_DAYS
+            batch_size (int): Conversaciones procesadas por transacción
+            dry_run (bool): Solo cuenta las conversaciones que se archivarían
+
+        Returns:
+            int: Número de conversaciones archivadas
+        """
+        cutoff = timezone.now() - timedelta(days=days or self.retention_days)
+        idle = Conversation.objects.filter(updated_at__lt=cutoff).order_by('updated_at')
+        if dry_run:
+            return idle.count()
+
+        archived = 0
+        while True:
+            batch = list(idle.prefetch_related('messages__feedback')[:batch_size])
+            if not batch:
+                break
+
+            by_month: Dict[str, List[Conversation]] = {}
+            for conversation in batch:
+                by_month.setdefault(conversation.updated_at.strftime('%Y-%m'), []).append(conversation)
+
+            # El fichero se escribe y sincroniza antes de borrar: un fallo intermedio
+            # deja como mucho un miembro huérfano, nunca una conversación perdida
+            entries = {}
+            for month, conversations in by_month.items():
+                records = [self._serialize(conv) for conv in conversations]
+                locations = self._append_members(month, records)
+                for conv, record, (offset, length) in zip(conversations, records, locations):
+                    entries[conv.id] = (conv.updated_at, ArchivedConversation(
+                        id=conv.id,
+                        user_id=conv.user_id,
+                        session_id=conv.session_id,
+                        created_at=conv.created_at,
+                        updated_at=conv.updated_at,
+                        messages_count=len(record['messages']),
+                        archive_month=month,
+                        offset=offset,
+                        length=length
+                    ))
+
+            with transaction.atomic():
+                # Las que recibieron mensajes mientras se serializaban siguen activas: su miembro
+                # en el fichero queda huérfano y no se borran
+                unchanged = [
+                    conversation_id for conversation_id, updated_at in Conversation.objects.select_for_update().filter(
+                        id__in=list(entries), updated_at__lt=cutoff
+                    ).values_list('id', 'updated_at')
+                    if updated_at == entries[conversation_id][0]
+                ]
+                ArchivedConversation.objects.bulk_create([entries[conversation_id][1] for conversation_id in unchanged])
+                Conversation.objects.filter(id__in=unchanged).delete()
+            if len(unchanged) < len(entries):
+                logger.info(f"{len(entries) - len(unchanged)} conversaciones con actividad reciente no se archivan")
+            archived += len(unchanged)
+
+        if archived:
+            logger.info(f"Conversaciones archivadas: {archived}")
+        return archived
+
+    def restore(self, conversation_id, **owner) -> Optional[Conversation]:
+        """
+        Devuelve a las tablas principales una conversación archivada, o None si no lo está
+
+        Args:
+            owner: Filtro de dueño (`user` o `session_id`); si no coincide no se restaura
+        """
+        entry = ArchivedConversation.objects.filter(id=conversation_id, **owner).first()
+        if entry is None:
+            return None
+
+        with open(self._archive_path(entry.archive_month), 'rb') as f:
+            f.seek(entry.offset)
+            record = json.loads(gzip.decompress(f.read(entry.length)).decode('utf-8'))
+
+        with transaction.atomic():
+            conversation = Conversation.objects.create(
+                id=record['id'],
+                user_id=record['user_id'],
+                session_id=record['session_id']
+            )
+            # update() no aplica auto_now_add: se conserva la fecha de creación. updated_at queda
+            # en el momento de la restauración, para que la retención no la archive de nuevo enseguida
+            Conversation.objects.filter(id=conversation.id).update(
+                created_at=parse_datetime(record['created_at'])
+            )
+            Message.objects.bulk_create([
+                Message(
+                    id=msg['id'],
+                    conversation_id=conversation.id,
+                    role=msg['role'],
+                    content=msg['content'],
+                    created_at=parse_datetime(msg['created_at']),
+                    metadata=msg.get('metadata', {})
+                )
+                for msg in record['messages']
+            ])
+            Feedback.objects.bulk_create([
+                Feedback(message_id=msg['id'], rating=fb['rating'], created_at=parse_datetime(fb['created_at']))
+                for msg in record['messages']
+                for fb in msg['feedback']
+            ])
+            entry.delete()
+
+        logger.info(f"Conversación restaurada desde el archivo {entry.archive_month}: {conversation_id}")
+        return Conversation.objects.get(id=conversation.id)
+
+    def compact(self):
+        """Recupera el espacio liberado por las conversaciones borradas"""
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+        elif connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                for model in (Conversation, Message, Feedback):
+                    cursor.execute(f"VACUUM ANALYZE {model._meta.db_table}")
+
+    def run_once(self):
+        try:
+            if self.archive_idle():
+                self.compact()
+        except Exception as e:
+            logger.error(f"Error en la tarea de retención: {str(e)}")
+
+    def run_periodic(self, interval_hours: float = None):
+        """
+        Ejecuta la retención cada `interval_hours` horas hasta que se interrumpa.
+
+        Pensado para un único proceso (`manage.py archive_conversations --periodic`),
+        no para cada worker del servidor.
+        """
+        interval = (interval_hours or getattr(settings, 'CHATBOT_RETENTION_INTERVAL_HOURS', 24)) * 3600
+        while True:
+            self.run_once()
+            time.sleep(interval)
@@ -1,188 +1,738 @@
+import json
+import uuid
+import asyncio
+import hashlib
 import logging
-import heapq
+import threading
 import numpy as np
-from typing import List, Tuple, Optional, Dict
-from collections import defaultdict
+from typing import List, Tuple, Optional, Dict, Union
+from collections import OrderedDict, defaultdict
+from django.conf import settings
 from langchain.schema import Document
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sentence_transformers import CrossEncoder
+from sklearn.feature_extraction.text import TfidfTransformer
+
+from .inference import get_embeddings, get_cross_encoder, CROSS_ENCODER_MODEL, EMBEDDING_MODEL
+from .retrieval_executor import RetrievalExecutor
+from .text_analysis import TokenStore
+from .keyword_index import KeywordIndex
+from .metadata_index import MetadataIndex, format_sources, validate_filters
+from .chunk_store import ChunkStore
+from .index_snapshot import IndexSnapshot
+from .vector_index import ChromaIndex, l2_relevance
+from .retrieval_cache import RetrievalCache
 
 logger = logging.getLogger(__name__)
 
 class BM25L:
-    def __init__(self, corpus, k1=1.5, b=0.75, delta=0.5):
-        self.corpus = corpus
+    """BM25L sobre los postings del `TokenStore`: solo se recorren los chunks que contienen algún término"""
+
+    def __init__(self, token_store: TokenStore, k1=1.5, b=0.75, delta=0.5):
+        self.token_store = token_store
         self.k1 = k1
         self.b = b
         self.delta = delta
-        self.avg_doc_len = sum(len(doc.split()) for doc in corpus) / len(corpus)
-        self.doc_freqs = []
-        self.idf = defaultdict(float)
-        self.doc_len = []
-        self.corpus_size = len(corpus)
+        self.corpus_size = token_store.num_docs
+        self.avg_doc_len = float(token_store.doc_lengths.mean()) if self.corpus_size else 1.0
         self._initialize()
 
     def _initialize(self):
-        for document in self.corpus:
-            words = document.split()
-            self.doc_len.append(len(words))
-            freq_dict = defaultdict(int)
-            for word in words:
-                freq_dict[word] += 1
-            self.doc_freqs.append(freq_dict)
-            for word in freq_dict:
-                self.idf[word] += 1
-
-        for word, freq in self.idf.items():
-            self.idf[word] = np.log((self.corpus_size - freq + 0.5) / (freq + 0.5))
-
-    def get_scores(self, query):
-        scores = [0] * self.corpus_size
-        query_words = query.split()
-        q_freqs = defaultdict(int)
-        for word in query_words:
-            q_freqs[word] += 1
-
-        for i, doc in enumerate(self.corpus):
-            for word in query_words:
-                if word not in self.doc_freqs[i]:
-                    continue
-                freq = self.doc_freqs[i][word]
-                numerator = self.idf[word] * freq * (self.k1 + 1)
-                denominator = freq + self.k1 * (1 - self.b + self.b * self.doc_len[i] / self.avg_doc_len)
-                scores[i] += (numerator / denominator) + self.delta
+        doc_freqs = self.token_store.doc_freqs.astype(np.float64)
+        self.idf = np.log((self.corpus_size - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        doc_len = self.token_store.doc_lengths.astype(np.float64)
+        self.length_norm = self.k1 * (1 - self.b + self.b * doc_len / (self.avg_doc_len or 1.0))
 
+    def get_scores(self, query_terms: Tuple[int, ...], allowed_mask: Optional[np.ndarray] = None) -> np.ndarray:
+        scores = np.zeros(self.corpus_size, dtype=np.float64)
+        for term in query_terms:
+            docs, freqs = self.token_store.postings(term)
+            if allowed_mask is not None:
+                # Filtrado previo: los chunks excluidos no llegan a puntuarse
+                keep = allowed_mask[docs]
+                docs, freqs = docs[keep], freqs[keep]
+            numerator = self.idf[term] * freqs * (self.k1 + 1)
+            denominator = freqs + self.length_norm[docs]
+            scores[docs] += numerator / denominator + self.delta
         return scores
 
 class BM25LRetriever:
-    def __init__(self, documents: List[str], k1: float = 1.5, b: float = 0.75, delta: float = 0.5):
-        self.documents = documents
-        self.bm25 = BM25L(self.documents, k1=k1, b=b, delta=delta)
+    def __init__(self, token_store: TokenStore, k1: float = 1.5, b: float = 0.75, delta: float = 0.5):
+        self.token_store = token_store
+        self.bm25 = BM25L(token_store, k1=k1, b=b, delta=delta)
 
-    def retrieve(self, query: str, top_k: int = 10) -> List[Tuple[int, float]]:
-        doc_scores = self.bm25.get_scores(query)
-        return heapq.nlargest(top_k, enumerate(doc_scores), key=lambda x: x[1])
+    def retrieve(self, query: str, top_k: int = 10, allowed_mask: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        query_terms = self.token_store.analyze_query(query)
+        if not query_terms:
+            return []
+        doc_scores = self.bm25.get_scores(query_terms, allowed_mask)
+        matched = np.flatnonzero(doc_scores)
+        best = matched[np.argsort(doc_scores[matched])[::-1][:top_k]]
+        return [(int(idx), float(doc_scores[idx])) for idx in best]
 
 class RetrievalService:
-    def __init__(self, documents: List[Document]):
-        self.documents = documents
-        self.vectorstore = None
+    def __init__(self, documents: Union[List[Document], ChunkStore]):
+        # Texto y metadatos en un almacén compacto; los índices solo guardan ids de chunk
+        self.chunks = documents if isinstance(documents, ChunkStore) else ChunkStore(documents)
+        self.vector_index = None
+        self.embeddings = None
+        # Con un snapshot, la búsqueda vectorial es exacta sobre la matriz mapeada en memoria
+        self.embedding_matrix = None
+        self.embedding_sq_norms = None
+        self.snapshot = None
+        self.token_store = None
+        self.keyword_index = None
+        self.metadata_index = None
         self.bm25l_retriever = None
-        self.tfidf_vectorizer = None
+        self.tfidf_transformer = None
+        self.tfidf_matrix = None
         self.cross_encoder = None
+        self.executor = RetrievalExecutor()
+        # Pool propio para los lotes: un lote largo no ocupa los hilos de las consultas del chat
+        self.batch_executor = RetrievalExecutor(
+            max_workers=getattr(settings, 'CHATBOT_BATCH_RETRIEVAL_WORKERS', 1), spare_workers=0
+        )
+        self.num_shards = getattr(settings, 'CHATBOT_RETRIEVAL_SHARDS', 1)
+        self.shards = None
+
+        # Rerank en cascada: umbrales de la primera etapa
+        self.cascade_enabled = getattr(settings, 'CHATBOT_CASCADE_ENABLED', True)
+        self.cascade_agreement_k = getattr(settings, 'CHATBOT_CASCADE_AGREEMENT_K', 3)
+        self.cascade_min_agreement = getattr(settings, 'CHATBOT_CASCADE_MIN_AGREEMENT', 2)
+        self.cascade_min_margin = getattr(settings, 'CHATBOT_CASCADE_MIN_MARGIN', 0.15)
+        self.cascade_candidates = getattr(settings, 'CHATBOT_CASCADE_CANDIDATES', 6)
+        self.cascade_stats = defaultdict(int)
+
+        # Historial como señales de recuperación separadas (ver `history_signals`)
+        self.history_turns = getattr(settings, 'CHATBOT_HISTORY_TURNS', 2)
+        self.history_weight = getattr(settings, 'CHATBOT_HISTORY_WEIGHT', 0.5)
+        self.history_decay = getattr(settings, 'CHATBOT_HISTORY_DECAY', 0.9)
+        # Embeddings de turnos ya vistos (consultas y respuestas), por hash del texto
+        self.turn_cache_size = getattr(settings, 'CHATBOT_HISTORY_EMBEDDING_CACHE_SIZE', 2048)
+        self._turn_embeddings = OrderedDict()
+        self._turn_lock = threading.Lock()
+        self.history_stats = defaultdict(int)
+
+        # Resultados recientes por (consulta, historial, parámetros, versión del índice)
+        self.result_cache = RetrievalCache()
+        self.index_version = None
+
+    @classmethod
+    def from_snapshot(cls, snapshot: IndexSnapshot) -> 'RetrievalService':
+        """
+        Servicio sobre un snapshot generado por `manage.py build_index`
+
+        Los índices se usan directamente desde los ficheros mapeados; solo se
+        construyen las estructuras pequeñas (idf de BM25L, vocabulario ordenado).
+        Con shards, cada proceso shard construye los índices de su partición.
+        """
+        service = cls(snapshot.chunks)
+        service.snapshot = snapshot
+        service.token_store = snapshot.token_store
+        service.keyword_index = KeywordIndex(service.token_store)
+        service._init_bm25l()
+        service.tfidf_transformer = TfidfTransformer()
+        service.tfidf_transformer.idf_ = snapshot.tfidf_idf
+        service.tfidf_matrix = snapshot.tfidf_matrix
+        service.embedding_matrix = snapshot.embeddings
+        service.embedding_sq_norms = snapshot.embedding_sq_norms
+        return service
 
-    def initialize(self):
+    def initialize(self, load_models: bool = True):
+        """
+        Construye el índice de metadatos y, con `load_models`, carga los modelos
+        (embeddings, cross-encoder) o arranca los shards. Se puede llamar de nuevo
+        para completar una inicialización hecha con `load_models=False`.
+        """
         try:
-            logger.info("Inicializando servicios de recuperación...")
-            self._init_vectorstore()
-            self._init_bm25l()
-            self._init_tfidf()
+            if self.metadata_index is None:
+                logger.info("Inicializando servicios de recuperación...")
+                self.metadata_index = MetadataIndex(self.chunks)
+            if not load_models or self.cross_encoder is not None:
+                return True
+            if self.num_shards > 1:
+                self._init_shards()
+            elif self.snapshot is not None:
+                self.embeddings = get_embeddings()
+            else:
+                self._init_indexes()
             self._init_cross_encoder()
+            self.index_version = self._index_version()
             logger.info("Servicios de recuperación inicializados")
             return True
         except Exception as e:
             logger.error(f"Error inicializando servicios de recuperación: {str(e)}")
             return False
 
-    def _init_vectorstore(self):
-        embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2",
-            model_kwargs={'device': 'cpu'}
-        )
-        self.vectorstore = Chroma.from_documents(
-            documents=self.documents,
-            embedding=embeddings
-        )
+    def _index_version(self) -> str:
+        """
+        Versión del índice para la caché de resultados
+
+        Combina el corpus (la versión del snapshot o, si se indexó en el arranque,
+        un resumen del texto, los límites y los metadatos de los chunks) con todo lo
+        que cambia el resultado para una misma consulta: modelos, backend de
+        inferencia y parámetros de la cascada y del historial.
+        """
+        if self.snapshot is not None:
+            corpus = self.snapshot.manifest['version']
+        else:
+            digest = hashlib.sha256(bytes(self.chunks.arena))
+            digest.update(np.ascontiguousarray(self.chunks.offsets).tobytes())
+            digest.update(np.ascontiguousarray(self.chunks.metadata_ids).tobytes())
+            digest.update(json.dumps(self.chunks.metadata_table, sort_keys=True, default=str).encode('utf-8'))
+            corpus = f"live-{digest.hexdigest()[:16]}"
+        config = json.dumps([
+            EMBEDDING_MODEL, CROSS_ENCODER_MODEL, getattr(settings, 'CHATBOT_INFERENCE_BACKEND', 'torch'),
+            self.cascade_enabled, self.cascade_agreement_k, self.cascade_min_agreement,
+            self.cascade_min_margin, self.cascade_candidates,
+            self.history_turns, self.history_weight, self.history_decay
+        ])
+        return f"{corpus}-{hashlib.sha256(config.encode('utf-8')).hexdigest()[:8]}"
+
+    def _init_indexes(self):
+        """Índices de primera etapa en este proceso (también los usa cada shard para su partición)"""
+        self._init_vectorstore()
+        self._init_token_store()
+        self._init_bm25l()
+        self._init_tfidf()
+
+    def _init_shards(self):
+        # Importación diferida: sharding depende de este módulo
+        from .sharding import ShardCoordinator
+        self.shards = ShardCoordinator(self.chunks, self.num_shards)
+
+    def _init_vectorstore(self, batch_size: int = 256):
+        # Backend configurable (CHATBOT_INFERENCE_BACKEND): PyTorch o ONNX int8
+        self.embeddings = get_embeddings()
+        # Colección propia: varios servicios (p. ej. shards o benchmarks) pueden convivir
+        self.vector_index = ChromaIndex(f"chunks-{uuid.uuid4().hex[:8]}")
+        # Chroma solo guarda el vector y el id del chunk; el texto sigue únicamente en el ChunkStore
+        for start in range(0, len(self.chunks), batch_size):
+            ids = range(start, min(start + batch_size, len(self.chunks)))
+            self.vector_index.add(ids, self.embeddings.embed_documents(self.chunks.texts(ids)))
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Embeddings de varias consultas en una sola pasada del modelo"""
+        return np.asarray(self.embeddings.embed_documents(queries), dtype=np.float32)
+
+    def vector_search(self, query: str, k: int = 10, allowed: Optional[np.ndarray] = None,
+                      query_vector: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Chunks más cercanos a la consulta como (chunk_id, relevancia en [0, 1])"""
+        if query_vector is None:
+            query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        if self.embedding_matrix is not None:
+            return self._matrix_search(query_vector, k, allowed)
+        return self.vector_index.search(query_vector, min(k, len(self.chunks)), allowed)
+
+    def chunk_embeddings(self) -> np.ndarray:
+        """Embedding de cada chunk en el orden de los ids (para escribir un snapshot)"""
+        if self.embedding_matrix is not None:
+            return np.asarray(self.embedding_matrix)
+        return self.vector_index.matrix(len(self.chunks))
+
+    def _matrix_search(self, query_vector: np.ndarray, k: int, allowed: Optional[np.ndarray]) -> List[Tuple[int, float]]:
+        """Búsqueda exacta con la misma distancia (L2 al cuadrado) y relevancia que Chroma por defecto"""
+        rows = allowed if allowed is not None else slice(None)
+        distances = (self.embedding_sq_norms[rows] - 2 * (self.embedding_matrix[rows] @ query_vector)
+                     + float(query_vector @ query_vector))
+        k = min(k, len(distances))
+        if not k:
+            return []
+        best = np.argpartition(distances, k - 1)[:k]
+        # Empates por id, para que el orden sea estable entre procesos
+        best = best[np.lexsort((best, distances[best]))]
+        ids = best if allowed is None else allowed[best]
+        return [(int(idx), l2_relevance(float(distances[pos]))) for idx, pos in zip(ids, best)]
+
+    def _init_token_store(self):
+        # Análisis único del corpus, compartido por BM25L, TF-IDF y la búsqueda por palabras clave
+        self.token_store = TokenStore(self.chunks.iter_texts())
+        logger.info(f"Corpus analizado: {len(self.token_store.token_ids)} tokens, "
+                    f"{self.token_store.vocab_size} términos")
+        self.keyword_index = KeywordIndex(self.token_store)
 
     def _init_bm25l(self):
-        doc_texts = [doc.page_content for doc in self.documents]
-        self.bm25l_retriever = BM25LRetriever(doc_texts, k1=1.2, b=0.75, delta=0.5)
+        self.bm25l_retriever = BM25LRetriever(self.token_store, k1=1.2, b=0.75, delta=0.5)
 
     def _init_tfidf(self):
-        doc_texts = [doc.page_content for doc in self.documents]
-        self.tfidf_vectorizer = TfidfVectorizer()
-        self.tfidf_vectorizer.fit(doc_texts)
+        self.tfidf_transformer = TfidfTransformer()
+        self.tfidf_matrix = self.tfidf_transformer.fit_transform(self.token_store.term_counts_matrix())
+
+    def tfidf_scores(self, query: str, allowed: Optional[np.ndarray] = None) -> np.ndarray:
+        """Similitud coseno de la consulta con cada chunk (las filas TF-IDF ya están normalizadas)"""
+        scores = np.zeros(len(self.chunks))
+        query_terms = self.token_store.analyze_query(query)
+        if not query_terms:
+            return scores
+        query_vector = self.tfidf_transformer.transform(self.token_store.query_counts_vector(query_terms))
+        if allowed is None:
+            return (self.tfidf_matrix @ query_vector.T).toarray().ravel()
+        # Solo se multiplican las filas de los chunks permitidos
+        scores[allowed] = (self.tfidf_matrix[allowed] @ query_vector.T).toarray().ravel()
+        return scores
 
     def _init_cross_encoder(self):
-        self.cross_encoder = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
-
-    def weight_chat_history(self, chat_history: List[Dict], max_messages: int = 2, decay_factor: float = 0.9) -> str:
-        if not chat_history:
-            return ""
-        recent_history = chat_history[-max_messages:]
-        weighted_history = []
-        for i, message in enumerate(reversed(recent_history)):
-            weight = decay_factor ** i
-            weighted_history.append(f"{weight:.2f} * {message['content']}")
-        return " ".join(reversed(weighted_history))
-
-    def rerank_results(self, docs: List[str], query: str, original_scores: List[float]) -> List[str]:
-        pairs = [[query, doc] for doc in docs]
-        scores = self.cross_encoder.predict(pairs)
-        combined_scores = [0.7 * new_score + 0.3 * original_score for new_score, original_score in zip(scores, original_scores)]
-        return [doc for _, doc in sorted(zip(combined_scores, docs), reverse=True)]
+        self.cross_encoder = get_cross_encoder()
+
+    def history_signals(self, query: str, chat_history: List[Dict]) -> List[Tuple[str, float]]:
+        """
+        Consulta actual (peso 1) y turnos recientes del historial con peso decreciente
+
+        Cada señal se busca por separado y se combina en la fusión; el texto de la
+        consulta no se mezcla con el historial.
+        """
+        recent = [message['content'] for message in chat_history[-(self.history_turns + 1):] if message.get('content')]
+        # El consumidor WebSocket ya incluye la consulta actual al final del historial
+        if recent and recent[-1] == query:
+            recent.pop()
+        recent = recent[-self.history_turns:] if self.history_turns else []
+        signals = [(query, 1.0)]
+        for i, text in enumerate(reversed(recent)):
+            signals.append((text, self.history_weight * self.history_decay ** i))
+        return signals
+
+    def _signal_vectors(self, texts: List[str]) -> np.ndarray:
+        """
+        Embeddings de las señales; los de turnos ya vistos salen de la caché
+
+        La consulta de un turno es historial en el siguiente, así que normalmente
+        solo se calcula el embedding de la consulta nueva y de la última respuesta.
+        """
+        keys = [hashlib.sha1(text.encode('utf-8')).digest() for text in texts]
+        with self._turn_lock:
+            vectors = [self._turn_embeddings.get(key) for key in keys]
+            for key, vector in zip(keys, vectors):
+                if vector is not None:
+                    self._turn_embeddings.move_to_end(key)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        self.history_stats['embedding_hits'] += len(texts) - len(missing)
+        self.history_stats['embedding_misses'] += len(missing)
+        if missing:
+            computed = self.embed_queries([texts[i] for i in missing])
+            with self._turn_lock:
+                for i, vector in zip(missing, computed):
+                    vectors[i] = vector
+                    self._turn_embeddings[keys[i]] = vector
+                while len(self._turn_embeddings) > self.turn_cache_size:
+                    self._turn_embeddings.popitem(last=False)
+        return np.stack(vectors)
+
+    @staticmethod
+    def _combine_ranked(weighted: List[Tuple[float, List[Tuple[int, float]]]], k: int,
+                        normalize: bool = False) -> List[Tuple[int, float]]:
+        """Media ponderada por chunk de varias listas (chunk_id, score); un chunk ausente puntúa 0"""
+        total = sum(weight for weight, _ in weighted) or 1.0
+        combined = defaultdict(float)
+        for weight, results in weighted:
+            scale = (max((score for _, score in results), default=0) or 1.0) if normalize else 1.0
+            for idx, score in results:
+                combined[idx] += weight * score / scale / total
+        return sorted(combined.items(), key=lambda pair: (-pair[1], pair[0]))[:k]
+
+    def multi_vector_search(self, signals: List[Tuple[str, float]], k: int = 10,
+                            allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Búsqueda vectorial de cada señal combinada por su peso"""
+        vectors = self._signal_vectors([text for text, _ in signals])
+        if len(signals) == 1:
+            return self.vector_search(signals[0][0], k, allowed, vectors[0])
+        return self._combine_ranked([
+            (weight, self.vector_search(text, k, allowed, vector)) for (text, weight), vector in zip(signals, vectors)
+        ], k)
+
+    def multi_bm25l(self, signals: List[Tuple[str, float]], k: int = 10,
+                    allowed_mask: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """BM25L de cada señal, normalizado por su máximo y combinado por su peso"""
+        if len(signals) == 1:
+            return self.bm25l_retriever.retrieve(signals[0][0], top_k=k, allowed_mask=allowed_mask)
+        return self._combine_ranked([
+            (weight, self.bm25l_retriever.retrieve(text, top_k=k, allowed_mask=allowed_mask))
+            for text, weight in signals
+        ], k, normalize=True)
+
+    def multi_tfidf(self, signals: List[Tuple[str, float]], allowed: Optional[np.ndarray] = None) -> np.ndarray:
+        total = sum(weight for _, weight in signals)
+        return sum(weight * self.tfidf_scores(text, allowed) for text, weight in signals) / total
+
+    def _merge_signals(self, results: List[Dict], signals: List[Tuple[str, float]], k: int) -> Dict:
+        """Combina los resultados de los shards para cada señal, con el formato de un solo resultado"""
+        merged = {}
+        for name in ('vector', 'bm25l'):
+            weighted = [(weight, result[name]) for result, (_, weight) in zip(results, signals)
+                        if result[name] is not None]
+            merged[name] = self._combine_ranked(weighted, k, normalize=name == 'bm25l') if weighted else None
+        weighted = [(weight, result['tfidf']) for result, (_, weight) in zip(results, signals)
+                    if result['tfidf'] is not None]
+        merged['tfidf'] = (sum(weight * scores for weight, scores in weighted) / sum(weight for weight, _ in weighted)
+                           if weighted else None)
+        return merged
+
+    def _keyword_matches(self, query: str, limit: int = 3, allowed_mask: Optional[np.ndarray] = None) -> List[Document]:
+        if self.shards is not None:
+            allowed = np.flatnonzero(allowed_mask) if allowed_mask is not None else None
+            matches = self.shards.keyword_search(query, limit=limit, allowed=allowed)
+        elif self.keyword_index is None:
+            return []
+        else:
+            matches = self.keyword_index.search(query, limit=limit, allowed_mask=allowed_mask)
+        return self.chunks.documents([idx for idx, _ in matches])
 
     def fallback_keyword_search(self, query: str) -> str:
-        keywords = query.lower().split()
-        relevant_docs = []
-        for doc in self.documents:
-            if any(keyword in doc.page_content.lower() for keyword in keywords):
-                relevant_docs.append(doc.page_content)
+        relevant_docs = self._keyword_matches(query)
         if not relevant_docs:
             return "No pude encontrar información relevante. ¿Puedes reformular tu pregunta?"
-        return "\n".join(relevant_docs[:3])
+        return "\n".join(doc.page_content for doc in relevant_docs)
 
     async def get_relevant_context(self, query: str, chat_history: List[Dict]) -> str:
-        import asyncio
+        documents = await self.get_relevant_documents(query, chat_history)
+        if not documents:
+            return self.fallback_keyword_search(query)
+        return "\n".join(doc.page_content for doc in documents)
 
+    def _fuse_scores(self, vector_results: List[Tuple[int, float]], bm25l_results: List[Tuple[int, float]],
+                     tfidf_scores: np.ndarray) -> Dict[int, float]:
+        """Suma ponderada por chunk: 0.6 vectorial + 0.3 BM25L (normalizado) + 0.1 TF-IDF"""
+        fused = defaultdict(float)
+        for idx, relevance in vector_results:
+            fused[idx] += 0.6 * max(relevance, 0.0)
+
+        max_bm25 = max((score for _, score in bm25l_results), default=0) or 1.0
+        for idx, score in bm25l_results:
+            fused[idx] += 0.3 * max(score, 0.0) / max_bm25
+
+        if not fused:
+            # Solo respondió TF-IDF: sus mejores chunks son los candidatos
+            for idx in np.argsort(tfidf_scores)[::-1][:10]:
+                if tfidf_scores[idx] > 0:
+                    fused[int(idx)] = 0.0
+
+        for idx in fused:
+            fused[idx] += 0.1 * tfidf_scores[idx]
+        return dict(fused)
+
+    def _cascade_plan(self, ranked: List[int], fused: Dict[int, float], vector_ranked: List[int],
+                      bm25l_ranked: List[int], top_k: int, trace: Dict) -> Tuple[int, List[int]]:
+        """
+        Decide si hace falta el cross-encoder a partir de la primera etapa.
+
+        Se omite cuando ambos recuperadores coinciden en sus primeros puestos y
+        hay margen entre el último chunk que entra en el contexto y el primero
+        que queda fuera. Si no, se mantiene fija la cabecera en la que ambos
+        coinciden y solo se reordenan los `candidates` siguientes.
+
+        Returns:
+            Tuple[int, List[int]]: Longitud de la cabecera fija y chunks que se
+            reordenan (lista vacía si se omite el rerank o la cabecera ya cubre
+            los `top_k` del contexto)
+        """
+        agreement_k = self.cascade_agreement_k
+        agreement = len(set(vector_ranked[:agreement_k]) & set(bm25l_ranked[:agreement_k]))
+        top_score = fused[ranked[0]] or 1.0
+        cutoff = min(top_k, len(ranked)) - 1
+        margin = (fused[ranked[cutoff]] - fused[ranked[cutoff + 1]]) / top_score if cutoff + 1 < len(ranked) else 1.0
+        trace.update({'agreement': agreement, 'margin': round(margin, 4)})
+
+        if not self.cascade_enabled:
+            head = 0
+            candidates = ranked
+        elif agreement >= self.cascade_min_agreement and margin >= self.cascade_min_margin:
+            candidates = []
+        else:
+            # Cabecera confiable: chunks iniciales presentes en el top de ambos recuperadores
+            both = set(vector_ranked[:agreement_k]) & set(bm25l_ranked[:agreement_k])
+            head = 0
+            while head < len(ranked) and ranked[head] in both:
+                head += 1
+            # Si la cabecera ya llena el contexto, reordenar el resto no cambia la respuesta
+            candidates = ranked[head:head + self.cascade_candidates] if head < top_k else []
+
+        if not candidates:
+            self.cascade_stats['skipped'] += 1
+            trace['rerank'] = 'skipped'
+            return 0, []
+        return head, candidates
+
+    def _apply_rerank(self, ranked: List[int], fused: Dict[int, float], head: int, candidates: List[int],
+                      scores, trace: Dict) -> List[int]:
+        """Reordena los candidatos combinando cross-encoder (0.7) y fusión (0.3)"""
+        combined = {idx: 0.7 * float(score) + 0.3 * fused[idx] for idx, score in zip(candidates, scores)}
+        reranked = sorted(candidates, key=combined.get, reverse=True)
+
+        mode = 'partial' if head or len(candidates) < len(ranked) else 'full'
+        self.cascade_stats[mode] += 1
+        trace.update({'rerank': mode, 'reranked': len(candidates)})
+        return ranked[:head] + reranked + ranked[head + len(candidates):]
+
+    def _cascade_rerank(self, ranked: List[int], fused: Dict[int, float], vector_ranked: List[int],
+                        bm25l_ranked: List[int], query: str, top_k: int, trace: Dict) -> List[int]:
+        head, candidates = self._cascade_plan(ranked, fused, vector_ranked, bm25l_ranked, top_k, trace)
+        if not candidates:
+            return ranked
+        # Solo se decodifica el texto de los candidatos que ve el cross-encoder
+        scores = self.cross_encoder.predict([[query, self.chunks.text(idx)] for idx in candidates])
+        return self._apply_rerank(ranked, fused, head, candidates, scores, trace)
+
+    async def get_relevant_documents(self, query: str, chat_history: List[Dict], top_k: int = 5,
+                                     trace: Optional[Dict] = None, filters: Optional[Dict] = None,
+                                     candidates: int = 10, rerank: bool = True) -> List[Document]:
+        """
+        Recupera los chunks más relevantes (fusión híbrida + rerank en cascada)
+
+        Args:
+            query (str): Consulta del usuario
+            chat_history (List[Dict]): Historial de la conversación
+            top_k (int): Número de chunks devueltos
+            trace (Dict): Si se indica, se completa con las decisiones tomadas (p. ej. `rerank`)
+                y con las fuentes (`sources`) de los chunks devueltos
+            filters (Dict): Filtro de metadatos (ver MetadataIndex); si no se indica se
+                detecta en la consulta el documento o tipo de documento mencionado
+            candidates (int): Resultados pedidos a cada recuperador (menos bajo carga)
+            rerank (bool): Si es False se omite el cross-encoder (escalones degradados)
+
+        Returns:
+            List[Document]: Chunks en orden de relevancia
+
+        Raises:
+            InvalidFilterError: Si `filters` no es válido o cita un documento que no está en el índice
+        """
+        self.validate_filters(filters)
+        if trace is None:
+            trace = {}
+        cache_key = None
+        if self.result_cache.enabled and self.index_version is not None:
+            cache_key = self.result_cache.key(
+                self.index_version, query, self.history_signals(query, chat_history)[1:],
+                filters, top_k, candidates, rerank
+            )
+            cached, tier = await self.result_cache.get(cache_key)
+            if cached is not None:
+                trace.update(cached['trace'])
+                trace['retrieval_cache'] = tier
+                documents = self.chunks.documents(cached['ids'])
+                trace['sources'] = format_sources(documents)
+                return documents
+
+        documents = await self._retrieve(query, chat_history, top_k, trace, filters, candidates, rerank)
+        # Solo se guardan resultados completos: ni la búsqueda por palabras clave ni
+        # los que perdieron algún recuperador por error o timeout
+        if cache_key is not None and trace.get('rerank') != 'fallback' and len(trace.get('retrievers', ())) == 3:
+            await self.result_cache.set(cache_key, {
+                'ids': [doc.metadata['chunk_id'] for doc in documents],
+                'trace': {key: value for key, value in trace.items() if key not in ('tier', 'sources')}
+            })
+        trace['sources'] = format_sources(documents)
+        return documents
+
+    def validate_filters(self, filters: Optional[Dict]):
+        """Lanza InvalidFilterError si un filtro explícito no es válido (ver MetadataIndex.validate)"""
+        if self.metadata_index is not None:
+            self.metadata_index.validate(filters)
+        else:
+            validate_filters(filters)
+
+    def _resolve_filters(self, query: str, filters: Optional[Dict]) -> Tuple[Optional[np.ndarray], Dict, bool]:
+        if self.metadata_index is None:
+            return None, {}, False
+        detected = filters is None
+        if detected:
+            filters = self.metadata_index.detect_filters(query)
+        return self.metadata_index.select(filters), filters, detected
+
+    def _allowed(self, query: str, filters: Optional[Dict], trace: Dict) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Ids y máscara de los chunks permitidos por el filtro (None, None si no hay filtro)"""
+        allowed, filters, detected = self._resolve_filters(query, filters)
+        if filters:
+            trace['filters'] = filters
+            trace['filters_detected'] = detected
+        if detected and allowed is not None:
+            # Un filtro implícito puede dejar fuera la respuesta: se registra para poder revisarlo
+            logger.info(f"Filtro detectado en la consulta {filters}: {len(allowed)} de {len(self.chunks)} fragmentos")
+        if allowed is None:
+            return None, None
+        trace['filtered_chunks'] = len(allowed)
+        allowed_mask = np.zeros(len(self.chunks), dtype=bool)
+        allowed_mask[allowed] = True
+        return allowed, allowed_mask
+
+    def _rank(self, results: Dict, candidates: int, trace: Dict) -> Optional[Tuple[List[int], Dict[int, float], List[int], List[int]]]:
+        """
+        Fusiona la primera etapa
+
+        Returns:
+            Candidatos en orden, puntuaciones fusionadas y el orden de cada
+            recuperador; None si hay que recurrir a la búsqueda por palabras clave
+        """
+        vector_results = results['vector'] or []
+        bm25l_results = results['bm25l'] or []
+        tfidf_scores = results['tfidf']
+        trace['retrievers'] = [name for name, result in results.items() if result is not None]
+
+        if not vector_results and not bm25l_results and tfidf_scores is None:
+            logger.warning("Todas las búsquedas fallaron. Usando búsqueda por palabras clave.")
+            trace['rerank'] = 'fallback'
+            return None
+
+        if tfidf_scores is None:
+            tfidf_scores = np.zeros(len(self.chunks))
+        fused = self._fuse_scores(vector_results, bm25l_results, tfidf_scores)
+        ranked = sorted(fused, key=fused.get, reverse=True)[:candidates]
+        if not ranked:
+            trace['rerank'] = 'fallback'
+            return None
+        return ranked, fused, [idx for idx, _ in vector_results], [idx for idx, _ in bm25l_results]
+
+    async def _retrieve(self, query: str, chat_history: List[Dict], top_k: int, trace: Dict,
+                        filters: Optional[Dict], candidates: int = 10, rerank: bool = True) -> List[Document]:
+        allowed_mask = None
         try:
-            weighted_history = self.weight_chat_history(chat_history)
-            combined_query = query + " " + weighted_history
+            allowed, allowed_mask = self._allowed(query, filters, trace)
+            if allowed is not None and not len(allowed):
+                return []
+
+            # Consulta y turnos recientes como señales separadas, combinadas con su peso en la fusión
+            signals = self.history_signals(query, chat_history)
+            trace['history_signals'] = len(signals) - 1
 
-            async def vector_search():
-                try:
-                    return self.vectorstore.similarity_search(combined_query, k=10)
-                except Exception as e:
-                    logger.error(f"Búsqueda vectorial fallida: {str(e)}")
-                    return []
+            if self.shards is not None:
+                # Scatter-gather: cada shard ejecuta los tres recuperadores sobre su partición
+                results = await asyncio.gather(*(
+                    self.executor.run_one(self.shards.search, text, candidates, allowed) for text, _ in signals
+                ))
+                trace['shards'] = min(result.pop('shards') for result in results)
+                results = results[0] if len(signals) == 1 else self._merge_signals(results, signals, candidates)
+            else:
+                # Los tres recuperadores corren a la vez en el pool; los que fallan o vencen devuelven None
+                results = await self.executor.run_all({
+                    'vector': lambda: self.multi_vector_search(signals, candidates, allowed),
+                    'bm25l': lambda: self.multi_bm25l(signals, candidates, allowed_mask),
+                    'tfidf': lambda: self.multi_tfidf(signals, allowed),
+                })
+            ranking = self._rank(results, candidates, trace)
+            if ranking is None:
+                return self._keyword_matches(query, allowed_mask=allowed_mask)
+            ranked, fused, vector_ranked, bm25l_ranked = ranking
 
-            async def bm25l_search():
-                try:
-                    return self.bm25l_retriever.retrieve(combined_query, top_k=10)
-                except Exception as e:
-                    logger.error(f"Búsqueda BM25L fallida: {str(e)}")
-                    return []
+            self.cascade_stats['queries'] += 1
+            if not rerank:
+                self.cascade_stats['skipped_load'] += 1
+                trace['rerank'] = 'skipped_load'
+                trace['fused_scores'] = [round(float(fused[idx]), 4) for idx in ranked[:top_k]]
+                return self.chunks.documents(ranked[:top_k])
 
-            vector_results, bm25l_results = await asyncio.gather(vector_search(), bm25l_search())
+            # El cross-encoder también es bloqueante: se ejecuta en el mismo pool
+            # El cross-encoder compara con la consulta actual; el historial ya pesa en la fusión
+            ranked = await self.executor.run_one(
+                self._cascade_rerank, ranked, fused, vector_ranked, bm25l_ranked, query, top_k, trace
+            )
 
-            if not vector_results and not bm25l_results:
-                logger.warning("Ambas búsquedas fallaron. Usando búsqueda por palabras clave.")
-                return self.fallback_keyword_search(combined_query)
+            trace['fused_scores'] = [round(float(fused[idx]), 4) for idx in ranked[:top_k]]
+            # El texto de los chunks elegidos solo se materializa aquí, para el prompt
+            return self.chunks.documents(ranked[:top_k])
 
-            combined_results = []
-            for doc in vector_results:
-                heapq.heappush(combined_results, (-0.6, doc.page_content))
+        except Exception as e:
+            logger.error(f"Error en get_relevant_documents: {str(e)}")
+            trace['rerank'] = 'fallback'
+            return self._keyword_matches(query, allowed_mask=allowed_mask)
 
-            for idx, score in bm25l_results:
-                doc_content = self.documents[idx].page_content
-                heapq.heappush(combined_results, (-0.3 * score, doc_content))
+    async def get_relevant_documents_batch(self, queries: List[str], top_k: int = 5,
+                                           filters: Optional[List[Optional[Dict]]] = None,
+                                           traces: Optional[List[Dict]] = None,
+                                           candidates: int = 10) -> List[List[Document]]:
+        """
+        Recupera los chunks de varias consultas independientes (sin historial) a la vez
 
-            tfidf_scores = self.tfidf_vectorizer.transform([combined_query]).toarray()[0]
-            for idx, doc in enumerate(self.documents):
-                doc_content = doc.page_content
-                if any(doc_content == content for _, content in combined_results):
-                    heapq.heappush(combined_results, (-0.1 * tfidf_scores[idx], doc_content))
+        Los embeddings de todas las consultas se calculan en una sola pasada y los
+        pares de todas las que necesitan rerank pasan juntos por el cross-encoder;
+        la fusión y la cascada son las mismas que en `get_relevant_documents`.
 
-            top_results = heapq.nsmallest(10, combined_results)
-            docs_to_rerank = [doc for _, doc in top_results]
-            original_scores = [-score for score, _ in top_results]
+        Args:
+            queries (List[str]): Consultas
+            filters (List[Dict]): Filtro de metadatos de cada consulta (None: detectado)
+            traces (List[Dict]): Si se indica, uno por consulta, como `trace`
 
-            reranked_docs = self.rerank_results(docs_to_rerank, combined_query, original_scores)
+        Returns:
+            List[List[Document]]: Chunks de cada consulta en orden de relevancia
+        """
+        filters = filters or [None] * len(queries)
+        for query_filters in filters:
+            self.validate_filters(query_filters)
+        traces = traces if traces is not None else [{} for _ in queries]
+        if self.shards is not None:
+            # Los shards no tienen modo por lotes: cada consulta hace su propio scatter-gather
+            return [
+                await self.get_relevant_documents(query, [], top_k, trace, query_filters, candidates)
+                for query, query_filters, trace in zip(queries, filters, traces)
+            ]
+        results = await self.batch_executor.run_one(self._retrieve_batch, queries, top_k, filters, traces, candidates)
+        for documents, trace in zip(results, traces):
+            trace['sources'] = format_sources(documents)
+        return results
 
-            return "\n".join(reranked_docs[:5])
+    def _first_stage(self, query: str, candidates: int, allowed: Optional[np.ndarray],
+                     allowed_mask: Optional[np.ndarray], query_vector: Optional[np.ndarray]) -> Dict:
+        """Los tres recuperadores en serie; cada uno que falle devuelve None, como en `run_all`"""
+        retrievers = {
+            'vector': lambda: self.vector_search(query, candidates, allowed, query_vector),
+            'bm25l': lambda: self.bm25l_retriever.retrieve(query, top_k=candidates, allowed_mask=allowed_mask),
+            'tfidf': lambda: self.tfidf_scores(query, allowed),
+        }
+        results = {}
+        for name, retrieve in retrievers.items():
+            try:
+                results[name] = retrieve()
+            except Exception as e:
+                logger.error(f"Búsqueda {name} fallida: {str(e)}")
+                results[name] = None
+        return results
 
+    def _retrieve_batch(self, queries: List[str], top_k: int, filters: List[Optional[Dict]],
+                        traces: List[Dict], candidates: int) -> List[List[Document]]:
+        try:
+            query_vectors = self.embed_queries(queries)
         except Exception as e:
-            logger.error(f"Error en get_relevant_context: {str(e)}")
-            return self.fallback_keyword_search(query)
+            logger.error(f"Error calculando los embeddings del lote: {str(e)}")
+            query_vectors = [None] * len(queries)
+
+        results: List[Optional[List[int]]] = [None] * len(queries)
+        fallbacks = {}
+        plans = []
+        for i, (query, trace) in enumerate(zip(queries, traces)):
+            allowed_mask = None
+            try:
+                allowed, allowed_mask = self._allowed(query, filters[i], trace)
+                if allowed is not None and not len(allowed):
+                    results[i] = []
+                    continue
+                stage = self._first_stage(query, candidates, allowed, allowed_mask, query_vectors[i])
+                ranking = self._rank(stage, candidates, trace)
+                if ranking is None:
+                    fallbacks[i] = self._keyword_matches(query, allowed_mask=allowed_mask)
+                    continue
+                ranked, fused, vector_ranked, bm25l_ranked = ranking
+                self.cascade_stats['queries'] += 1
+                head, rerank_ids = self._cascade_plan(ranked, fused, vector_ranked, bm25l_ranked, top_k, trace)
+                results[i] = ranked
+                if rerank_ids:
+                    plans.append((i, ranked, fused, head, rerank_ids))
+            except Exception as e:
+                logger.error(f"Error en la recuperación por lotes: {str(e)}")
+                traces[i]['rerank'] = 'fallback'
+                fallbacks[i] = self._keyword_matches(query, allowed_mask=allowed_mask)
+
+        # Un único paso del cross-encoder con los pares de todas las consultas
+        pairs = [[queries[i], self.chunks.text(idx)] for i, _, _, _, rerank_ids in plans for idx in rerank_ids]
+        if pairs:
+            try:
+                scores = self.cross_encoder.predict(pairs)
+                offset = 0
+                for i, ranked, fused, head, rerank_ids in plans:
+                    batch_scores = scores[offset:offset + len(rerank_ids)]
+                    offset += len(rerank_ids)
+                    results[i] = self._apply_rerank(ranked, fused, head, rerank_ids, batch_scores, traces[i])
+            except Exception as e:
+                # Sin cross-encoder se mantiene el orden de la fusión
+                logger.error(f"Error en el rerank por lotes: {str(e)}")
+                for i, *_ in plans:
+                    traces[i]['rerank'] = 'failed'
+
+        return [
+            fallbacks[i] if i in fallbacks else self.chunks.documents(ranked[:top_k])
+            for i, ranked in enumerate(results)
+        ]
@@ -0,0 +1,110 @@
+import json
+import hashlib
+import logging
+from collections import OrderedDict, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+from django.conf import settings
+
+from .text_analysis import fold_accents
+
+logger = logging.getLogger(__name__)
+
+
+class RetrievalCache:
+    """
+    Caché de resultados de recuperación: ids de chunk ordenados y traza (con las puntuaciones fusionadas).
+
+    La clave incluye la consulta normalizada, el historial que interviene en la
+    recuperación, los parámetros (filtros, top_k, candidatos, rerank) y la versión
+    del índice (corpus, modelos y configuración de la cascada y del historial), así
+    que al reindexar o cambiar esa configuración las entradas anteriores dejan de
+    coincidir sin invalidarlas a mano. Hay un LRU en proceso y, si se configura un alias de
+    CACHES (p. ej. Redis), un nivel compartido entre workers.
+    """
+
+    def __init__(self, size: int = None, shared_alias: str = None, shared_ttl: int = None):
+        self.size = size if size is not None else getattr(settings, 'CHATBOT_RETRIEVAL_CACHE_SIZE', 1024)
+        self.shared_alias = shared_alias or getattr(settings, 'CHATBOT_RETRIEVAL_CACHE_ALIAS', None)
+        self.shared_ttl = shared_ttl if shared_ttl is not None else getattr(settings, 'CHATBOT_RETRIEVAL_CACHE_TTL', 3600)
+        self.entries: 'OrderedDict[str, Dict]' = OrderedDict()
+        self.stats = defaultdict(int)
+        self._shared = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    @property
+    def shared(self):
+        if self._shared is None and self.shared_alias:
+            from django.core.cache import caches
+            self._shared = caches[self.shared_alias]
+        return self._shared
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return ' '.join(fold_accents(text.lower()).split())
+
+    def key(self, index_version: str, query: str, history: List[Tuple[str, float]], filters: Optional[Dict],
+            top_k: int, candidates: int, rerank: bool) -> str:
+        """
+        Args:
+            history (List[Tuple[str, float]]): Señales de historial con su peso (ver `history_signals`)
+        """
+        history_digest = hashlib.sha256(json.dumps(
+            [[self.normalize(text), round(weight, 4)] for text, weight in history], ensure_ascii=False
+        ).encode('utf-8')).hexdigest()[:16]
+        payload = json.dumps(
+            [index_version, self.normalize(query), history_digest, filters, top_k, candidates, rerank],
+            ensure_ascii=False, sort_keys=True, default=str
+        )
+        return f"retrieval:{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+    async def get(self, key: str) -> Tuple[Optional[Dict], Optional[str]]:
+        """Entrada y nivel donde se encontró ('local' o 'shared'), o (None, None)"""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry, 'local'
+        if self.shared is not None:
+            try:
+                entry = await self.shared.aget(key)
+            except Exception as e:
+                self.stats['shared_errors'] += 1
+                logger.warning(f"Caché de recuperación compartida no disponible: {str(e)}")
+                entry = None
+            if entry is not None:
+                self._remember(key, entry)
+                self.stats['shared_hits'] += 1
+                return entry, 'shared'
+        self.stats['misses'] += 1
+        return None, None
+
+    async def set(self, key: str, entry: Dict[str, Any]):
+        self._remember(key, entry)
+        if self.shared is not None:
+            try:
+                await self.shared.aset(key, entry, timeout=self.shared_ttl)
+            except Exception as e:
+                self.stats['shared_errors'] += 1
+                logger.warning(f"No se pudo escribir en la caché de recuperación compartida: {str(e)}")
+
+    def _remember(self, key: str, entry: Dict):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.stats['hits'] + self.stats['shared_hits'] + self.stats['misses']
+        hits = self.stats['hits'] + self.stats['shared_hits']
+        return {
+            **self.stats,
+            'entries': len(self.entries),
+            'hit_rate': round(hits / lookups, 4) if lookups else 0.0,
+            'shared': self.shared_alias
+        }
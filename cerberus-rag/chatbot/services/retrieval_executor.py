@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import functools
+import contextvars
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+class RetrievalExecutor:
+    """
+    Ejecuta los recuperadores en un pool de hilos propio y acotado.
+
+    Las búsquedas vectorial, BM25L y TF-IDF son bloqueantes pero pasan la mayor
+    parte del tiempo en NumPy/BLAS u ONNX/PyTorch, que liberan el GIL; en hilos
+    se solapan entre sí y no detienen el event loop. Cada recuperador tiene su
+    propio timeout, que empieza a contar cuando su hilo comienza a ejecutarlo
+    (la espera en la cola del pool no lo consume): si vence, su resultado se
+    descarta y la fusión continúa con los que terminaron.
+
+    El hilo de un recuperador descartado sigue hasta acabar; el pool tiene
+    `spare_workers` hilos más que `max_workers` para que ese trabajo abandonado
+    no quite capacidad a las peticiones siguientes.
+    """
+
+    def __init__(self, max_workers: int = None, timeouts: Dict[str, float] = None, spare_workers: int = None):
+        self.max_workers = max_workers or getattr(settings, 'CHATBOT_RETRIEVAL_WORKERS', 4)
+        self.spare_workers = spare_workers if spare_workers is not None else getattr(
+            settings, 'CHATBOT_RETRIEVAL_SPARE_WORKERS', self.max_workers
+        )
+        self.timeouts = timeouts or getattr(settings, 'CHATBOT_RETRIEVAL_TIMEOUTS', {})
+        self.default_timeout = self.timeouts.get('default', 5.0)
+        self._pool = ThreadPoolExecutor(
+            max_workers=self.max_workers + self.spare_workers, thread_name_prefix='retrieval'
+        )
+        self.stats = defaultdict(int)
+        # Hilos que siguen ejecutando un recuperador cuyo timeout ya venció
+        self.abandoned = 0
+        self._lock = threading.Lock()
+
+    async def run_one(self, func: Callable, *args, **kwargs) -> Any:
+        """Ejecuta una función bloqueante en el pool, sin timeout"""
+        loop = asyncio.get_running_loop()
+        # run_in_executor no copia el contexto: sin esto los registros del hilo pierden los ids de la petición
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._pool, functools.partial(context.run, func, *args, **kwargs))
+
+    async def _run_named(self, name: str, func: Callable) -> Any:
+        timeout = self.timeouts.get(name, self.default_timeout)
+        loop = asyncio.get_running_loop()
+        started = asyncio.Event()
+        state = {'finished': False, 'abandoned': False}
+
+        def run():
+            loop.call_soon_threadsafe(started.set)
+            try:
+                return func()
+            finally:
+                with self._lock:
+                    state['finished'] = True
+                    if state['abandoned']:
+                        self.abandoned -= 1
+
+        future = loop.run_in_executor(self._pool, contextvars.copy_context().run, run)
+        try:
+            await started.wait()
+            return await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                if not state['finished']:
+                    state['abandoned'] = True
+                    self.abandoned += 1
+                abandoned = self.abandoned
+            self.stats[f"{name}_timeouts"] += 1
+            logger.warning(f"Recuperador {name} superó su timeout ({timeout}s); se descarta")
+            if abandoned > self.spare_workers:
+                logger.warning(
+                    f"{abandoned} hilos de recuperación abandonados superan la reserva del pool "
+                    f"({self.spare_workers}); las búsquedas nuevas esperarán en cola"
+                )
+        except Exception as e:
+            self.stats[f"{name}_errors"] += 1
+            logger.error(f"Búsqueda {name} fallida: {str(e)}")
+        return None
+
+    async def run_all(self, tasks: Dict[str, Callable]) -> Dict[str, Any]:
+        """
+        Lanza todos los recuperadores a la vez
+
+        Args:
+            tasks (Dict[str, Callable]): Nombre del recuperador -> función sin argumentos
+
+        Returns:
+            Dict[str, Any]: Resultado de cada recuperador, o None si falló o venció su timeout
+        """
+        names = list(tasks)
+        results = await asyncio.gather(*(self._run_named(name, tasks[name]) for name in names))
+        return dict(zip(names, results))
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,302 @@
+import os
+import logging
+import itertools
+import threading
+import multiprocessing
+from concurrent.futures import Future, wait
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from django.conf import settings
+
+from .retrieval import RetrievalService
+from .chunk_store import ChunkStore
+
+logger = logging.getLogger(__name__)
+
+RETRIEVERS = ('vector', 'bm25l', 'tfidf')
+
+
+class RetrievalShard:
+    """
+    Índices de una partición del corpus; vive dentro del proceso del shard.
+
+    Reutiliza `RetrievalService` sobre su subconjunto de chunks (Chroma, BM25L,
+    TF-IDF y el índice de palabras clave propios) y traduce los ids locales a
+    los ids globales del coordinador. Las estadísticas (idf, longitud media) son
+    las de la partición, como en cualquier búsqueda distribuida sin fase DFS.
+    """
+
+    def __init__(self, entries: List[Tuple[int, str, Dict]]):
+        self.global_ids = np.asarray([chunk_id for chunk_id, _, _ in entries], dtype=np.int64)
+        self._local_by_global = {chunk_id: idx for idx, (chunk_id, _, _) in enumerate(entries)}
+        self.service = RetrievalService(ChunkStore.from_entries((text, metadata) for _, text, metadata in entries))
+        self.service._init_indexes()
+
+    def _local_filter(self, allowed: Optional[List[int]]) -> Optional[np.ndarray]:
+        if allowed is None:
+            return None
+        return np.flatnonzero(np.isin(self.global_ids, allowed)).astype(np.int32)
+
+    def _to_global(self, pairs) -> List[Tuple[int, float]]:
+        return [(int(self.global_ids[idx]), float(score)) for idx, score in pairs]
+
+    def search(self, query: str, top_k: int = 10, allowed: Optional[List[int]] = None) -> Dict[str, Any]:
+        """Primera etapa en la partición; cada recuperador que falle devuelve None, como en run_all"""
+        service = self.service
+        local_allowed = self._local_filter(allowed)
+        if local_allowed is not None and not len(local_allowed):
+            return {name: [] for name in RETRIEVERS}
+        allowed_mask = None
+        if local_allowed is not None:
+            allowed_mask = np.zeros(len(service.chunks), dtype=bool)
+            allowed_mask[local_allowed] = True
+
+        results = {}
+        try:
+            results['vector'] = self._to_global(service.vector_search(query, top_k, local_allowed))
+        except Exception as e:
+            logger.error(f"Búsqueda vector fallida en el shard: {str(e)}")
+            results['vector'] = None
+
+        try:
+            results['bm25l'] = self._to_global(
+                service.bm25l_retriever.retrieve(query, top_k=top_k, allowed_mask=allowed_mask)
+            )
+        except Exception as e:
+            logger.error(f"Búsqueda bm25l fallida en el shard: {str(e)}")
+            results['bm25l'] = None
+
+        try:
+            scores = service.tfidf_scores(query, local_allowed)
+            # Se devuelven los mejores TF-IDF y, además, el TF-IDF de los candidatos
+            # vectoriales y BM25L del shard, que el coordinador necesita para fusionar
+            candidates = set(np.argsort(scores)[::-1][:top_k].tolist())
+            for name in ('vector', 'bm25l'):
+                candidates.update(self._local_by_global[gid] for gid, _ in results[name] or [])
+            results['tfidf'] = self._to_global((idx, scores[idx]) for idx in candidates if scores[idx] > 0)
+        except Exception as e:
+            logger.error(f"Búsqueda tfidf fallida en el shard: {str(e)}")
+            results['tfidf'] = None
+
+        return results
+
+    def keyword(self, query: str, limit: int = 3, allowed: Optional[List[int]] = None) -> List[Tuple[int, float]]:
+        local_allowed = self._local_filter(allowed)
+        allowed_mask = None
+        if local_allowed is not None:
+            allowed_mask = np.zeros(len(self.service.chunks), dtype=bool)
+            allowed_mask[local_allowed] = True
+        return self._to_global(self.service.keyword_index.search(query, limit=limit, allowed_mask=allowed_mask))
+
+
+def _shard_worker(conn, shard_id: int):
+    """Bucle del proceso del shard: atiende las peticiones del coordinador de una en una"""
+    import django
+    from chatbot.log_pipeline import set_log_process
+    # El proceso hereda sys.argv del padre (p. ej. runserver): sin esto ready() arrancaría el servicio de chat
+    os.environ['CHATBOT_SHARD_WORKER'] = '1'
+    # y escribiría en el fichero de log del padre
+    set_log_process(f"shard-{shard_id}")
+    django.setup()
+
+    shard = None
+    while True:
+        try:
+            seq, op, payload = conn.recv()
+        except EOFError:
+            break
+        if op == 'stop':
+            break
+        try:
+            if op == 'build':
+                shard = RetrievalShard(payload)
+                result = len(payload)
+            elif op == 'search':
+                result = shard.search(**payload)
+            elif op == 'keyword':
+                result = shard.keyword(**payload)
+            else:
+                raise ValueError(f"Operación desconocida: {op}")
+            conn.send((seq, 'ok', result))
+        except Exception as e:
+            conn.send((seq, 'error', f"shard {shard_id}: {str(e)}"))
+    conn.close()
+
+
+class ShardClient:
+    """
+    Extremo del coordinador para un proceso shard.
+
+    Cada petición lleva un número de secuencia y un hilo lector entrega cada
+    respuesta al Future de su petición. El shard atiende en serie, pero quien
+    pide no espera a las respuestas anteriores: una petición abandonada por
+    timeout (`abandon`) no bloquea a las siguientes y su respuesta tardía se
+    descarta al llegar.
+    """
+
+    def __init__(self, context, shard_id: int):
+        self.shard_id = shard_id
+        self._conn, child_conn = context.Pipe()
+        self._send_lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+        self._pending_lock = threading.Lock()
+        self._seq = itertools.count()
+        self.process = context.Process(
+            target=_shard_worker, args=(child_conn, shard_id),
+            name=f"retrieval-shard-{shard_id}", daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self._reader = threading.Thread(target=self._read_replies, name=f"shard-reader-{shard_id}", daemon=True)
+        self._reader.start()
+
+    def submit(self, op: str, payload: Any) -> Future:
+        """Envía la petición sin esperar; el Future se completa con el resultado o con RuntimeError"""
+        future = Future()
+        future.seq = next(self._seq)
+        with self._pending_lock:
+            self._pending[future.seq] = future
+        try:
+            with self._send_lock:
+                self._conn.send((future.seq, op, payload))
+        except (OSError, BrokenPipeError) as e:
+            # Solo la falla quien la saca de las pendientes (aquí o el hilo lector)
+            with self._pending_lock:
+                owned = self._pending.pop(future.seq, None) is not None
+            if owned:
+                future.set_exception(RuntimeError(f"shard {self.shard_id}: {str(e)}"))
+        return future
+
+    def abandon(self, future: Future):
+        """Deja de esperar la respuesta de `future`; si llega más tarde se descarta"""
+        with self._pending_lock:
+            self._pending.pop(future.seq, None)
+
+    def _read_replies(self):
+        while True:
+            try:
+                seq, status, result = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._pending_lock:
+                future = self._pending.pop(seq, None)
+            if future is None:
+                logger.debug(f"Respuesta tardía del shard {self.shard_id} descartada (petición {seq})")
+            elif status == 'ok':
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+        # El proceso terminó: las peticiones en vuelo no recibirán respuesta
+        with self._pending_lock:
+            pending, self._pending = list(self._pending.values()), {}
+        for future in pending:
+            future.set_exception(RuntimeError(f"shard {self.shard_id}: el proceso terminó"))
+
+    def stop(self):
+        try:
+            with self._send_lock:
+                self._conn.send((None, 'stop', None))
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=5)
+        self._conn.close()
+
+
+class ShardCoordinator:
+    """
+    Reparte el corpus entre N procesos shard y combina sus resultados.
+
+    Los chunks se asignan por turnos (id % N) para equilibrar el tamaño de las
+    particiones. Cada consulta se envía a todos los shards a la vez (scatter),
+    se recogen sus top-k (gather) y el coordinador aplica la fusión y el rerank
+    habituales. Un shard que no responde a tiempo se omite.
+    """
+
+    def __init__(self, chunks: ChunkStore, num_shards: int, timeout: float = None):
+        self.num_shards = num_shards
+        self.num_docs = len(chunks)
+        timeouts = getattr(settings, 'CHATBOT_RETRIEVAL_TIMEOUTS', {})
+        self.timeout = timeout or timeouts.get('shard', timeouts.get('default', 5.0))
+
+        context = multiprocessing.get_context('spawn')
+        self.clients = [ShardClient(context, shard_id) for shard_id in range(num_shards)]
+
+        partitions = [[] for _ in range(num_shards)]
+        for chunk_id in range(len(chunks)):
+            metadata = chunks.metadata_table[chunks.metadata_ids[chunk_id]]
+            partitions[chunk_id % num_shards].append((chunk_id, chunks.text(chunk_id), metadata))
+
+        # Los shards construyen sus índices en paralelo
+        sizes = self.scatter('build', partitions, timeout=None)
+        if any(size is None for size in sizes):
+            self.close()
+            raise RuntimeError("No se pudieron construir todos los shards")
+        logger.info(f"Recuperación distribuida en {num_shards} shards: {sizes} chunks")
+
+    def scatter(self, op: str, payload: Any, timeout: Optional[float] = -1) -> List[Any]:
+        """
+        Envía la petición a todos los shards y espera sus respuestas
+
+        Args:
+            payload: Igual para todos los shards, o una lista con uno por shard (si op == 'build')
+            timeout (float): Espera máxima; -1 usa el timeout configurado y None espera sin límite
+
+        Returns:
+            List[Any]: Resultado de cada shard, o None si falló o no respondió a tiempo
+        """
+        timeout = self.timeout if timeout == -1 else timeout
+        futures = [
+            client.submit(op, payload[i] if op == 'build' else payload)
+            for i, client in enumerate(self.clients)
+        ]
+        done, _ = wait(futures, timeout=timeout)
+        results = []
+        for client, future in zip(self.clients, futures):
+            if future not in done:
+                client.abandon(future)
+                logger.warning(f"Shard {client.shard_id} superó su timeout ({timeout}s); se descarta")
+                results.append(None)
+            elif future.exception() is not None:
+                logger.error(f"Error en el shard {client.shard_id}: {str(future.exception())}")
+                results.append(None)
+            else:
+                results.append(future.result())
+        return results
+
+    def search(self, query: str, top_k: int = 10, allowed: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """
+        Primera etapa distribuida con el mismo formato que los recuperadores locales
+
+        Returns:
+            Dict[str, Any]: `vector` [(chunk_id, score)], `bm25l` [(chunk_id, score)] y
+            `tfidf` (puntuaciones densas); None si ningún shard respondió con ese recuperador
+        """
+        payload = {'query': query, 'top_k': top_k, 'allowed': allowed.tolist() if allowed is not None else None}
+        responses = [response for response in self.scatter('search', payload) if response is not None]
+
+        merged = {}
+        for name in ('vector', 'bm25l'):
+            parts = [response[name] for response in responses if response[name] is not None]
+            merged[name] = sorted((pair for part in parts for pair in part), key=lambda pair: pair[1],
+                                  reverse=True)[:top_k] if parts else None
+
+        parts = [response['tfidf'] for response in responses if response['tfidf'] is not None]
+        if parts:
+            scores = np.zeros(self.num_docs)
+            for part in parts:
+                for chunk_id, score in part:
+                    scores[chunk_id] = score
+            merged['tfidf'] = scores
+        else:
+            merged['tfidf'] = None
+        merged['shards'] = len(responses)
+        return merged
+
+    def keyword_search(self, query: str, limit: int = 3, allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        payload = {'query': query, 'limit': limit, 'allowed': allowed.tolist() if allowed is not None else None}
+        matches = [pair for response in self.scatter('keyword', payload) if response for pair in response]
+        return sorted(matches, key=lambda pair: (-pair[1], pair[0]))[:limit]
+
+    def close(self):
+        for client in self.clients:
+            client.stop()
@@ -0,0 +1,160 @@
+import re
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+import numpy as np
+
+SPANISH_STOPWORDS = frozenset("""
+a al algo algunas algunos ante antes como con contra cual cuales cuando de del desde donde durante e el
+ella ellas ellos en entre era eran es esa esas ese eso esos esta estaba estado estan estar estas este
+esto estos fue fueron ha habia han hasta hay la las le les lo los mas me mi mis mucho muy nada ni no nos
+nosotros o os otra otras otro otros para pero poco por porque que quien quienes se sea segun ser si sido
+sin sobre son su sus tambien tanto te tiene tienen todo todos tu tus un una uno unos y ya yo
+""".split())
+
+_TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def fold_accents(text: str) -> str:
+    """Elimina tildes y diéresis conservando la ñ"""
+    text = text.replace('ñ', '\0')
+    folded = ''.join(
+        char for char in unicodedata.normalize('NFKD', text)
+        if not unicodedata.combining(char)
+    )
+    return folded.replace('\0', 'ñ')
+
+
+def light_stem(token: str) -> str:
+    """Stemmer ligero para español: quita plurales y la vocal final de género"""
+    if len(token) > 5 and token.endswith('ces'):
+        token = token[:-3] + 'z'
+    elif len(token) > 4 and token.endswith('es') and token[-3] not in 'aeiou':
+        token = token[:-2]
+    elif len(token) > 3 and token.endswith('s'):
+        token = token[:-1]
+    if len(token) > 4 and token[-1] in 'aoe':
+        token = token[:-1]
+    return token
+
+
+class SpanishAnalyzer:
+    def __init__(self, stem: bool = True, stopwords: frozenset = SPANISH_STOPWORDS):
+        self.stem = stem
+        self.stopwords = stopwords
+
+    def __call__(self, text: str) -> List[str]:
+        tokens = _TOKEN_PATTERN.findall(fold_accents(text.lower()))
+        tokens = [token for token in tokens if token not in self.stopwords]
+        if self.stem:
+            tokens = [light_stem(token) for token in tokens]
+        return tokens
+
+
+class TokenStore:
+    """
+    Tokens analizados de todo el corpus, calculados una sola vez en la ingesta.
+
+    Cada chunk se guarda como un tramo de `token_ids` (int32 contiguos) delimitado
+    por `offsets`; el vocabulario asigna un id entero a cada término. Las listas
+    de postings (chunks y frecuencias por término) se construyen a partir de esos
+    arrays y las comparten BM25L, TF-IDF y la búsqueda por palabras clave.
+    """
+
+    def __init__(self, texts: Iterable[str], analyzer: SpanishAnalyzer = None):
+        self.analyzer = analyzer or SpanishAnalyzer()
+        self.vocabulary: Dict[str, int] = {}
+
+        ids = []
+        offsets = [0]
+        for text in texts:
+            for token in self.analyzer(text):
+                ids.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+            offsets.append(len(ids))
+
+        self.token_ids = np.asarray(ids, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.doc_lengths = np.diff(self.offsets).astype(np.int32)
+        self.num_docs = len(offsets) - 1
+        self._build_postings()
+        self._analyze_query = lru_cache(maxsize=4096)(self._analyze_query_uncached)
+
+    # Arrays que definen el almacén; se guardan y cargan tal cual en los snapshots del índice
+    ARRAYS = (
+        'token_ids', 'offsets', 'doc_lengths', 'token_docs', 'posting_terms', 'posting_docs',
+        'posting_freqs', 'posting_offsets', 'doc_freqs', 'term_positions', 'position_offsets'
+    )
+
+    @classmethod
+    def from_arrays(cls, vocabulary: Dict[str, int], arrays: Dict[str, np.ndarray],
+                    analyzer: SpanishAnalyzer = None) -> 'TokenStore':
+        """Reconstruye el almacén sin reanalizar el corpus (p. ej. con arrays mapeados en memoria)"""
+        store = cls.__new__(cls)
+        store.analyzer = analyzer or SpanishAnalyzer()
+        store.vocabulary = vocabulary
+        for name in cls.ARRAYS:
+            setattr(store, name, arrays[name])
+        store.num_docs = len(store.offsets) - 1
+        store._analyze_query = lru_cache(maxsize=4096)(store._analyze_query_uncached)
+        return store
+
+    @property
+    def vocab_size(self) -> int:
+        return len(self.vocabulary)
+
+    def _build_postings(self):
+        """Postings por término: chunks ordenados y frecuencia del término en cada uno"""
+        doc_of_token = np.repeat(np.arange(self.num_docs, dtype=np.int32), self.doc_lengths)
+        self.token_docs = doc_of_token
+        # Pares (término, chunk) únicos con su frecuencia, ordenados por término
+        keys = self.token_ids.astype(np.int64) * max(self.num_docs, 1) + doc_of_token
+        unique_keys, counts = np.unique(keys, return_counts=True)
+        self.posting_terms = (unique_keys // max(self.num_docs, 1)).astype(np.int32)
+        self.posting_docs = (unique_keys % max(self.num_docs, 1)).astype(np.int32)
+        self.posting_freqs = counts.astype(np.int32)
+        self.posting_offsets = np.searchsorted(self.posting_terms, np.arange(self.vocab_size + 1)).astype(np.int64)
+        self.doc_freqs = np.diff(self.posting_offsets).astype(np.int32)
+
+        # Postings posicionales: posiciones globales de cada término, agrupadas por término
+        self.term_positions = np.argsort(self.token_ids, kind='stable').astype(np.int64)
+        self.position_offsets = np.searchsorted(
+            self.token_ids[self.term_positions], np.arange(self.vocab_size + 1)
+        ).astype(np.int64)
+
+    def postings(self, term_id: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.posting_offsets[term_id], self.posting_offsets[term_id + 1]
+        return self.posting_docs[start:end], self.posting_freqs[start:end]
+
+    def positions(self, term_id: int) -> np.ndarray:
+        """Posiciones (índices en `token_ids`) donde aparece el término"""
+        return self.term_positions[self.position_offsets[term_id]:self.position_offsets[term_id + 1]]
+
+    def doc_tokens(self, doc_id: int) -> np.ndarray:
+        return self.token_ids[self.offsets[doc_id]:self.offsets[doc_id + 1]]
+
+    def _analyze_query_uncached(self, text: str) -> Tuple[int, ...]:
+        return tuple(
+            self.vocabulary[token] for token in self.analyzer(text)
+            if token in self.vocabulary
+        )
+
+    def analyze_query(self, text: str) -> Tuple[int, ...]:
+        """Ids de los términos de la consulta presentes en el vocabulario (con caché)"""
+        return self._analyze_query(text)
+
+    def term_counts_matrix(self):
+        """Matriz dispersa chunks x términos con las frecuencias, para TF-IDF"""
+        from scipy.sparse import csr_matrix
+        return csr_matrix(
+            (self.posting_freqs, (self.posting_docs, self.posting_terms)),
+            shape=(self.num_docs, self.vocab_size),
+            dtype=np.float64
+        )
+
+    def query_counts_vector(self, term_ids: Tuple[int, ...]):
+        from scipy.sparse import csr_matrix
+        terms, counts = np.unique(np.asarray(term_ids, dtype=np.int64), return_counts=True)
+        return csr_matrix(
+            (counts.astype(np.float64), (np.zeros(len(terms), dtype=np.int64), terms)),
+            shape=(1, self.vocab_size)
+        )
@@ -0,0 +1,56 @@
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+
+
+def l2_relevance(distance: float) -> float:
+    """Relevancia en [0, 1] a partir de la distancia L2 al cuadrado entre vectores normalizados"""
+    return 1.0 - distance / 2 ** 0.5
+
+
+class ChromaIndex:
+    """
+    Colección de Chroma en memoria con los embeddings de los chunks.
+
+    Solo usa la API pública de `chromadb` (crear la colección, `add`, `query`
+    y `get`): Chroma guarda el vector y el id de cada chunk, y la relevancia se
+    calcula aquí con la misma fórmula que la búsqueda exacta sobre un snapshot.
+    """
+
+    def __init__(self, name: str):
+        # Importación diferida: con un snapshot la búsqueda es exacta y no hace falta Chroma
+        import chromadb
+        client = chromadb.EphemeralClient()
+        # Sin función de embeddings propia: los vectores los calcula el backend de inferencia
+        self.collection = client.create_collection(name=name, metadata={'hnsw:space': 'l2'}, embedding_function=None)
+
+    def add(self, ids: Sequence[int], embeddings: List[List[float]]):
+        self.collection.add(
+            ids=[str(idx) for idx in ids],
+            embeddings=embeddings,
+            metadatas=[{'chunk_id': int(idx)} for idx in ids]
+        )
+
+    def search(self, query_vector: np.ndarray, k: int, allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """Los `k` chunks más cercanos (entre los permitidos) como (chunk_id, relevancia)"""
+        if not k:
+            return []
+        where = {'chunk_id': {'$in': allowed.tolist()}} if allowed is not None else None
+        results = self.collection.query(
+            query_embeddings=[np.asarray(query_vector, dtype=np.float32).tolist()],
+            n_results=k, where=where, include=['metadatas', 'distances']
+        )
+        return [
+            (int(metadata['chunk_id']), l2_relevance(distance))
+            for metadata, distance in zip(results['metadatas'][0], results['distances'][0])
+        ]
+
+    def matrix(self, num_chunks: int) -> np.ndarray:
+        """Embedding de cada chunk en el orden de los ids"""
+        result = self.collection.get(include=['embeddings'])
+        embeddings = result['embeddings']
+        if not len(embeddings):
+            return np.zeros((num_chunks, 0), dtype=np.float32)
+        matrix = np.zeros((num_chunks, len(embeddings[0])), dtype=np.float32)
+        for chunk_id, vector in zip(result['ids'], embeddings):
+            matrix[int(chunk_id)] = vector
+        return matrix
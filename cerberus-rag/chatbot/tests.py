@@ -1,3 +1,1095 @@
-from django.test import TestCase
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import logging
+import threading
+import multiprocessing
+from collections import Counter
+import tempfile
+from io import StringIO
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import SkipTest, mock
 
-# Create your tests here.
+from django.contrib.auth.models import AnonymousUser, User
+from channels.testing import WebsocketCommunicator
+import numpy as np
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+from django.test import AsyncClient, SimpleTestCase, TestCase, override_settings
+from asgiref.sync import async_to_sync
+from django.urls import reverse
+from django.utils import timezone
+from langchain.schema import Document
+
+from . import consumers, log_pipeline, repository
+from .apps import is_server_process
+from .log_pipeline import AsyncLogHandler, JsonFormatter, request_id_var
+from .models import ArchivedConversation, Conversation, Feedback, Message
+from .management.commands.bench_inference import SAMPLE_PASSAGES, SAMPLE_QUERIES
+from .services import inference, prompt_builder, sharding
+from .services.batch_qa import resume_output
+from .services.chat_service import ChatService
+from .services.chunk_store import ChunkStore
+from .services.document_loader import DocumentLoader
+from .services.feedback_journal import FeedbackJournal
+from .services.index_snapshot import IndexSnapshot, index_config, source_fingerprint
+from .services.keyword_index import KeywordIndex
+from .services.llm_router import LLMRouter
+from .services.metadata_index import InvalidFilterError, MetadataIndex
+from .services.message_writer import MessageWriter
+from .services.retention import RetentionService
+from .services.profiling import SamplingProfiler
+from .services.prompt_builder import PromptBuilder
+from .services.retrieval import BM25L, RetrievalService
+from .services.retrieval_cache import RetrievalCache
+from .services.retrieval_executor import RetrievalExecutor
+from .services.text_analysis import TokenStore
+from .views import chat_views
+
+
+def chunk(text, start=None, source='data/reglamento.pdf', page=0):
+    metadata = {'source': source, 'page': page}
+    if start is not None:
+        metadata['start_index'] = start
+    return Document(page_content=text, metadata=metadata)
+
+
+def word_count(text):
+    return len(text.split())
+
+
+@mock.patch.object(prompt_builder, 'get_tokenizer', lambda name: word_count)
+class PromptBuilderTests(SimpleTestCase):
+    def test_overlap_removed_by_start_index(self):
+        page = "El estudiante debe inscribir asignaturas. La matrícula se paga antes del plazo fijado."
+        first, second = page[:50], page[30:]
+        texts = PromptBuilder().deduplicate_chunks([chunk(first, 0), chunk(second, 30)])
+        self.assertEqual(texts, [first.strip(), page[50:].strip()])
+
+    def test_contained_chunk_dropped(self):
+        page = "Artículo 1. Los estudiantes de pregrado conservan la calidad de estudiante."
+        texts = PromptBuilder().deduplicate_chunks([chunk(page, 0), chunk(page[10:40], 10)])
+        self.assertEqual(texts, [page])
+
+    def test_other_page_not_trimmed(self):
+        text = "La matrícula se paga antes del plazo fijado por la universidad."
+        texts = PromptBuilder().deduplicate_chunks([chunk(text, 0, page=0), chunk(text, 0, page=1)])
+        self.assertEqual(len(texts), 2)
+
+    def test_overlap_by_content_without_start_index(self):
+        shared = "la matrícula se paga antes del plazo"
+        texts = PromptBuilder(min_overlap=10).deduplicate_chunks([
+            chunk(f"Según el reglamento, {shared}"), chunk(f"{shared} fijado por la sede.")
+        ])
+        self.assertEqual(texts[1], "fijado por la sede.")
+
+    def test_truncated_tail_uses_token_threshold(self):
+        builder = PromptBuilder(min_overlap=1000, min_tail_tokens=3)
+        context = builder._pack_context(["uno dos tres", "cuatro cinco seis siete ocho"], budget=7)
+        self.assertEqual(context, "uno dos tres\ncuatro cinco seis siete")
+        self.assertEqual(PromptBuilder(min_tail_tokens=5)._pack_context(["uno dos tres", "cuatro cinco"], 4), "uno dos tres")
+
+    def test_explicit_zero_is_kept(self):
+        builder = PromptBuilder(history_budget=0, min_overlap=0, min_tail_tokens=0)
+        self.assertEqual((builder.history_budget, builder.min_overlap, builder.min_tail_tokens), (0, 0, 0))
+        with override_settings(CHATBOT_PROMPT_MIN_TAIL_TOKENS=0):
+            self.assertEqual(PromptBuilder().min_tail_tokens, 0)
+        # Sin mínimo, el chunk que no cabe entero se recorta aunque solo quepa una palabra
+        self.assertEqual(builder._pack_context(["uno dos tres", "cuatro cinco"], 4), "uno dos tres\ncuatro")
+
+
+class PromptTokenizerTests(SimpleTestCase):
+    def test_fallback_overcounts_and_is_reported(self):
+        text = "Las inscripciones extemporáneas requieren autorización del consejo de facultad."
+        self.assertGreater(prompt_builder._approximate_token_count(text), len(text.split()))
+        with mock.patch.dict(prompt_builder.tokenizer_status), mock.patch.dict('sys.modules', {'transformers': None}):
+            count = prompt_builder.get_tokenizer.__wrapped__('modelo/inexistente')
+            self.assertEqual((prompt_builder.tokenizer_status['name'], prompt_builder.tokenizer_status['exact']),
+                             ('modelo/inexistente', False))
+        self.assertIs(count, prompt_builder._approximate_token_count)
+
+
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        self.writer = MessageWriter(flush_interval=60)
+
+    def test_invalid_message_does_not_block_batch(self):
+        conversation = Conversation(session_id='s1')
+        self.writer.add_conversation(conversation)
+        good = Message(conversation=conversation, role='user', content='hola')
+        bad = Message(conversation=conversation, role='user', content=None)
+        later = Message(conversation=conversation, role='assistant', content='respuesta')
+        for message in (good, bad, later):
+            self.writer.add_message(message)
+        self.assertEqual(self.writer.pending_count, 0)
+        self.assertEqual(
+            set(Message.objects.values_list('id', flat=True)), {good.id, later.id}
+        )
+
+    def test_deleted_conversation_not_recreated(self):
+        conversation = Conversation.objects.create(session_id='s1')
+        loaded = Conversation.objects.get(id=conversation.id)
+        Conversation.objects.filter(id=conversation.id).delete()
+        self.writer.add_message(Message(conversation=loaded, role='user', content='hola'))
+        self.assertFalse(Conversation.objects.exists())
+        self.assertFalse(Message.objects.exists())
+
+    def test_existing_conversation_touched(self):
+        conversation = Conversation.objects.create(session_id='s1')
+        before = conversation.updated_at
+        self.writer.add_message(Message(conversation=conversation, role='user', content='hola'))
+        conversation.refresh_from_db()
+        self.assertGreater(conversation.updated_at, before)
+        self.assertEqual(conversation.messages.count(), 1)
+
+
+@override_settings(CHATBOT_ARCHIVE_DIR=tempfile.mkdtemp())
+class RetentionTests(TestCase):
+    def setUp(self):
+        self.service = RetentionService(retention_days=30)
+        self.old = timezone.now() - timedelta(days=60)
+
+    def idle_conversation(self, session_id='s1'):
+        conversation = Conversation.objects.create(session_id=session_id)
+        message = Message.objects.create(conversation=conversation, role='assistant', content='respuesta')
+        Feedback.objects.create(message=message, rating=4, created_at=self.old)
+        Conversation.objects.filter(id=conversation.id).update(updated_at=self.old)
+        return conversation
+
+    def test_archive_and_restore(self):
+        conversation = self.idle_conversation()
+        self.assertEqual(self.service.archive_idle(), 1)
+        self.assertFalse(Conversation.objects.exists())
+
+        restored = self.service.restore(conversation.id)
+        self.assertEqual(restored.messages.count(), 1)
+        self.assertEqual(Feedback.objects.get().created_at, self.old)
+        # Restaurada = activa: la siguiente pasada no la vuelve a archivar
+        self.assertGreater(restored.updated_at, timezone.now() - timedelta(minutes=1))
+        self.assertEqual(self.service.archive_idle(), 0)
+
+    def test_activity_during_archive_keeps_conversation(self):
+        conversation = self.idle_conversation()
+        serialize = self.service._serialize
+
+        def serialize_then_write(conv):
+            record = serialize(conv)
+            Message.objects.create(conversation_id=conv.id, role='user', content='nueva pregunta')
+            Conversation.objects.filter(id=conv.id).update(updated_at=timezone.now())
+            return record
+
+        with mock.patch.object(self.service, '_serialize', serialize_then_write):
+            self.assertEqual(self.service.archive_idle(), 0)
+        self.assertEqual(Conversation.objects.get(id=conversation.id).messages.count(), 2)
+        self.assertFalse(ArchivedConversation.objects.exists())
+
+    def test_restore_requires_owner(self):
+        conversation = self.idle_conversation(session_id='owner')
+        self.service.archive_idle()
+        with self.assertRaises(Conversation.DoesNotExist):
+            async_to_sync(repository.get_conversation)(conversation.id, session_id='intruder')
+        self.assertTrue(ArchivedConversation.objects.filter(id=conversation.id).exists())
+        restored = async_to_sync(repository.get_conversation)(conversation.id, session_id='owner')
+        self.assertEqual(restored.id, conversation.id)
+
+    def test_lookups_without_owner_are_refused(self):
+        conversation = self.idle_conversation(session_id='owner')
+        self.service.archive_idle()
+        with self.assertRaises(ValueError):
+            async_to_sync(repository.get_conversation)(conversation.id)
+        # Ni el chat HTTP ni el consumer continúan (ni restauran) la conversación de otra sesión
+        response = self.client.post(reverse('chatbot:chat_api'), {'query': 'hola', 'conversation_id': str(conversation.id)},
+                                    content_type='application/json')
+        self.assertEqual((response.status_code, response.json()), (404, {'error': 'Conversation not found'}))
+        self.assertEqual(
+            async_to_sync(repository.load_conversation_with_history)(conversation.id, session_id='intruder'), (None, [])
+        )
+        self.assertTrue(ArchivedConversation.objects.filter(id=conversation.id).exists())
+
+
+class FeedbackJournalTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def test_always_is_durable_on_return(self):
+        journal = FeedbackJournal(directory=self.directory, fsync_policy='always', flush_interval=60)
+        journal.record("¿plazo?", "El 30 de junio", 5, message_id='m1')
+        with open(journal.current_path, encoding='utf-8') as f:
+            self.assertIn('"m1"', f.read())
+
+    def test_one_active_file_per_process(self):
+        journal = FeedbackJournal(directory=self.directory, fsync_policy='batch', flush_interval=60)
+        self.assertTrue(journal.current_path.endswith(f"feedback-current-{os.getpid()}.jsonl"))
+        journal.record("a", "b", 4)
+        journal.flush()
+        journal.rotate()
+        self.assertEqual(len(glob.glob(os.path.join(self.directory, f'feedback-*-{os.getpid()}-000.jsonl.gz'))), 1)
+        # Fichero activo de un proceso que ya terminó: se incluye en la exportación y se puede comprimir
+        with open(os.path.join(self.directory, 'feedback-current-999999999.jsonl'), 'w', encoding='utf-8') as f:
+            f.write('{"timestamp": 1.0, "rating": 3}\n')
+        self.assertEqual([event['rating'] for event in journal.iter_events()], [4, 3])
+        self.assertEqual(journal.rotate_stale(), 1)
+        self.assertEqual(len(list(journal.iter_events())), 2)
+
+
+class InferenceParityTests(SimpleTestCase):
+    """El backend ONNX int8 debe puntuar como el de PyTorch; se omite si ONNX Runtime no está disponible"""
+
+    # Similitud mínima entre embeddings y diferencia máxima entre logits del cross-encoder (rango ~[-11, 11])
+    MIN_COSINE = 0.99
+    MAX_LOGIT_DRIFT = 0.25
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        try:
+            cls.onnx_embeddings = inference.OnnxEmbeddings()
+            cls.onnx_cross_encoder = inference.OnnxCrossEncoder()
+            cls.torch_embeddings = inference._torch_embeddings(inference.EMBEDDING_MODEL)
+            cls.torch_cross_encoder = inference._torch_cross_encoder(inference.CROSS_ENCODER_MODEL)
+        except Exception as e:
+            raise SkipTest(f"Modelos ONNX o PyTorch no disponibles: {str(e)}")
+
+    def test_embeddings_match(self):
+        torch_vectors = np.asarray(self.torch_embeddings.embed_documents(SAMPLE_PASSAGES))
+        onnx_vectors = np.asarray(self.onnx_embeddings.embed_documents(SAMPLE_PASSAGES))
+        cosine = (torch_vectors * onnx_vectors).sum(axis=1) / (
+            np.linalg.norm(torch_vectors, axis=1) * np.linalg.norm(onnx_vectors, axis=1)
+        )
+        self.assertGreaterEqual(cosine.min(), self.MIN_COSINE)
+
+    def test_cross_encoder_scores_and_ranking_match(self):
+        passages = SAMPLE_PASSAGES[:4]
+        pairs = [[query, passage] for query in SAMPLE_QUERIES for passage in passages]
+        torch_scores = np.asarray(self.torch_cross_encoder.predict(pairs))
+        onnx_scores = np.asarray(self.onnx_cross_encoder.predict(pairs))
+        self.assertLessEqual(np.abs(torch_scores - onnx_scores).max(), self.MAX_LOGIT_DRIFT)
+        for start in range(0, len(pairs), len(passages)):
+            self.assertEqual(
+                list(np.argsort(-torch_scores[start:start + len(passages)])),
+                list(np.argsort(-onnx_scores[start:start + len(passages)]))
+            )
+class CascadeRerankTests(SimpleTestCase):
+    # Primera etapa con 8 candidatos; el corte de top_k=3 cae entre los chunks 3 y 4
+    ranked = [1, 2, 3, 4, 5, 6, 7, 8]
+
+    def setUp(self):
+        self.service = RetrievalService(ChunkStore([chunk(f"Artículo {i}") for i in range(10)]))
+
+    def fused(self, fourth):
+        return {1: 0.9, 2: 0.8, 3: 0.7, 4: fourth, 5: 0.3, 6: 0.2, 7: 0.1, 8: 0.05}
+
+    def plan(self, fused, vector_ranked, bm25l_ranked, top_k=3, ranked=None):
+        trace = {}
+        plan = self.service._cascade_plan(ranked or self.ranked, fused, vector_ranked, bm25l_ranked, top_k, trace)
+        return plan, trace
+
+    def test_clear_margin_and_agreement_skip_the_cross_encoder(self):
+        (head, candidates), trace = self.plan(self.fused(0.3), [1, 2, 3], [2, 1, 3])
+        self.assertEqual((head, candidates), (0, []))
+        self.assertEqual(trace, {'agreement': 3, 'margin': 0.4444, 'rerank': 'skipped'})
+        self.assertEqual(self.service.cascade_stats['skipped'], 1)
+
+    def test_tight_margin_reranks_after_the_agreed_head(self):
+        (head, candidates), trace = self.plan(self.fused(0.68), [1, 2, 9], [1, 3, 2])
+        self.assertEqual(head, 2)
+        self.assertEqual(candidates, [3, 4, 5, 6, 7, 8])
+        self.assertEqual(trace['agreement'], 2)
+        self.assertNotIn('rerank', trace)
+
+    def test_no_agreement_reranks_everything(self):
+        (head, candidates), trace = self.plan(self.fused(0.3), [1, 2, 3], [4, 5, 6], ranked=[1, 2, 3, 4])
+        self.assertEqual((head, candidates), (0, [1, 2, 3, 4]))
+        self.assertEqual(trace['agreement'], 0)
+
+    def test_head_covering_top_k_skips_the_rerank(self):
+        (head, candidates), trace = self.plan(self.fused(0.68), [1, 2, 3], [2, 1, 9], top_k=2)
+        self.assertEqual((head, candidates), (0, []))
+        self.assertEqual(trace['rerank'], 'skipped')
+
+    def test_disabled_cascade_reranks_every_candidate(self):
+        self.service.cascade_enabled = False
+        (head, candidates), _ = self.plan(self.fused(0.3), [1, 2, 3], [2, 1, 3])
+        self.assertEqual((head, candidates), (0, self.ranked))
+
+    def test_apply_rerank_keeps_head_and_tail(self):
+        trace = {}
+        fused = self.fused(0.68)
+        order = self.service._apply_rerank(self.ranked, fused, 2, [3, 4, 5], [0.1, 0.9, 0.5], trace)
+        self.assertEqual(order, [1, 2, 4, 5, 3, 6, 7, 8])
+        self.assertEqual(trace, {'rerank': 'partial', 'reranked': 3})
+
+        trace = {}
+        order = self.service._apply_rerank([1, 2, 3], fused, 0, [1, 2, 3], [0.0, 0.2, 0.9], trace)
+        self.assertEqual(order, [3, 2, 1])
+        self.assertEqual(trace['rerank'], 'full')
+        self.assertEqual(dict(self.service.cascade_stats), {'partial': 1, 'full': 1})
+
+    def test_cascade_rerank_only_scores_the_candidates(self):
+        self.service.cross_encoder = mock.Mock()
+        self.service.cross_encoder.predict.side_effect = lambda pairs: [0.9 if '8' in text else 0.0 for _, text in pairs]
+        trace = {}
+        order = self.service._cascade_rerank(self.ranked, self.fused(0.68), [1, 2, 9], [1, 3, 2], 'becas', 3, trace)
+        pairs = self.service.cross_encoder.predict.call_args.args[0]
+        self.assertEqual([text for _, text in pairs], [f"Artículo {i}" for i in range(3, 9)])
+        self.assertEqual(order[:3], [1, 2, 8])
+        self.assertEqual(trace['rerank'], 'partial')
+
+
+class CascadeReportTests(TestCase):
+    def test_report_groups_answers_and_ratings_by_mode(self):
+        conversation = Conversation.objects.create(session_id='s1')
+        for mode, rating in [('skipped', 5), ('skipped', 3), ('partial', 4), ('full', None), (None, None)]:
+            metadata = {'rerank': mode} if mode else {}
+            message = Message.objects.create(conversation=conversation, role='assistant', content='respuesta',
+                                             metadata=metadata)
+            if rating:
+                Feedback.objects.create(message=message, rating=rating)
+        Message.objects.create(conversation=conversation, role='user', content='pregunta', metadata={'rerank': 'full'})
+
+        out = StringIO()
+        call_command('cascade_report', stdout=out)
+        rows = {line.split()[0]: line.split() for line in out.getvalue().splitlines()[1:]}
+        self.assertEqual(rows, {
+            'skipped': ['skipped', '2', '50.0%', '2', '4.00'],
+            'partial': ['partial', '1', '25.0%', '1', '4.00'],
+            'full': ['full', '1', '25.0%', '0', '-'],
+        })
+
+
+class RetrievalExecutorTests(SimpleTestCase):
+    def test_queue_wait_does_not_count_against_timeout(self):
+        executor = RetrievalExecutor(max_workers=1, spare_workers=0, timeouts={'default': 0.2})
+
+        async def scenario():
+            busy = asyncio.ensure_future(executor.run_one(time.sleep, 0.4))
+            await asyncio.sleep(0.01)
+            results = await executor.run_all({'bm25l': lambda: 'ok'})
+            await busy
+            return results
+
+        self.assertEqual(asyncio.run(scenario()), {'bm25l': 'ok'})
+        executor.shutdown()
+
+    def test_timed_out_work_is_tracked_until_it_finishes(self):
+        executor = RetrievalExecutor(max_workers=1, spare_workers=1, timeouts={'default': 0.05})
+
+        async def scenario():
+            results = await executor.run_all({'vector': lambda: time.sleep(0.3) or 'tarde'})
+            abandoned = executor.abandoned
+            await asyncio.sleep(0.4)
+            return results, abandoned
+
+        results, abandoned = asyncio.run(scenario())
+        self.assertEqual(results, {'vector': None})
+        self.assertEqual((abandoned, executor.abandoned), (1, 0))
+        self.assertEqual(executor.stats['vector_timeouts'], 1)
+        executor.shutdown()
+
+    def test_workers_see_the_request_context(self):
+        executor = RetrievalExecutor(max_workers=1, spare_workers=0)
+
+        async def scenario():
+            request_id_var.set('req-1')
+            return (await executor.run_one(request_id_var.get),
+                    await executor.run_all({'bm25l': request_id_var.get}))
+
+        self.assertEqual(asyncio.run(scenario()), ('req-1', {'bm25l': 'req-1'}))
+        executor.shutdown()
+
+
+class TokenStoreTests(SimpleTestCase):
+    texts = [
+        "El plazo de la matrícula termina en septiembre",
+        "MATRICULA de asignaturas y plazos de pago del año",
+        "Las becas cubren las actividades y los lápices",
+        "Beca de actividad para el ano académico",
+    ]
+
+    def setUp(self):
+        self.store = TokenStore(self.texts)
+
+    def test_accents_and_case_are_folded_but_not_the_eñe(self):
+        analyzer = self.store.analyzer
+        self.assertEqual(analyzer("Matrícula"), analyzer("MATRICULA"))
+        self.assertEqual(analyzer("académico"), analyzer("ACADEMICO"))
+        self.assertNotEqual(analyzer("año"), analyzer("ano"))
+
+    def test_stopwords_are_dropped(self):
+        self.assertEqual(self.store.analyzer("El plazo de la matrícula"), ['plaz', 'matricul'])
+        self.assertEqual(self.store.analyze_query("de la y los"), ())
+
+    def test_stemming_merges_plurals_and_gender(self):
+        analyzer = self.store.analyzer
+        for plural, singular in [("becas", "beca"), ("plazos", "plazo"), ("actividades", "actividad"),
+                                 ("lápices", "lápiz"), ("académicas", "académico")]:
+            with self.subTest(plural=plural):
+                self.assertEqual(analyzer(plural), analyzer(singular))
+
+    def test_postings_match_the_analyzed_corpus(self):
+        self.assertEqual(self.store.token_ids.dtype, np.int32)
+        analyzed = [Counter(self.store.analyzer(text)) for text in self.texts]
+        for term, term_id in self.store.vocabulary.items():
+            docs, freqs = self.store.postings(term_id)
+            expected = {doc: counts[term] for doc, counts in enumerate(analyzed) if term in counts}
+            self.assertEqual(dict(zip(docs.tolist(), freqs.tolist())), expected, term)
+            self.assertEqual(self.store.doc_freqs[term_id], len(expected))
+        self.assertEqual(self.store.doc_lengths.tolist(), [sum(counts.values()) for counts in analyzed])
+
+        # Los arrays se recargan tal cual desde un snapshot
+        arrays = {name: getattr(self.store, name) for name in TokenStore.ARRAYS}
+        restored = TokenStore.from_arrays(self.store.vocabulary, arrays)
+        self.assertEqual(restored.analyze_query("becas de matrícula"), self.store.analyze_query("becas de matrícula"))
+
+    def test_bm25l_matches_a_reference_over_the_tokens(self):
+        k1, b, delta = 1.2, 0.75, 0.5
+        query = "plazos de matrícula y becas"
+        bm25 = BM25L(self.store, k1=k1, b=b, delta=delta)
+
+        analyzed = [Counter(self.store.analyzer(text)) for text in self.texts]
+        lengths = [sum(counts.values()) for counts in analyzed]
+        avg_length = sum(lengths) / len(lengths)
+        expected = []
+        for counts, length in zip(analyzed, lengths):
+            score = 0.0
+            for term in self.store.analyzer(query):
+                df = sum(term in other for other in analyzed)
+                if counts[term]:
+                    idf = np.log((len(analyzed) - df + 0.5) / (df + 0.5))
+                    norm = k1 * (1 - b + b * length / avg_length)
+                    score += idf * counts[term] * (k1 + 1) / (counts[term] + norm) + delta
+            expected.append(score)
+        np.testing.assert_allclose(bm25.get_scores(self.store.analyze_query(query)), expected)
+
+    def test_tfidf_matches_sklearn_on_the_same_analyzer(self):
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        service = RetrievalService(ChunkStore([chunk(text) for text in self.texts]))
+        service.token_store = self.store
+        service._init_tfidf()
+        vectorizer = TfidfVectorizer(analyzer=self.store.analyzer)
+        matrix = vectorizer.fit_transform(self.texts)
+        for query in ("plazos de matrícula", "becas para actividades", "año"):
+            with self.subTest(query=query):
+                expected = (matrix @ vectorizer.transform([query]).T).toarray().ravel()
+                np.testing.assert_allclose(service.tfidf_scores(query), expected)
+
+
+class LogPipelineTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.handler = AsyncLogHandler(filename=os.path.join(tmp.name, 'chatbot.{process}.log'))
+        self.addCleanup(self.handler.close)
+        # Solo el handler de la prueba: el de LOGGING sigue escribiendo en su fichero
+        patcher = mock.patch.object(log_pipeline, '_handlers', [self.handler])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, log_pipeline, '_process_name', None)
+
+    def test_file_is_named_after_the_process(self):
+        with mock.patch.object(sys, 'argv', ['manage.py', 'batch_qa', 'in.jsonl', 'out.jsonl']):
+            self.assertEqual(log_pipeline.log_process_name(), 'batch_qa')
+        with mock.patch.object(sys, 'argv', ['manage.py', 'runserver']), mock.patch.dict(os.environ, {'RUN_MAIN': ''}):
+            self.assertEqual(log_pipeline.log_process_name(), 'runserver-reloader')
+
+        log_pipeline.set_log_process('worker-1')
+        self.assertEqual(self.handler.file_handler.baseFilename, os.path.join(self.dir, 'chatbot.worker-1.log'))
+        # Tras fork() el hilo escritor del padre no existe: se simula deteniéndolo
+        self.handler.listener.stop()
+        self.handler._restart_after_fork()
+        self.assertEqual(self.handler.file_handler.baseFilename, os.path.join(self.dir, 'chatbot.worker-1.log'))
+
+    def test_prune_removes_logs_of_missing_workers(self):
+        names = ['chatbot.worker-0.log', 'chatbot.worker-3.log', 'chatbot.worker-3.log.1', 'chatbot.runserver.log']
+        for name in names:
+            open(os.path.join(self.dir, name), 'w').close()
+        log_pipeline.prune_worker_logs(2)
+        self.assertEqual(sorted(os.listdir(self.dir)), ['chatbot.runserver.log', 'chatbot.worker-0.log'])
+
+    def test_formatter_applies_to_console(self):
+        formatter = logging.Formatter('{levelname} {message}', style='{')
+        self.handler.setFormatter(formatter)
+        self.assertIs(self.handler.console.formatter, formatter)
+        self.assertIsInstance(self.handler.file_handler.formatter, JsonFormatter)
+
+
+class KeywordIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = KeywordIndex(TokenStore([
+            "El reglamento estudiantil regula la matrícula",
+            "Calendario de inscripción de asignaturas",
+            "Reglamentos de bienestar universitario",
+        ]))
+
+    def test_prefix_matches_stemmed_vocabulary(self):
+        self.assertEqual({doc for doc, _ in self.index.search("reglamento*")}, {0, 2})
+        self.assertEqual({doc for doc, _ in self.index.search("Reglamentos*")}, {0, 2})
+        self.assertEqual([doc for doc, _ in self.index.search("inscrip*")], [1])
+
+
+class DocumentLoaderDedupTests(SimpleTestCase):
+    def load(self, pages, **kwargs):
+        loader = DocumentLoader(['data/reglamento.pdf'], deduplicate=True, **kwargs)
+        with mock.patch.object(loader, '_load_pdf', return_value=pages):
+            return loader, loader.load_documents()
+
+    @override_settings(CHATBOT_DEDUP_THRESHOLD=0.85)
+    def test_threshold_is_a_parameter(self):
+        text = "El estudiante debe inscribir las asignaturas del semestre dentro del plazo fijado por la sede"
+        pages = [chunk(text, page=0), chunk(text.replace('sede', 'facultad de ingeniería'), page=1)]
+        self.assertEqual(len(self.load(list(pages))[1]), 2)
+        loader, docs = self.load(list(pages), dedup_threshold=0.5)
+        self.assertEqual((len(docs), loader.dedup_report['near_duplicates']), (1, 1))
+        from django.conf import settings
+        self.assertEqual(settings.CHATBOT_DEDUP_THRESHOLD, 0.85)
+
+    def test_empty_corpus_has_no_report(self):
+        loader, docs = self.load([])
+        self.assertEqual((docs, loader.dedup_report), ([], None))
+
+
+class MetadataIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = MetadataIndex(ChunkStore([
+            Document(page_content="Artículo 1", metadata={'source': 'data/reglamento_estudiantil.pdf', 'page': 0,
+                                                          'ingested_at': '2024-01-10'}),
+            Document(page_content="Inscripciones", metadata={'source': 'data/calendario_2025.pdf', 'page': 2,
+                                                             'ingested_at': '2025-02-01'}),
+        ]))
+
+    def test_valid_filters_select_chunks(self):
+        self.assertEqual(list(self.index.select({'source': 'reglamento_estudiantil.pdf'})), [0])
+        self.assertEqual(list(self.index.select({'page': [2, 3], 'ingested_after': '2025-01-01'})), [1])
+        # Tipo válido sin documentos en el corpus: contexto vacío, no error
+        self.assertEqual(list(self.index.select({'doc_type': 'circular'})), [])
+
+    def test_invalid_explicit_filters_raise(self):
+        for filters in ({'source': 'no_existe.pdf'}, {'ingested_after': '2025-13-01'}, {'page': 0},
+                        {'doc_type': 'memorando'}, {'fuente': 'x'}, ['reglamento']):
+            with self.subTest(filters=filters), self.assertRaises(InvalidFilterError):
+                self.index.validate(filters)
+
+    def test_detected_filters_are_traced(self):
+        from .services.retrieval import RetrievalService
+        service = RetrievalService.__new__(RetrievalService)
+        service.metadata_index, service.chunks = self.index, ChunkStore([Document(page_content="a"), Document(page_content="b")])
+        trace = {}
+        service._allowed("¿Qué dice el calendario 2025?", None, trace)
+        self.assertEqual(trace['filters'], {'source': ['calendario_2025.pdf']})
+        self.assertTrue(trace['filters_detected'])
+        trace = {}
+        service._allowed("plazos", {'source': 'calendario_2025'}, trace)
+        self.assertFalse(trace['filters_detected'])
+
+
+def _slow_echo_worker(conn, shard_id):
+    while True:
+        seq, op, payload = conn.recv()
+        if op == 'stop':
+            break
+        time.sleep(payload['delay'])
+        conn.send((seq, 'ok', payload['value']))
+
+
+class ShardClientTests(SimpleTestCase):
+    def test_late_reply_is_not_delivered_to_next_request(self):
+        with mock.patch.object(sharding, '_shard_worker', _slow_echo_worker):
+            client = sharding.ShardClient(multiprocessing.get_context('fork'), 0)
+        try:
+            late = client.submit('search', {'delay': 0.3, 'value': 'antigua'})
+            with self.assertRaises(TimeoutError):
+                late.result(timeout=0.05)
+            client.abandon(late)
+            # No espera a que el shard responda la petición abandonada para enviar la siguiente
+            started = time.monotonic()
+            current = client.submit('search', {'delay': 0, 'value': 'nueva'})
+            self.assertLess(time.monotonic() - started, 0.1)
+            self.assertEqual(current.result(timeout=2), 'nueva')
+            self.assertFalse(late.done())
+        finally:
+            client.stop()
+
+
+class AnswerCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.service = ChatService.__new__(ChatService)
+        self.service.retrieval_service = mock.Mock(index_version='v1')
+
+    def test_key_depends_on_history_filters_and_index(self):
+        history = [{'role': 'user', 'content': '¿Cuándo es la matrícula?'}, {'role': 'assistant', 'content': 'En enero'}]
+        key = self.service._cache_key("¿Y el plazo?", history, None)
+        self.assertEqual(key, self.service._cache_key("¿y el  PLAZO?", [dict(m) for m in history], None))
+        self.assertNotEqual(key, self.service._cache_key("¿Y el plazo?", [], None))
+        self.assertNotEqual(key, self.service._cache_key("¿Y el plazo?", history, {'source': 'calendario'}))
+        self.service.retrieval_service.index_version = 'v2'
+        self.assertNotEqual(key, self.service._cache_key("¿Y el plazo?", history, None))
+
+
+class LoadMetricsTests(TestCase):
+    def test_only_staff_can_read_metrics(self):
+        url = reverse('chatbot:load_metrics_api')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        user = User.objects.create_user('operador', password='clave')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get(url).status_code, 302)
+        User.objects.filter(pk=user.pk).update(is_staff=True)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('tier', response.json())
+
+
+def fake_ollama(token_delay=0.02, status=200):
+    """Servidor HTTP mínimo con la API de generación de Ollama (NDJSON en streaming); responde `status` si no es 200"""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.0'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _json(self, payload, status=200):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self._json({'version': 'fake'})
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if status != 200:
+                self._json({'error': f"error {status}"}, status)
+                return
+            tokens = ["respuesta ", "de ", str(self.server.server_address[1])]
+            lines = [{'model': request.get('model'), 'created_at': '2025-01-01T00:00:00Z', 'response': token,
+                      'done': False} for token in tokens]
+            lines.append({'model': request.get('model'), 'created_at': '2025-01-01T00:00:00Z', 'response': '',
+                          'done': True, 'done_reason': 'stop'})
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            if not request.get('stream', True):
+                self.wfile.write(json.dumps({**lines[-1], 'response': ''.join(tokens)}).encode('utf-8'))
+                return
+            for line in lines:
+                time.sleep(token_delay)
+                self.wfile.write(json.dumps(line).encode('utf-8') + b"\n")
+                self.wfile.flush()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class LLMRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+
+    def endpoint(self, weight=1, **kwargs):
+        server = fake_ollama(**kwargs)
+        self.servers.append(server)
+        return {'url': f"http://127.0.0.1:{server.server_address[1]}", 'weight': weight}
+
+    @staticmethod
+    async def generate(router, total, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        answers = Counter()
+
+        async def one(i):
+            async with semaphore:
+                if i % 2:
+                    text = "".join([token async for token in router.astream("hola")])
+                else:
+                    text = await router.ainvoke("hola")
+                answers[text.rsplit(' ', 1)[-1]] += 1
+
+        await asyncio.gather(*(one(i) for i in range(total)))
+        return answers
+
+    def test_weighted_split_and_retry_on_broken_endpoint(self):
+        # El primer servidor sano pesa el doble; el roto (500) se declara sano para forzar reintentos
+        broken = self.endpoint(status=500)
+        router = LLMRouter('fake-model', 0.0, [broken, self.endpoint(weight=2), self.endpoint(), self.endpoint()])
+        answers = asyncio.run(self.generate(router, total=80, concurrency=12))
+
+        self.assertEqual(sum(answers.values()), 80)
+        self.assertFalse(router.endpoints[0].healthy)
+        heavy, *light = [answers[endpoint.url.rsplit(':', 1)[-1]] for endpoint in router.endpoints[1:]]
+        self.assertTrue(all(count > 0 for count in light))
+        # Con la carga repartida por (en curso + 1) / peso, el de peso 2 atiende bastante más que la media del resto
+        self.assertGreater(heavy, 1.4 * sum(light) / len(light))
+
+    def test_request_error_does_not_trip_endpoint(self):
+        router = LLMRouter('fake-model', 0.0, [self.endpoint(status=400), self.endpoint()])
+        router.endpoints[1].healthy = False
+        with self.assertRaises(Exception):
+            asyncio.run(router.ainvoke("hola"))
+        self.assertTrue(router.endpoints[0].healthy)
+        self.assertEqual((router.endpoints[0].failures, router.endpoints[1].requests), (0, 0))
+
+    def test_zero_weight_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            LLMRouter('fake-model', 0.0, [{'url': 'http://127.0.0.1:1', 'weight': 0}])
+
+
+class SamplingProfilerTests(SimpleTestCase):
+    def test_overlapping_requests_are_counted(self):
+        profiler = SamplingProfiler(interval=0.001)
+        profiler.arm(1)
+
+        async def scenario():
+            async with profiler.request():
+                async with profiler.request():
+                    await asyncio.sleep(0.02)
+            async with profiler.request():
+                pass
+
+        asyncio.run(scenario())
+        status = profiler.status()
+        self.assertEqual((status['profiled_requests'], status['overlapping_requests']), (1, 1))
+        self.assertEqual(status['scope'], 'process')
+        self.assertGreater(status['samples'], 0)
+
+
+class StartupTests(SimpleTestCase):
+    def test_only_server_processes_start_the_chat_service(self):
+        cases = [
+            (['manage.py', 'runserver'], {'RUN_MAIN': 'true'}, True),
+            (['manage.py', 'runserver'], {}, False),
+            (['manage.py', 'runserver', '--noreload'], {}, True),
+            (['/usr/local/bin/daphne', 'cerberus_chatbot.asgi:application'], {}, True),
+            (['/usr/lib/python3/site-packages/daphne/__main__.py', 'cerberus_chatbot.asgi:application'], {}, True),
+            (['manage.py', 'bench_inference'], {}, False),
+            (['manage.py', 'batch_qa', 'preguntas.jsonl'], {}, False),
+            (['manage.py', 'test'], {}, False),
+        ]
+        for argv, env, expected in cases:
+            with self.subTest(argv=argv), mock.patch('sys.argv', argv), mock.patch.dict(os.environ, env):
+                if 'RUN_MAIN' not in env:
+                    os.environ.pop('RUN_MAIN', None)
+                self.assertEqual(is_server_process(), expected)
+
+    def test_concurrent_initialize_runs_once(self):
+        calls = []
+
+        async def slow_initialize(service):
+            calls.append(threading.get_ident())
+            await asyncio.sleep(0.1)
+            return True
+
+        service = ChatService.__new__(ChatService)
+        results = []
+        with mock.patch.object(ChatService, '_initialize', slow_initialize):
+            # Hilo de arranque con su propio event loop y una petición en otro
+            threads = [threading.Thread(target=lambda: results.append(asyncio.run(service.initialize())))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual((len(calls), results), (1, [True, True, True]))
+        self.assertIsNone(ChatService._init_future)
+
+
+class IndexSnapshotConfigTests(SimpleTestCase):
+    def setUp(self):
+        pdf = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
+        pdf.write(b'%PDF-1.4')
+        pdf.close()
+        self.addCleanup(os.unlink, pdf.name)
+        self.pdf_files = [pdf.name]
+        self.snapshot = IndexSnapshot.__new__(IndexSnapshot)
+        self.snapshot.manifest = {'sources': source_fingerprint(self.pdf_files), **index_config()}
+
+    def test_matches_current_configuration(self):
+        self.assertTrue(self.snapshot.matches(self.pdf_files))
+
+    def test_config_changes_invalidate_snapshot(self):
+        changes = {
+            'CHATBOT_INFERENCE_BACKEND': 'onnx' if index_config()['inference_backend'] != 'onnx' else 'torch',
+            'CHATBOT_CHUNK_SIZE': 500,
+            'CHATBOT_CHUNK_OVERLAP': 50,
+            'CHATBOT_DEDUP_THRESHOLD': 0.7,
+        }
+        for setting, value in changes.items():
+            with self.subTest(setting=setting), override_settings(**{setting: value}):
+                self.assertFalse(self.snapshot.matches(self.pdf_files))
+        # Sin deduplicación el umbral no cuenta
+        with override_settings(CHATBOT_DEDUP_ENABLED=False):
+            self.snapshot.manifest.update(index_config())
+            with override_settings(CHATBOT_DEDUP_THRESHOLD=0.7):
+                self.assertTrue(self.snapshot.matches(self.pdf_files))
+
+
+class BatchQATests(SimpleTestCase):
+    def test_resume_drops_errors_duplicates_and_truncated_tail(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'salida.jsonl')
+            lines = [
+                {'id': '1', 'answer': 'a', 'error': None},
+                {'id': '2', 'answer': None, 'error': 'Error en la generación'},
+                {'id': '1', 'answer': 'b', 'error': None},
+                {'id': '3', 'answer': 'c', 'error': None},
+            ]
+            with open(path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(line) + '\n' for line in lines)
+                f.write('{"id": "4", "answ')
+
+            self.assertEqual(resume_output(path), {'1', '3'})
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual([json.loads(line)['answer'] for line in f], ['a', 'c'])
+
+    def test_batch_generation_does_not_feed_load_controller(self):
+        service = ChatService.__new__(ChatService)
+        service.prompt_builder = mock.Mock()
+        service.prompt_builder.build_variables.return_value = {}
+        service.llm_service = mock.Mock()
+        service.llm_service.router.ainvoke = mock.AsyncMock(return_value='respuesta')
+        service.load_controller = mock.Mock()
+
+        self.assertEqual(asyncio.run(service.answer_from_documents("¿Plazo?", [])), 'respuesta')
+        service.load_controller.record_generation.assert_not_called()
+
+
+class ChatStreamSSETests(SimpleTestCase):
+    def setUp(self):
+        self.writer = mock.Mock()
+        self.writer.has_pending_conversation.return_value = False
+        for patcher in (
+            mock.patch.object(chat_views.chat_service, 'validate_filters'),
+            mock.patch.object(chat_views, 'message_writer', self.writer),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def stub_stream(self, tokens, error=None, hang=False):
+        async def stream_query(query, chat_history, trace=None, filters=None, on_retrieved=None):
+            trace.update({'sources': ['reglamento.pdf'], 'tier': 'normal'})
+            on_retrieved(trace)
+            for token in tokens:
+                yield token
+            if error:
+                raise error
+            if hang:
+                await asyncio.Event().wait()
+
+        patcher = mock.patch.object(chat_views.chat_service, 'stream_query', stream_query)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def parse(frames):
+        events = []
+        for frame in b''.join(frames).decode().split('\n\n'):
+            if frame.startswith('event: '):
+                event, data = frame.split('\n')
+                events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        return events
+
+    async def open_stream(self):
+        response = await AsyncClient().post(reverse('chatbot:chat_stream_api'), {'query': 'Hola'},
+                                            content_type='application/json')
+        self.assertEqual(response['Content-Type'], 'text/event-stream; charset=utf-8')
+        return response
+
+    async def collect(self):
+        response = await self.open_stream()
+        return self.parse([frame async for frame in response.streaming_content])
+
+    def persisted(self):
+        messages = [call.args[0] for call in self.writer.add_message.call_args_list]
+        return [(message.role, message.content) for message in messages]
+
+    def test_events_in_order_and_answer_persisted(self):
+        self.stub_stream(["Hola", " mundo"])
+        events = asyncio.run(self.collect())
+
+        self.assertEqual([event for event, _ in events], ['retrieval', 'token', 'token', 'message'])
+        retrieval, message = events[0][1], events[-1][1]
+        self.assertEqual(retrieval['message_id'], message['id'])
+        self.assertEqual((retrieval['sources'], retrieval['tier']), (['reglamento.pdf'], 'normal'))
+        self.assertEqual([data['token'] for event, data in events if event == 'token'], ["Hola", " mundo"])
+        self.assertEqual(message['response'], "Hola mundo")
+        self.assertEqual(self.persisted(), [('user', 'Hola'), ('assistant', 'Hola mundo')])
+
+    def test_generation_error_sends_error_event(self):
+        self.stub_stream(["Hola"], error=RuntimeError("LLM caído"))
+        events = asyncio.run(self.collect())
+
+        self.assertEqual([event for event, _ in events], ['retrieval', 'token', 'error'])
+        self.assertEqual(events[-1][1], {'message_id': events[0][1]['message_id'], 'error': 'Internal server error'})
+        self.assertEqual(self.persisted()[-1], ('assistant', 'Hola (Error: LLM caído)'))
+
+    def test_disconnect_persists_partial_answer_once(self):
+        self.stub_stream(["Hola"], hang=True)
+
+        async def scenario():
+            response = await self.open_stream()
+            frames = []
+
+            async def consume():
+                async for frame in response.streaming_content:
+                    frames.append(frame)
+
+            # Django cancela la tarea del generador cuando el cliente se desconecta
+            task = asyncio.create_task(consume())
+            while len(self.parse(frames)) < 2:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            return self.parse(frames)
+
+        events = asyncio.run(scenario())
+        self.assertEqual([event for event, _ in events], ['retrieval', 'token'])
+        self.assertEqual(self.persisted(), [('user', 'Hola'), ('assistant', 'Hola')])
+class HistorySignalsTests(SimpleTestCase):
+    history = [
+        {'role': 'user', 'content': "¿Cuándo es la matrícula?"},
+        {'role': 'assistant', 'content': "En septiembre."},
+        {'role': 'user', 'content': "¿Y las becas?"},
+    ]
+
+    def setUp(self):
+        self.service = RetrievalService(ChunkStore([chunk("Plazos de matrícula")]))
+
+    def test_recent_turns_get_decaying_weights(self):
+        signals = self.service.history_signals("¿Y las becas?", self.history[:2])
+        self.assertEqual([text for text, _ in signals], ["¿Y las becas?", "En septiembre.", "¿Cuándo es la matrícula?"])
+        self.assertEqual([weight for _, weight in signals], [1.0, 0.5, 0.45])
+
+    def test_trailing_current_query_is_not_a_history_signal(self):
+        # El consumidor WebSocket ya añade la consulta al historial; la señal no se duplica
+        self.assertEqual(self.service.history_signals("¿Y las becas?", self.history),
+                         self.service.history_signals("¿Y las becas?", self.history[:2]))
+
+    def test_zero_history_turns_keeps_only_the_query(self):
+        self.service.history_turns = 0
+        self.assertEqual(self.service.history_signals("¿Y las becas?", self.history), [("¿Y las becas?", 1.0)])
+        self.assertEqual(self.service.history_signals("¿Y las becas?", []), [("¿Y las becas?", 1.0)])
+
+    def test_combine_ranked_weights_and_missing_chunks(self):
+        weighted = [(1.0, [(1, 0.8), (2, 0.4)]), (0.5, [(2, 1.0), (3, 0.6)])]
+        combined = RetrievalService._combine_ranked(weighted, k=3)
+        self.assertEqual([idx for idx, _ in combined], [2, 1, 3])
+        np.testing.assert_allclose([score for _, score in combined], [0.6, 0.8 / 1.5, 0.2])
+        self.assertEqual(len(RetrievalService._combine_ranked(weighted, k=2)), 2)
+
+        # Normalizado por el máximo de cada lista (BM25L); el empate se resuelve por id
+        combined = RetrievalService._combine_ranked(weighted, k=3, normalize=True)
+        self.assertEqual([idx for idx, _ in combined], [1, 2, 3])
+        np.testing.assert_allclose([score for _, score in combined], [2 / 3, 2 / 3, 0.2])
+
+    def test_turn_embeddings_are_reused_on_the_next_turn(self):
+        self.service.embed_queries = mock.Mock(side_effect=lambda texts: np.array([[len(text), 1.0] for text in texts]))
+        first = self.service._signal_vectors(["¿Cuándo es la matrícula?"])
+        second = self.service._signal_vectors(["¿Y las becas?", "En septiembre.", "¿Cuándo es la matrícula?"])
+
+        self.assertEqual(self.service.embed_queries.call_args_list[-1].args[0], ["¿Y las becas?", "En septiembre."])
+        np.testing.assert_array_equal(second[2], first[0])
+        self.assertEqual(dict(self.service.history_stats), {'embedding_hits': 1, 'embedding_misses': 3})
+
+    def test_turn_embedding_cache_is_bounded(self):
+        self.service.turn_cache_size = 2
+        self.service.embed_queries = mock.Mock(side_effect=lambda texts: np.ones((len(texts), 2)))
+        self.service._signal_vectors(["a", "b", "c"])
+        self.service._signal_vectors(["a"])
+        self.assertEqual(self.service.history_stats['embedding_misses'], 4)
+        self.assertEqual(len(self.service._turn_embeddings), 2)
+
+
+class ChatConsumerStreamTests(SimpleTestCase):
+    def setUp(self):
+        async def stream_query(query, chat_history, trace=None, filters=None):
+            for token in ("Hola", " mundo"):
+                yield token
+
+        for patcher in (
+            mock.patch.object(consumers.chat_service, 'validate_filters'),
+            mock.patch.object(consumers.chat_service, 'stream_query', stream_query),
+            mock.patch.object(consumers, 'message_writer'),
+            mock.patch.object(consumers.repository, 'close_connections', mock.AsyncMock()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @staticmethod
+    async def connect(session_key):
+        communicator = WebsocketCommunicator(consumers.ChatConsumer.as_asgi(), '/ws/chat/')
+        communicator.scope.update({
+            'user': AnonymousUser(), 'session': mock.Mock(session_key=session_key), 'url_route': {'kwargs': {}}
+        })
+        await communicator.connect()
+        await communicator.receive_json_from()
+        return communicator
+
+    @staticmethod
+    async def receive_until_end(communicator):
+        events = []
+        while not events or events[-1]['type'] not in ('message_complete', 'resume_failed'):
+            events.append(await communicator.receive_json_from(timeout=5))
+        return events
+
+    async def ask(self, session_key):
+        communicator = await self.connect(session_key)
+        await communicator.send_json_to({'type': 'chat_message', 'message': 'Hola'})
+        events = await self.receive_until_end(communicator)
+        await communicator.disconnect()
+        return events
+
+    async def resume(self, session_key, message_id):
+        communicator = await self.connect(session_key)
+        await communicator.send_json_to({'type': 'resume', 'message_id': message_id, 'offset': 1})
+        events = await self.receive_until_end(communicator)
+        await communicator.disconnect()
+        return events
+
+    def test_streaming_start_precedes_tokens(self):
+        events = asyncio.run(self.ask('sesion-a'))
+
+        types = [event['type'] for event in events]
+        self.assertEqual(types, ['system_message', 'streaming_start', 'streaming_token', 'streaming_token',
+                                 'message_complete'])
+        self.assertEqual(events[1]['message_id'], events[-1]['message_id'])
+        self.assertEqual(events[-1]['full_message'], 'Hola mundo')
+
+    def test_only_the_owner_can_resume(self):
+        async def scenario():
+            message_id = (await self.ask('sesion-a'))[-1]['message_id']
+            return await self.resume('sesion-b', message_id), await self.resume('sesion-a', message_id)
+
+        other, owner = asyncio.run(scenario())
+        self.assertEqual([event['type'] for event in other], ['resume_failed'])
+        self.assertEqual([(event['type'], event.get('token')) for event in owner],
+                         [('streaming_token', ' mundo'), ('message_complete', None)])
+
+
+class RetrievalCacheTests(SimpleTestCase):
+    def service(self, page=0):
+        return RetrievalService(ChunkStore([chunk("Plazos de matrícula", page=page), chunk("Becas y ayudas")]))
+
+    def test_index_version_covers_metadata_and_config(self):
+        version = self.service()._index_version()
+        self.assertEqual(version, self.service()._index_version())
+        self.assertNotEqual(version, self.service(page=3)._index_version())
+        for setting, value in {'CHATBOT_CASCADE_MIN_MARGIN': 0.3, 'CHATBOT_HISTORY_TURNS': 4}.items():
+            with self.subTest(setting=setting), override_settings(**{setting: value}):
+                self.assertNotEqual(version, self.service()._index_version())
+
+    def test_explicit_zero_ttl_is_kept(self):
+        self.assertEqual(RetrievalCache(shared_ttl=0).shared_ttl, 0)
+        with override_settings(CHATBOT_RETRIEVAL_CACHE_TTL=0):
+            self.assertEqual(RetrievalCache().shared_ttl, 0)
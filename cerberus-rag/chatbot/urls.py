@@ -1,11 +1,20 @@
 from django.urls import path
-from .views import chat_views, conversation_views, feedback_views
+from .views import batch_views, chat_views, conversation_views, feedback_views, profiling_views
 
 app_name = 'chatbot'
 
 urlpatterns = [
     path('', chat_views.index, name='index'),
     path('api/chat/', chat_views.chat, name='chat_api'),
+    path('api/chat/stream/', chat_views.chat_stream, name='chat_stream_api'),
+    path('api/metrics/load/', chat_views.load_metrics, name='load_metrics_api'),
+    path('api/admin/profiling/', profiling_views.status, name='profiling_status_api'),
+    path('api/admin/profiling/start/', profiling_views.start_sampling, name='profiling_start_api'),
+    path('api/admin/profiling/stacks/', profiling_views.stacks, name='profiling_stacks_api'),
+    path('api/admin/profiling/memory/snapshot/', profiling_views.memory_snapshot, name='memory_snapshot_api'),
+    path('api/admin/profiling/memory/diff/', profiling_views.memory_diff, name='memory_diff_api'),
+    path('api/admin/profiling/memory/stop/', profiling_views.memory_stop, name='memory_stop_api'),
+    path('api/admin/batch-qa/', batch_views.batches, name='batch_qa_api'),
     path('api/feedback/', feedback_views.feedback, name='feedback_api'),
     path('api/conversations/', conversation_views.conversations, name='conversations_api'),
     path('api/conversations/<uuid:conversation_id>/', conversation_views.get_conversation, name='get_conversation_api'),
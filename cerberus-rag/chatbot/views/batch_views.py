@@ -0,0 +1,40 @@
+import json
+import logging
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+from django.views.decorators.http import require_http_methods
+
+from ..services.batch_qa import BatchQAService
+
+logger = logging.getLogger(__name__)
+batch_qa = BatchQAService.get_instance()
+
+# Lotes de preguntas: solo staff y solo sobre ficheros dentro de CHATBOT_BATCH_DIR
+
+@staff_member_required
+@require_http_methods(["GET", "POST"])
+async def batches(request):
+    """GET: estado de los lotes de este proceso. POST: lanza un lote {input, output, batch_size, concurrency, top_k}"""
+    if request.method == "GET":
+        return JsonResponse({'batches': [batch_qa.status(job) for job in batch_qa.jobs.values()]})
+
+    try:
+        data = json.loads(request.body or b'{}')
+        input_name, output_name = data['input'], data['output']
+        options = {key: int(data[key]) for key in ('batch_size', 'concurrency', 'top_k') if key in data}
+    except (KeyError, ValueError, TypeError):
+        return JsonResponse({'error': 'Se requieren input y output; batch_size, concurrency y top_k numéricos'},
+                            status=400)
+    if any(value < 1 for value in options.values()):
+        return JsonResponse({'error': 'batch_size, concurrency y top_k deben ser >= 1'}, status=400)
+
+    try:
+        job = batch_qa.start(input_name, output_name, **options)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except FileNotFoundError:
+        return JsonResponse({'error': 'Fichero de preguntas no encontrado'}, status=404)
+    except RuntimeError as e:
+        return JsonResponse({'error': str(e)}, status=409)
+    logger.info(f"Lote {output_name} lanzado por {await request.auser()}")
+    return JsonResponse(job, status=202)
@@ -2,18 +2,29 @@ import json
 import asyncio
 import logging
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from asgiref.sync import sync_to_async
 
+from .. import repository
 from ..models import Conversation, Message
 from ..services.chat_service import ChatService
+from ..services.metadata_index import InvalidFilterError
+from ..services.message_writer import MessageWriter
+from ..services.load_controller import LoadController
+from ..services.prompt_builder import tokenizer_status
+from ..services.profiling import ProfilingService
+from ..services.answer_streams import AnswerStreamRegistry
+from ..log_pipeline import bind_log_context, pipeline_metrics
 
 logger = logging.getLogger(__name__)
 
 # Obtiene la instancia del servicio de chat
 chat_service = ChatService.get_instance()
+message_writer = MessageWriter.get_instance()
+profiling = ProfilingService.get_instance()
 
 # Esta función se ejecutará al cargar la vista por primera vez
 async def initialize_chat_service():
@@ -35,27 +46,32 @@ def index(request):
     """Vista para la página principal de la interfaz del chatbot."""
     return render(request, 'chatbot/index.html')
 
-# Convertimos operaciones de base de datos a async
-@sync_to_async
-def get_conversation_by_id(conversation_id):
-    return Conversation.objects.get(id=conversation_id)
+def create_message(conversation, role, content, metadata=None):
+    """Construye el mensaje con su id y lo encola para escritura en segundo plano"""
+    message = Message(conversation=conversation, role=role, content=content, metadata=metadata or {})
+    message_writer.add_message(message)
+    return message
 
-@sync_to_async
-def create_conversation(user=None, session_id=None):
-    return Conversation.objects.create(user=user, session_id=session_id)
-
-@sync_to_async
-def get_messages_for_conversation(conversation):
-    messages = Message.objects.filter(conversation=conversation).order_by('created_at')
-    return list(messages)
+async def get_or_create_conversation(request, conversation_id):
+    """
+    Conversación existente del usuario o sesión con su historial, o una nueva (se persiste
+    junto con sus mensajes); lanza `Conversation.DoesNotExist` si el id es de otro dueño
+    """
+    user = await request.auser()
+    user = user if user.is_authenticated else None
+    session_id = request.session.session_key or 'anonymous'
+    if conversation_id:
+        if message_writer.has_pending_conversation(conversation_id):
+            await message_writer.flush()
+        conversation = await repository.get_conversation(conversation_id, user=user, session_id=session_id)
+        bind_log_context(conversation_id=conversation.id)
+        # Obtener historial de mensajes para el contexto
+        return conversation, await repository.get_chat_history(conversation.id)
 
-@sync_to_async
-def create_message(conversation, role, content):
-    return Message.objects.create(
-        conversation=conversation,
-        role=role,
-        content=content
-    )
+    conversation = Conversation(user=user, session_id=session_id)
+    message_writer.add_conversation(conversation)
+    bind_log_context(conversation_id=conversation.id)
+    return conversation, []
 
 @csrf_exempt
 @require_http_methods(["POST", "OPTIONS"])  # Añadir OPTIONS
@@ -70,40 +86,40 @@ async def chat(request):
         data = json.loads(request.body)
         query = data.get('query', '')
         conversation_id = data.get('conversation_id')
+        # Filtro opcional de metadatos: source, page, doc_type, ingested_after, ingested_before
+        filters = data.get('filters')
 
         if not query:
             return JsonResponse({'error': 'Query is required'}, status=400)
+        try:
+            chat_service.validate_filters(filters)
+        except InvalidFilterError as e:
+            return JsonResponse({'error': str(e)}, status=400)
 
-        # Obtener o crear una conversación
-        if conversation_id:
-            try:
-                conversation = await get_conversation_by_id(conversation_id)
-            except Conversation.DoesNotExist:
-                return JsonResponse({'error': 'Conversation not found'}, status=404)
-        else:
-            # Crear nueva conversación
-            conversation = await create_conversation(
-                user=request.user if request.user.is_authenticated else None,
-                session_id=request.session.session_key or 'anonymous'
-            )
-
-        # Obtener historial de mensajes para el contexto
-        messages = await get_messages_for_conversation(conversation)
-        chat_history = [{'role': msg.role, 'content': msg.content} for msg in messages]
+        try:
+            conversation, chat_history = await get_or_create_conversation(request, conversation_id)
+        except Conversation.DoesNotExist:
+            return JsonResponse({'error': 'Conversation not found'}, status=404)
 
         # Guardar el mensaje del usuario
-        user_message = await create_message(
+        user_message = create_message(
             conversation=conversation,
             role='user',
             content=query
         )
 
-        # Procesar la consulta
-        response_data = await chat_service.process_query(query, chat_history)
+        # Procesar la consulta (perfilada si el profiler está armado)
+        trace = {}
+        try:
+            async with profiling.request('chat'):
+                response_data = await chat_service.process_query(query, chat_history, trace=trace, filters=filters)
+        except InvalidFilterError as e:
+            # Solo si el índice terminó de cargarse después de la validación inicial
+            return JsonResponse({'error': str(e)}, status=400)
 
         if 'error' in response_data:
             # Guardar mensaje de error como sistema
-            error_message = await create_message(
+            error_message = create_message(
                 conversation=conversation,
                 role='system',
                 content=response_data.get('fallback_response', response_data['error'])
@@ -111,19 +127,147 @@ async def chat(request):
             return JsonResponse(response_data, status=500)
 
         # Guardar la respuesta del asistente
-        assistant_message = await create_message(
+        assistant_message = create_message(
             conversation=conversation,
             role='assistant',
-            content=response_data['response']
+            content=response_data['response'],
+            metadata=trace
         )
 
         return JsonResponse({
             'id': str(assistant_message.id),
             'conversation_id': str(conversation.id),
             'response': response_data['response'],
+            'sources': response_data.get('sources', []),
+            'tier': trace.get('tier'),
             'timestamp': assistant_message.created_at.isoformat()
         })
 
     except Exception as e:
         logger.error(f"Error en chat endpoint: {str(e)}")
         return JsonResponse({'error': 'Internal server error'}, status=500)
+
+def sse_event(event, data):
+    """Trama de Server-Sent Events con datos JSON (una sola línea `data:`)"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@csrf_exempt
+@require_http_methods(["POST", "OPTIONS"])
+async def chat_stream(request):
+    """
+    Variante en streaming de `chat` con Server-Sent Events.
+
+    Eventos: `retrieval` (chunks recuperados y escalón de carga), `token` (cada
+    fragmento generado), `message` (respuesta completa, como la de `chat`) y
+    `error`. Cada pocos segundos sin datos se envía un comentario para que los
+    proxies no cierren la conexión; funciona con cualquier proxy HTTP/1.1 que no
+    almacene la respuesta en búfer.
+    """
+    if request.method == "OPTIONS":
+        return JsonResponse({})
+
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
+    query = data.get('query', '')
+    filters = data.get('filters')
+    if not query:
+        return JsonResponse({'error': 'Query is required'}, status=400)
+    try:
+        chat_service.validate_filters(filters)
+    except InvalidFilterError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    try:
+        conversation, chat_history = await get_or_create_conversation(request, data.get('conversation_id'))
+    except Conversation.DoesNotExist:
+        return JsonResponse({'error': 'Conversation not found'}, status=404)
+
+    create_message(conversation=conversation, role='user', content=query)
+    # El id del mensaje del asistente se conoce antes del primer token
+    assistant_message = Message(conversation=conversation, role='assistant', content="")
+    message_id, conversation_id = str(assistant_message.id), str(conversation.id)
+    keepalive = getattr(settings, 'CHATBOT_SSE_KEEPALIVE', 15.0)
+
+    async def events():
+        queue = asyncio.Queue()
+        trace = {}
+
+        def on_retrieved(trace):
+            queue.put_nowait(('retrieval', {
+                'message_id': message_id, 'conversation_id': conversation_id,
+                'sources': trace.get('sources', []), 'tier': trace.get('tier')
+            }))
+
+        async def produce():
+            # La generación corre en su propia tarea: los keepalive no dependen del ritmo de los tokens
+            try:
+                async with profiling.request('chat_stream'):
+                    async for token in chat_service.stream_query(query, chat_history, trace=trace,
+                                                                 filters=filters, on_retrieved=on_retrieved):
+                        if token:
+                            queue.put_nowait(('token', token))
+                queue.put_nowait(('done', None))
+            except Exception as e:
+                queue.put_nowait(('error', str(e)))
+
+        response_text = ""
+        producer = asyncio.create_task(produce())
+        try:
+            while True:
+                try:
+                    kind, payload = await asyncio.wait_for(queue.get(), timeout=keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if kind == 'token':
+                    response_text += payload
+                    yield sse_event('token', {'token': payload})
+                elif kind == 'retrieval':
+                    yield sse_event('retrieval', payload)
+                elif kind == 'error':
+                    logger.error(f"Error en chat_stream: {payload}")
+                    response_text = f"{response_text} (Error: {payload})"
+                    yield sse_event('error', {'message_id': message_id, 'error': 'Internal server error'})
+                    break
+                else:
+                    yield sse_event('message', {
+                        'id': message_id,
+                        'conversation_id': conversation_id,
+                        'response': response_text,
+                        'sources': trace.get('sources', []),
+                        'tier': trace.get('tier'),
+                        'timestamp': assistant_message.created_at.isoformat()
+                    })
+                    break
+        finally:
+            # Si el cliente se desconecta, Django cancela este generador: se detiene la generación
+            producer.cancel()
+            # El mensaje se persiste una sola vez con lo generado, aunque sea parcial
+            assistant_message.content = response_text
+            assistant_message.metadata = trace
+            message_writer.add_message(assistant_message)
+
+    response = StreamingHttpResponse(events(), content_type='text/event-stream; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    # nginx: no almacenar la respuesta en búfer
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+# Solo staff: expone el estado interno del proceso
+@staff_member_required
+@require_http_methods(["GET"])
+def load_metrics(request):
+    """Escalón de degradación actual y señales de carga del proceso"""
+    metrics = LoadController.get_instance().metrics()
+    if chat_service.retrieval_service is not None:
+        metrics['rerank'] = dict(chat_service.retrieval_service.cascade_stats)
+        metrics['history'] = dict(chat_service.retrieval_service.history_stats)
+        metrics['retrieval_cache'] = chat_service.retrieval_service.result_cache.metrics()
+    metrics['answer_streams'] = AnswerStreamRegistry.get_instance().stats()
+    # exact=False: el presupuesto del prompt se mide con la aproximación, no con el tokenizador del modelo
+    metrics['prompt_tokenizer'] = dict(tokenizer_status)
+    metrics['logging'] = pipeline_metrics()
+    if chat_service.llm_service is not None and chat_service.llm_service.router is not None:
+        metrics['llm_endpoints'] = chat_service.llm_service.router.status()
+    return JsonResponse(metrics)
@@ -4,36 +4,15 @@ import logging
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
-from asgiref.sync import sync_to_async
 
-from ..models import Message, Feedback
+from .. import repository
+from ..models import Message
 from ..services.chat_service import ChatService
+from ..services.message_writer import MessageWriter
 
 logger = logging.getLogger(__name__)
 chat_service = ChatService.get_instance()
-
-@sync_to_async
-def get_message_by_id(message_id):
-    return Message.objects.get(id=message_id, role='assistant')
-
-@sync_to_async
-def create_feedback_record(message, rating):
-    return Feedback.objects.create(
-        message=message,
-        rating=int(rating)
-    )
-
-@sync_to_async
-def get_last_user_message(conversation):
-    last_user_message = conversation.messages.filter(role='user').last()
-    if last_user_message:
-        return last_user_message.content
-    return ""
-
-@sync_to_async
-def save_feedback_to_file(query, answer, rating):
-    # Envolvemos la función síncrona de chat_service con sync_to_async
-    return chat_service.save_feedback(query, answer, rating)
+message_writer = MessageWriter.get_instance()
 
 @csrf_exempt
 @require_http_methods(["POST", "OPTIONS"])  # Añadir OPTIONS
@@ -53,18 +32,24 @@ async def feedback(request):
             return JsonResponse({'error': 'Message ID and rating (1-5) are required'}, status=400)
 
         try:
-            message = await get_message_by_id(message_id)
+            # El mensaje puede seguir en la cola de escritura
+            await message_writer.flush()
+            message = await repository.get_assistant_message(message_id)
         except Message.DoesNotExist:
             return JsonResponse({'error': 'Message not found'}, status=404)
 
         # Guardar feedback en la base de datos
-        feedback_obj = await create_feedback_record(message, int(rating))
+        feedback_obj = await repository.create_feedback(message, int(rating))
 
         # Obtener la última consulta del usuario de forma segura
-        query = await get_last_user_message(message.conversation)
-
-        # Usar nuestra función envuelta en sync_to_async
-        await save_feedback_to_file(query, message.content, int(rating))
+        query = await repository.get_last_user_query(message.conversation_id)
+
+        # Registrar en el diario de feedback (solo encola el evento)
+        await chat_service.save_feedback_async(
+            query, message.content, int(rating),
+            message_id=message.id,
+            conversation_id=message.conversation_id
+        )
 
         return JsonResponse({'status': 'success', 'feedback_id': str(feedback_obj.id)})
 
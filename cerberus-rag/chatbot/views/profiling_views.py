@@ -0,0 +1,83 @@
+import json
+import logging
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import HttpResponse, JsonResponse
+from django.views.decorators.http import require_http_methods
+
+from ..services.profiling import ProfilingService
+
+logger = logging.getLogger(__name__)
+profiling = ProfilingService.get_instance()
+
+# Vistas de diagnóstico: solo para staff, con sesión del admin de Django y protección CSRF
+
+@staff_member_required
+@require_http_methods(["GET"])
+def status(request):
+    """Estado del profiler, del monitor del event loop y de las instantáneas de memoria"""
+    return JsonResponse({
+        'sampler': profiling.sampler.status(),
+        'loop_lag': profiling.loop_monitor.status(),
+        'memory_snapshots': list(profiling.memory.snapshots.keys())
+    })
+
+@staff_member_required
+@require_http_methods(["POST"])
+def start_sampling(request):
+    """Arma el profiler por muestreo (de todo el proceso) mientras se atienden las próximas N peticiones de chat"""
+    try:
+        data = json.loads(request.body or b'{}')
+        requests = int(data.get('requests', 10))
+        interval_ms = float(data.get('interval_ms', 5))
+    except (ValueError, TypeError):
+        return JsonResponse({'error': 'requests e interval_ms deben ser numéricos'}, status=400)
+    if requests < 1 or interval_ms <= 0:
+        return JsonResponse({'error': 'requests debe ser >= 1 e interval_ms > 0'}, status=400)
+
+    profiling.sampler.arm(requests, interval_ms / 1000)
+    logger.info(f"Profiler armado por {request.user} para {requests} peticiones cada {interval_ms} ms")
+    return JsonResponse(profiling.sampler.status())
+
+@staff_member_required
+@require_http_methods(["GET"])
+def stacks(request):
+    """Pilas plegadas del último perfilado, compatibles con flamegraph.pl y speedscope"""
+    response = HttpResponse(profiling.sampler.collapsed(), content_type='text/plain; charset=utf-8')
+    response['Content-Disposition'] = 'attachment; filename="chatbot.folded"'
+    return response
+
+@staff_member_required
+@require_http_methods(["POST"])
+def memory_snapshot(request):
+    """Toma una instantánea de tracemalloc (lo arranca si no estaba activo)"""
+    return JsonResponse(profiling.memory.snapshot())
+
+@staff_member_required
+@require_http_methods(["GET"])
+def memory_diff(request):
+    """Ubicaciones con más crecimiento entre dos instantáneas (?from=&to=), o las mayores de una (?to=)"""
+    try:
+        to_id = int(request.GET['to'])
+        from_id = int(request.GET['from']) if 'from' in request.GET else None
+        limit = int(request.GET.get('limit', 20))
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'Se requiere el parámetro numérico to'}, status=400)
+    group_by = request.GET.get('group_by', 'lineno')
+    if group_by not in ('lineno', 'filename', 'traceback'):
+        return JsonResponse({'error': 'group_by debe ser lineno, filename o traceback'}, status=400)
+
+    try:
+        if from_id is None:
+            stats = profiling.memory.top(to_id, limit, group_by)
+        else:
+            stats = profiling.memory.diff(from_id, to_id, limit, group_by)
+    except KeyError:
+        return JsonResponse({'error': 'Instantánea no encontrada'}, status=404)
+    return JsonResponse({'from': from_id, 'to': to_id, 'stats': stats})
+
+@staff_member_required
+@require_http_methods(["POST"])
+def memory_stop(request):
+    """Detiene tracemalloc y descarta las instantáneas, eliminando su sobrecoste"""
+    profiling.memory.stop()
+    return JsonResponse({'tracing': False})
@@ -1,4 +1,4 @@
-import { useState, useEffect, useRef } from "react";
+import { useState, useEffect, useRef, useCallback } from "react";
 import { getConversations, getConversation } from "../services/chatService";
 import webSocketService from "../services/webSocketService";
 
@@ -10,15 +10,50 @@ export default function useChatLogic(initialConversationId = null) {
   const [showConversations, setShowConversations] = useState(false);
   const [conversations, setConversations] = useState([]);
   const [connected, setConnected] = useState(false);
-  const [pendingStreamingMessages, setPendingStreamingMessages] = useState(
-    new Map(),
-  );
+  const [isStreaming, setIsStreaming] = useState(false);
+
+  // Ids of the messages being streamed; their text lives in webSocketService's buffer
+  const streamingRef = useRef(new Set());
+  const frameRef = useRef(null);
 
-  // Refs to maintain state in callbacks
-  const messagesRef = useRef(messages);
-  messagesRef.current = messages;
-  const streamingRef = useRef(pendingStreamingMessages);
-  streamingRef.current = pendingStreamingMessages;
+  const stopStreaming = (messageId) => {
+    if (messageId === undefined) {
+      streamingRef.current.clear();
+    } else {
+      streamingRef.current.delete(messageId);
+    }
+    if (streamingRef.current.size === 0) {
+      setIsStreaming(false);
+    }
+  };
+
+  // Copy buffered tokens into state at most once per animation frame. Only the
+  // streaming messages get new objects, so the memoized bubbles of every other
+  // message are not re-rendered.
+  const flushStreaming = useCallback(() => {
+    frameRef.current = null;
+    setMessages((prev) => {
+      let next = prev;
+      let pending = streamingRef.current.size;
+      for (let i = prev.length - 1; i >= 0 && pending > 0; i--) {
+        const msg = prev[i];
+        if (!msg.isStreaming || !streamingRef.current.has(msg.id)) continue;
+        pending--;
+        const content = webSocketService.getBufferedMessage(msg.id);
+        if (content && content !== msg.content) {
+          if (next === prev) next = prev.slice();
+          next[i] = { ...msg, content };
+        }
+      }
+      return next;
+    });
+  }, []);
+
+  const scheduleFlush = useCallback(() => {
+    if (frameRef.current === null) {
+      frameRef.current = requestAnimationFrame(flushStreaming);
+    }
+  }, [flushStreaming]);
 
   // Initialize WebSocket connection
   useEffect(() => {
@@ -44,11 +79,8 @@ export default function useChatLogic(initialConversationId = null) {
     const streamingStartHandler = (data) => {
       const { message_id, initialToken } = data;
 
-      setPendingStreamingMessages((prev) => {
-        const newMap = new Map(prev);
-        newMap.set(message_id, initialToken);
-        return newMap;
-      });
+      streamingRef.current.add(message_id);
+      setIsStreaming(true);
 
       setMessages((prev) => [
         ...prev,
@@ -61,15 +93,8 @@ export default function useChatLogic(initialConversationId = null) {
       ]);
     };
 
-    const streamingProgressHandler = (data) => {
-      const { message_id, lastToken } = data;
-
-      setPendingStreamingMessages((prev) => {
-        const newMap = new Map(prev);
-        const currentContent = newMap.get(message_id) || "";
-        newMap.set(message_id, currentContent + lastToken);
-        return newMap;
-      });
+    const streamingProgressHandler = () => {
+      scheduleFlush();
     };
 
     const messageCompleteHandler = (data) => {
@@ -80,21 +105,14 @@ export default function useChatLogic(initialConversationId = null) {
           msg.id === message_id
             ? {
                 ...msg,
-                content:
-                  content ||
-                  streamingRef.current.get(message_id) ||
-                  msg.content,
+                content: content || msg.content,
                 isStreaming: false,
               }
             : msg,
         ),
       );
 
-      setPendingStreamingMessages((prev) => {
-        const newMap = new Map(prev);
-        newMap.delete(message_id);
-        return newMap;
-      });
+      stopStreaming(message_id);
 
       if (conversation_id) {
         setConversationId(conversation_id);
@@ -103,6 +121,27 @@ export default function useChatLogic(initialConversationId = null) {
       setIsLoading(false);
     };
 
+    const resumeFailedHandler = (data) => {
+      const { message_id, content } = data;
+
+      // Keep what was received before the connection dropped
+      setMessages((prev) => [
+        ...prev.map((msg) =>
+          msg.id === message_id
+            ? { ...msg, content: content || msg.content, isStreaming: false }
+            : msg,
+        ),
+        {
+          role: "system",
+          content:
+            "La respuesta se interrumpió al perder la conexión. Vuelve a abrir la conversación para verla completa.",
+        },
+      ]);
+
+      stopStreaming(message_id);
+      setIsLoading(false);
+    };
+
     const feedbackReceivedHandler = (data) => {
       const { message_id, rating } = data;
       setMessages((prev) =>
@@ -116,23 +155,31 @@ export default function useChatLogic(initialConversationId = null) {
       console.error("WebSocket error:", data.error || data.message);
       setIsLoading(false);
 
-      if (streamingRef.current.size > 0) {
-        setMessages((prev) => {
-          const newMessages = [...prev];
-          for (let i = 0; i < newMessages.length; i++) {
-            if (newMessages[i].isStreaming) {
-              newMessages[i] = {
-                ...newMessages[i],
-                isStreaming: false,
-                content:
-                  "Error: La conexión se perdió durante la generación de respuesta.",
-              };
-            }
-          }
-          return newMessages;
-        });
-
-        setPendingStreamingMessages(new Map());
+      // A server error names its stream; a connection error only ends the streams
+      // that webSocketService will not resume once it reconnects
+      const resumable = new Set(webSocketService.getPendingMessages());
+      const interrupted = data.message_id
+        ? [data.message_id]
+        : [...streamingRef.current].filter((id) => !resumable.has(id));
+
+      if (interrupted.length > 0) {
+        setMessages((prev) =>
+          prev.map((msg) =>
+            msg.isStreaming && interrupted.includes(msg.id)
+              ? {
+                  ...msg,
+                  isStreaming: false,
+                  content:
+                    data.content ||
+                    (data.message_id
+                      ? "Error: No se pudo generar la respuesta."
+                      : "Error: La conexión se perdió durante la generación de respuesta."),
+                }
+              : msg,
+          ),
+        );
+
+        interrupted.forEach(stopStreaming);
       }
 
       setMessages((prev) => [
@@ -167,6 +214,10 @@ export default function useChatLogic(initialConversationId = null) {
       "message_complete",
       messageCompleteHandler,
     );
+    const unsubscribeResumeFailed = webSocketService.addMessageHandler(
+      "resume_failed",
+      resumeFailedHandler,
+    );
     const unsubscribeFeedback = webSocketService.addMessageHandler(
       "feedback_received",
       feedbackReceivedHandler,
@@ -186,23 +237,6 @@ export default function useChatLogic(initialConversationId = null) {
     // Connect to WebSocket
     webSocketService.connect(conversationId);
 
-    // Interval to update streaming messages
-    const streamingUpdateInterval = setInterval(() => {
-      setMessages((prev) => {
-        if (streamingRef.current.size === 0) return prev;
-
-        return prev.map((msg) => {
-          if (msg.isStreaming && streamingRef.current.has(msg.id)) {
-            return {
-              ...msg,
-              content: streamingRef.current.get(msg.id),
-            };
-          }
-          return msg;
-        });
-      });
-    }, 100);
-
     // Cleanup on unmount
     return () => {
       unsubscribeConnect();
@@ -210,17 +244,21 @@ export default function useChatLogic(initialConversationId = null) {
       unsubscribeStreamingStart();
       unsubscribeStreamingProgress();
       unsubscribeComplete();
+      unsubscribeResumeFailed();
       unsubscribeFeedback();
       unsubscribeError();
       unsubscribeDisconnect();
 
-      clearInterval(streamingUpdateInterval);
+      if (frameRef.current !== null) {
+        cancelAnimationFrame(frameRef.current);
+        frameRef.current = null;
+      }
 
       if (webSocketService.isConnected()) {
         webSocketService.disconnect();
       }
     };
-  }, [isOpen, conversationId]);
+  }, [isOpen, conversationId, scheduleFlush]);
 
   // Load conversations
   useEffect(() => {
@@ -272,7 +310,7 @@ export default function useChatLogic(initialConversationId = null) {
         webSocketService.disconnect();
       }
 
-      setPendingStreamingMessages(new Map());
+      stopStreaming();
 
       const data = await getConversation(id);
       setMessages(data.messages);
@@ -300,30 +338,33 @@ export default function useChatLogic(initialConversationId = null) {
       webSocketService.disconnect();
     }
 
-    setPendingStreamingMessages(new Map());
+    stopStreaming();
     setConversationId(null);
     setMessages([]);
     webSocketService.connect();
     setShowConversations(false);
   };
 
-  // Send feedback via WebSocket
-  const sendFeedback = (messageId, rating) => {
-    if (!webSocketService.isConnected()) {
-      webSocketService.connect(conversationId);
-      setTimeout(() => {
+  // Send feedback via WebSocket (stable identity so memoized bubbles don't re-render)
+  const sendFeedback = useCallback(
+    (messageId, rating) => {
+      if (!webSocketService.isConnected()) {
+        webSocketService.connect(conversationId);
+        setTimeout(() => {
+          webSocketService.sendFeedback(messageId, rating);
+        }, 500);
+      } else {
         webSocketService.sendFeedback(messageId, rating);
-      }, 500);
-    } else {
-      webSocketService.sendFeedback(messageId, rating);
-    }
+      }
 
-    setMessages((prev) =>
-      prev.map((msg) =>
-        msg.id === messageId ? { ...msg, feedback: rating } : msg,
-      ),
-    );
-  };
+      setMessages((prev) =>
+        prev.map((msg) =>
+          msg.id === messageId ? { ...msg, feedback: rating } : msg,
+        ),
+      );
+    },
+    [conversationId],
+  );
 
   // Close chat window
   const closeChat = () => {
@@ -331,7 +372,7 @@ export default function useChatLogic(initialConversationId = null) {
       webSocketService.disconnect();
     }
     setIsOpen(false);
-    setPendingStreamingMessages(new Map());
+    stopStreaming();
   };
 
   return {
@@ -354,6 +395,6 @@ export default function useChatLogic(initialConversationId = null) {
     loadConversation,
     startNewConversation,
     connected,
-    isStreaming: pendingStreamingMessages.size > 0,
+    isStreaming,
   };
 }
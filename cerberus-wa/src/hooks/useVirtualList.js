@@ -0,0 +1,166 @@
+import { useState, useEffect, useLayoutEffect, useRef, useCallback } from "react";
+
+// Distance (px) from the bottom at which the list keeps following new content
+const BOTTOM_THRESHOLD = 48;
+
+/**
+ * Windowing for a scrollable list of rows with variable, unknown heights.
+ *
+ * Only the rows inside the viewport (plus `overscan` px above and below) are
+ * rendered; spacers stand in for the rest. Row heights are measured with a
+ * single ResizeObserver and cached by key, so a streaming message that grows
+ * only updates its own height. While the user is at the bottom the list
+ * sticks to it, without smooth-scroll animations.
+ */
+export default function useVirtualList({
+  keys,
+  estimatedHeight = 80,
+  overscan = 600,
+}) {
+  const containerRef = useRef(null);
+  const heightsRef = useRef(new Map());
+  const atBottomRef = useRef(true);
+  const observerRef = useRef(null);
+  const frameRef = useRef(null);
+  const pendingRef = useRef(new Set());
+  const [viewport, setViewport] = useState({ top: 0, height: 0 });
+  const [, setMeasured] = useState(0);
+
+  // Run the queued updates together, at most once per animation frame
+  const schedule = useCallback((update) => {
+    pendingRef.current.add(update);
+    if (frameRef.current !== null) return;
+    frameRef.current = requestAnimationFrame(() => {
+      frameRef.current = null;
+      const updates = Array.from(pendingRef.current);
+      pendingRef.current.clear();
+      updates.forEach((run) => run());
+    });
+  }, []);
+
+  const readViewport = useCallback(() => {
+    const container = containerRef.current;
+    if (!container) return;
+    atBottomRef.current =
+      container.scrollHeight - container.scrollTop - container.clientHeight <
+      BOTTOM_THRESHOLD;
+    setViewport((prev) =>
+      prev.top === container.scrollTop &&
+      prev.height === container.clientHeight
+        ? prev
+        : { top: container.scrollTop, height: container.clientHeight },
+    );
+  }, []);
+
+  const bumpMeasured = useCallback(
+    () => setMeasured((version) => version + 1),
+    [],
+  );
+
+  const getObserver = useCallback(() => {
+    if (observerRef.current === null && typeof ResizeObserver !== "undefined") {
+      observerRef.current = new ResizeObserver((entries) => {
+        let changed = false;
+        for (const entry of entries) {
+          // Unmounted rows report a zero size: keep their last measurement
+          if (!entry.target.isConnected) continue;
+          const key = entry.target.dataset.virtualKey;
+          const height = entry.target.offsetHeight;
+          if (key !== undefined && heightsRef.current.get(key) !== height) {
+            heightsRef.current.set(key, height);
+            changed = true;
+          }
+        }
+        if (changed) schedule(bumpMeasured);
+      });
+    }
+    return observerRef.current;
+  }, [schedule, bumpMeasured]);
+
+  // Callback ref for each rendered row (React 19 runs the returned cleanup on unmount)
+  const measureRef = useCallback(
+    (element) => {
+      const observer = getObserver();
+      if (!element || !observer) return undefined;
+      observer.observe(element);
+      return () => observer.unobserve(element);
+    },
+    [getObserver],
+  );
+
+  const onScroll = useCallback(
+    () => schedule(readViewport),
+    [schedule, readViewport],
+  );
+
+  // Row offsets from the cached heights (cheap arithmetic, no DOM access)
+  const offsets = new Array(keys.length + 1);
+  offsets[0] = 0;
+  for (let i = 0; i < keys.length; i++) {
+    offsets[i + 1] =
+      offsets[i] + (heightsRef.current.get(String(keys[i])) ?? estimatedHeight);
+  }
+  const totalHeight = offsets[keys.length];
+
+  // First row ending below the top of the window, by binary search
+  const windowTop = viewport.top - overscan;
+  const windowBottom = viewport.top + viewport.height + overscan;
+  let low = 0;
+  let high = keys.length;
+  while (low < high) {
+    const mid = (low + high) >> 1;
+    if (offsets[mid + 1] <= windowTop) low = mid + 1;
+    else high = mid;
+  }
+  let end = low;
+  while (end < keys.length && offsets[end] < windowBottom) end++;
+  // Until the viewport is measured, render the tail of the list
+  const startIndex = viewport.height ? low : Math.max(0, keys.length - 20);
+  const endIndex = viewport.height ? end : keys.length;
+
+  // Stick to the bottom when content grows, if the user was already there
+  useLayoutEffect(() => {
+    const container = containerRef.current;
+    if (container && atBottomRef.current) {
+      container.scrollTop = container.scrollHeight;
+    }
+  });
+
+  useEffect(() => {
+    const container = containerRef.current;
+    const rows = getObserver();
+    // Rows mounted before this effect (or kept across a StrictMode remount)
+    if (container && rows) {
+      container
+        .querySelectorAll("[data-virtual-key]")
+        .forEach((element) => rows.observe(element));
+    }
+    readViewport();
+    const resize =
+      container && typeof ResizeObserver !== "undefined"
+        ? new ResizeObserver(() => schedule(readViewport))
+        : null;
+    if (resize) resize.observe(container);
+
+    return () => {
+      if (resize) resize.disconnect();
+      if (rows) rows.disconnect();
+      observerRef.current = null;
+      if (frameRef.current !== null) {
+        cancelAnimationFrame(frameRef.current);
+        frameRef.current = null;
+      }
+      pendingRef.current.clear();
+    };
+  }, [getObserver, readViewport, schedule]);
+
+  return {
+    containerRef,
+    onScroll,
+    measureRef,
+    startIndex,
+    endIndex,
+    paddingTop: offsets[startIndex],
+    paddingBottom: totalHeight - offsets[endIndex],
+  };
+}
@@ -1,4 +1,4 @@
-import React from "react";
+import React, { memo } from "react";
 import ReactMarkdown from "react-markdown";
 import rehypeSanitize from "rehype-sanitize";
 import "./MessageBubble.css";
@@ -52,4 +52,5 @@ const MessageBubble = ({ message, onFeedback }) => {
   );
 };
 
-export default MessageBubble;
+// Messages are immutable objects: while an answer streams only its own bubble re-renders
+export default memo(MessageBubble);
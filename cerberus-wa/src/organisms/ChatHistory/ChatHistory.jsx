@@ -1,27 +1,37 @@
-import React, { useRef, useEffect } from "react";
+import React from "react";
 import "./ChatHistory.css";
 import MessageBubble from "../../molecules/MessageBubble";
 import Spinner from "../../atoms/Spinner";
+import useVirtualList from "../../hooks/useVirtualList";
 
-const ChatHistory = ({ messages, isLoading, onFeedback }) => {
-  const historyEndRef = useRef(null);
+const messageKey = (message, index) => message.id || `index-${index}`;
 
-  // Auto-scroll to bottom on new messages
-  useEffect(() => {
-    if (historyEndRef.current) {
-      historyEndRef.current.scrollIntoView({ behavior: "smooth" });
-    }
-  }, [messages, isLoading]);
+const ChatHistory = ({ messages, isLoading, onFeedback }) => {
+  // Only the visible messages are mounted; the list follows new content while at the bottom
+  const {
+    containerRef,
+    onScroll,
+    measureRef,
+    startIndex,
+    endIndex,
+    paddingTop,
+    paddingBottom,
+  } = useVirtualList({ keys: messages.map(messageKey) });
 
   return (
-    <div className="chat-history">
-      {messages.map((message, index) => (
-        <MessageBubble
-          key={message.id || index}
-          message={message}
-          onFeedback={onFeedback}
-        />
-      ))}
+    <div className="chat-history" ref={containerRef} onScroll={onScroll}>
+      <div className="chat-history-spacer" style={{ height: paddingTop }} />
+
+      {messages.slice(startIndex, endIndex).map((message, offset) => {
+        const key = messageKey(message, startIndex + offset);
+        return (
+          <div key={key} data-virtual-key={key} ref={measureRef}>
+            <MessageBubble message={message} onFeedback={onFeedback} />
+          </div>
+        );
+      })}
+
+      <div className="chat-history-spacer" style={{ height: paddingBottom }} />
 
       {isLoading && (
         <div className="loading-indicator">
@@ -29,8 +39,6 @@ const ChatHistory = ({ messages, isLoading, onFeedback }) => {
           <span>Procesando información...</span>
         </div>
       )}
-
-      <div ref={historyEndRef}></div>
     </div>
   );
 };
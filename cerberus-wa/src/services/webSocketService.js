@@ -34,6 +34,10 @@ class WebSocketService {
     this.socket.onopen = () => {
       console.log("WebSocket connection established");
       this.connected = true;
+      if (this.reconnecting) {
+        // Resume answers that were streaming when the connection dropped
+        this._resumePendingMessages();
+      }
       this.reconnecting = false;
       this._notifyHandlers("connect", { connected: true });
     };
@@ -63,6 +67,12 @@ class WebSocketService {
   }
 
   _processMessage(data) {
+    // The server registered the stream: track it before the first token arrives
+    if (data.type === "streaming_start") {
+      this._startStream(data.message_id, "");
+      return;
+    }
+
     // Handle streaming tokens specially to buffer them
     if (data.type === "streaming_token") {
       this._handleStreamingToken(data);
@@ -75,30 +85,86 @@ class WebSocketService {
       return;
     }
 
+    // The server no longer has the stream (expired or another worker)
+    if (data.type === "resume_failed") {
+      this._handleResumeFailed(data);
+      return;
+    }
+
+    // Generation failed on the server: the stream is over and cannot be resumed
+    if (data.type === "error" && data.message_id) {
+      this._handleStreamError(data);
+      return;
+    }
+
     // For all other message types, pass through normally
     this._notifyHandlers(data.type, data);
   }
 
+  _resumePendingMessages() {
+    this.pendingMessages.forEach((messageId) => {
+      const received = this.messageBuffer.get(messageId)?.tokens.length || 0;
+      console.log(`Resuming message ${messageId} from token ${received}`);
+      this.socket.send(
+        JSON.stringify({
+          type: "resume",
+          message_id: messageId,
+          offset: received,
+        }),
+      );
+    });
+  }
+
+  _handleResumeFailed(data) {
+    const { message_id } = data;
+    const content = this.messageBuffer.get(message_id)?.content || "";
+
+    this.pendingMessages.delete(message_id);
+    this.messageBuffer.delete(message_id);
+    this._notifyHandlers("resume_failed", { message_id, content });
+  }
+
+  _handleStreamError(data) {
+    const { message_id } = data;
+    const content = this.messageBuffer.get(message_id)?.content || "";
+
+    this.pendingMessages.delete(message_id);
+    this.messageBuffer.delete(message_id);
+    this._notifyHandlers("error", { ...data, content });
+  }
+
+  _startStream(message_id, initialToken) {
+    if (this.pendingMessages.has(message_id)) {
+      return;
+    }
+    // Pending messages are resumed if the connection drops
+    this.pendingMessages.add(message_id);
+    // Initialize buffer for this message
+    this.messageBuffer.set(message_id, {
+      content: "",
+      tokens: [],
+      lastUpdate: Date.now(),
+    });
+
+    // Notify that a new message has started streaming
+    this._notifyHandlers("streaming_start", {
+      message_id,
+      initialToken,
+    });
+  }
+
   _handleStreamingToken(data) {
-    const { token, message_id } = data;
-
-    // Add message_id to pending messages if not already there
-    if (!this.pendingMessages.has(message_id)) {
-      this.pendingMessages.add(message_id);
-      // Initialize buffer for this message
-      this.messageBuffer.set(message_id, {
-        content: "",
-        tokens: [],
-        lastUpdate: Date.now(),
-      });
+    const { token, message_id, offset } = data;
 
-      // Notify that a new message has started streaming
-      this._notifyHandlers("streaming_start", {
-        message_id,
-        initialToken: token,
-      });
+    // Tokens replayed after a resume that were already received
+    const received = this.messageBuffer.get(message_id)?.tokens.length || 0;
+    if (offset !== undefined && offset < received) {
+      return;
     }
 
+    // Servers without streaming_start: the first token starts the stream
+    this._startStream(message_id, token);
+
     // Add token to buffer
     const messageData = this.messageBuffer.get(message_id);
     messageData.content += token;